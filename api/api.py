@@ -1,15 +1,45 @@
 print('Inicializando a estrutura da API...\nImportando as bibliotecas...')
-from fastapi import FastAPI
-from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
+import asyncio
+from contextlib import aclosing, asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from sentence_transformers import SentenceTransformer
 from starlette.middleware.cors import CORSMiddleware
 
 from api.environment.environment import environment
 from api.gerador_de_respostas import GeradorDeRespostas, DadosChat
+from api.utils.admissao import ControladorAdmissao, RejeicaoAdmissao
+from api.utils.cache import CacheEmbeddings, CacheRespostas
+from api.utils.eventos import agrupar_tokens, serializar_ndjson
+from api.utils.metricas import metricas
+from api.utils.paginas_estaticas import ArquivosEstaticosImutaveis, PaginaPreRenderizada
+from api.utils.servidor_modelos import ClienteServidorModelos, FuncaoEmbeddingsRemota, RerankerBertRemoto
+from api.utils.sessoes import RepositorioSessoes
 from api.utils.utils import FuncaoEmbeddings
 
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    if environment.OLLAMA_AQUECER_NA_INICIALIZACAO:
+        # Sem aquecimento, a primeira pergunta espera a carga do modelo no Ollama (vários segundos)
+        print(f'Carregando o modelo {environment.MODELO_LLAMA} no Ollama (modo {environment.MODO_OLLAMA})...')
+        try:
+            await gerador_de_respostas.interface_ollama.aquecer()
+        except Exception as erro:
+            print(f'AVISO: não foi possível aquecer o modelo no Ollama ({erro})')
+    yield
+    # Encerrando o pool de conexões com o Ollama
+    await gerador_de_respostas.interface_ollama.fechar()
+    if gerador_de_respostas.loteador_embeddings:
+        await gerador_de_respostas.loteador_embeddings.fechar()
+    if sessoes: sessoes.fechar()
+    if cliente_servidor_modelos: cliente_servidor_modelos.fechar()
+    # Persistindo o cache de embeddings, para que sobreviva a reinicializações
+    if cache_embeddings and cache_embeddings.url_arquivo:
+        print(f'Salvando cache de embeddings em {cache_embeddings.url_arquivo}...')
+        cache_embeddings.salvar()
+
 print('Instanciando a api (FastAPI)...')
-app = FastAPI()
+app = FastAPI(lifespan=ciclo_de_vida)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=['*'],  # Allow all origins
@@ -19,43 +49,145 @@ app.add_middleware(
 )
 
 print(f'Criando GeradorDeRespostas (usando {environment.MODELO_DE_EMBEDDINGS} - device={environment.DEVICE})...')
-funcao_de_embeddings = FuncaoEmbeddings(nome_modelo=environment.MODELO_DE_EMBEDDINGS, tipo_modelo=SentenceTransformer, device=environment.DEVICE)
-gerador_de_respostas = GeradorDeRespostas(funcao_de_embeddings=funcao_de_embeddings, url_banco_vetores=environment.URL_BANCO_VETORES, device=environment.DEVICE)
+cache_embeddings = CacheEmbeddings(
+    tamanho_maximo=environment.CACHE_EMBEDDINGS_TAMANHO,
+    ttl=environment.CACHE_EMBEDDINGS_TTL,
+    url_arquivo=environment.URL_CACHE_EMBEDDINGS) if environment.CACHE_EMBEDDINGS_TAMANHO > 0 else None
+cliente_servidor_modelos = None
+reranker_bert = None
+if environment.URL_SERVIDOR_MODELOS:
+    # Modelos hospedados no servidor de modelos (python -m api.utils.servidor_modelos), compartilhado pelos workers
+    print(f'Usando o servidor de modelos em {environment.URL_SERVIDOR_MODELOS}...')
+    cliente_servidor_modelos = ClienteServidorModelos(environment.URL_SERVIDOR_MODELOS, timeout=environment.SERVIDOR_MODELOS_TIMEOUT)
+    funcao_de_embeddings = FuncaoEmbeddingsRemota(cliente_servidor_modelos, nome_modelo=environment.MODELO_DE_EMBEDDINGS, cache=cache_embeddings)
+    reranker_bert = RerankerBertRemoto(cliente_servidor_modelos)
+else:
+    funcao_de_embeddings = FuncaoEmbeddings(nome_modelo=environment.MODELO_DE_EMBEDDINGS, tipo_modelo=SentenceTransformer, device=environment.DEVICE, cache=cache_embeddings, backend_inferencia=environment.BACKEND_INFERENCIA_EMBEDDINGS)
+cache_respostas = CacheRespostas(
+    tamanho_maximo=environment.CACHE_RESPOSTAS_TAMANHO,
+    limiar_similaridade=environment.CACHE_RESPOSTAS_LIMIAR_SIMILARIDADE,
+    ttl=environment.CACHE_RESPOSTAS_TTL) if environment.CACHE_RESPOSTAS_TAMANHO > 0 else None
+sessoes = RepositorioSessoes(
+    tamanho_maximo=environment.SESSOES_TAMANHO,
+    ttl=environment.SESSOES_TTL,
+    url_sqlite=environment.URL_SESSOES_SQLITE) if environment.SESSOES_TAMANHO > 0 else None
+controlador_admissao = ControladorAdmissao(
+    max_concorrentes=environment.ADMISSAO_MAX_CONCORRENTES,
+    tamanho_max_fila=environment.ADMISSAO_TAMANHO_MAX_FILA,
+    tempo_max_fila=environment.ADMISSAO_TEMPO_MAX_FILA)
+gerador_de_respostas = GeradorDeRespostas(funcao_de_embeddings=funcao_de_embeddings, url_banco_vetores=environment.URL_BANCO_VETORES, device=environment.DEVICE, cache_respostas=cache_respostas, sessoes=sessoes, reranker_bert=reranker_bert, controlador_admissao=controlador_admissao)
+
+pagina_chat_renderizada = PaginaPreRenderizada('web/chat.html', environment.TAGS_SUBSTITUICAO_HTML)
+
+class RespostaStream(StreamingResponse):
+    '''
+    StreamingResponse que fecha o iterador da resposta ao terminar, inclusive quando o cliente desconecta
+    (http.disconnect): o Starlette apenas cancela o envio, e o fechamento interrompe a geração do Llama e
+    devolve a vaga de admissão imediatamente.
+    '''
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+async def instrumentar(gerador_resposta):
+    # Requisições em andamento e consultas interrompidas por exceção, para /metrics
+    metricas.requisicoes_em_andamento.incrementar()
+    try:
+        async with aclosing(gerador_resposta):
+            async for fragmento in gerador_resposta:
+                yield fragmento
+    except Exception:
+        metricas.erros.incrementar('consulta')
+        raise
+    finally:
+        metricas.requisicoes_em_andamento.decrementar()
+
+def verificar_admissao(endpoint: str):
+    # Recusa imediata (429/503 com Retry-After), antes de qualquer recuperação, quando não haveria vaga de geração
+    metricas.requisicoes.incrementar(endpoint)
+    try:
+        controlador_admissao.verificar_entrada()
+    except RejeicaoAdmissao as rejeicao:
+        metricas.rejeicoes.incrementar(str(rejeicao.status_code))
+        return JSONResponse(
+            {'detail': rejeicao.motivo},
+            status_code=rejeicao.status_code,
+            headers={'Retry-After': str(rejeicao.retry_after)})
+    return None
+
+def responder_stream(gerador_resposta, media_type: str):
+    # A vaga de admissão é obtida pelo gerador de respostas apenas para a geração do Llama; se a fila encher
+    # depois da verificação de entrada, a recusa chega ao cliente como evento 'erro' (etapa 'admissao')
+    return RespostaStream(instrumentar(gerador_resposta), media_type=media_type)
+
+# Medidores lidos no momento da coleta
+metricas.registrar_medidor('rag_fila_executor', 'Tarefas aguardando no ThreadPoolExecutor (embeddings, busca, Bert)',
+                           lambda: gerador_de_respostas.executor._work_queue.qsize())
+metricas.registrar_medidor('rag_admissao_em_execucao', 'Gerações admitidas em execução', lambda: controlador_admissao.em_execucao)
+metricas.registrar_medidor('rag_admissao_fila', 'Requisições aguardando admissão', lambda: len(controlador_admissao.fila))
+if gerador_de_respostas.loteador_embeddings:
+    metricas.registrar_medidor('rag_fila_loteador_embeddings', 'Perguntas aguardando o próximo lote de embeddings',
+                               lambda: gerador_de_respostas.loteador_embeddings.estatisticas()['tamanho_fila'])
+if cache_embeddings:
+    metricas.registrar_medidor('rag_cache_embeddings_acertos_total', 'Embeddings de perguntas servidos pelo cache',
+                               lambda: cache_embeddings.acertos, tipo='counter')
 
 print('Definindo as rotas')
 
 @app.post('/chat/enviar_pergunta/')
 async def gerar_resposta(dadosRecebidos: DadosChat):
-    return StreamingResponse(gerador_de_respostas.consultar(dadosRecebidos), media_type='text/plain')
+    recusa = verificar_admissao('enviar_pergunta')
+    if recusa: return recusa
+    return responder_stream(gerador_de_respostas.consultar(dadosRecebidos), media_type='text/plain')
 
+@app.post('/chat/enviar_pergunta/eventos/')
+async def gerar_resposta_eventos(dadosRecebidos: DadosChat):
+    recusa = verificar_admissao('eventos')
+    if recusa: return recusa
+    # Eventos tipados em NDJSON (documentos, token, scores, fim_texto, tempos, fim), com tokens agrupados
+    eventos = agrupar_tokens(
+        gerador_de_respostas.consultar_eventos(dadosRecebidos),
+        tamanho_max=environment.EVENTOS_TAMANHO_MAX_AGRUPAMENTO,
+        intervalo_max_ms=environment.EVENTOS_INTERVALO_MAX_AGRUPAMENTO_MS)
+    return responder_stream(serializar_ndjson(eventos), media_type='application/x-ndjson')
 
-@app.get('/chat/')
-async def pagina_chat():
-    with open('web/chat.html', 'r', encoding='utf-8') as arquivo: conteudo_html = arquivo.read()
-    # substituindo as tags dentro do HTML, para maior controle
-    for tag, valor in environment.TAGS_SUBSTITUICAO_HTML.items():
-        conteudo_html = conteudo_html.replace(tag, valor)
-    return HTMLResponse(content=conteudo_html, status_code=200)
+@app.get('/chat/estatisticas_admissao/')
+async def estatisticas_admissao():
+    return {**controlador_admissao.estatisticas(), 'prazos_excedidos': gerador_de_respostas.qtd_prazos_excedidos}
 
-@app.get('/web/img/favicon/favicon.ico')
-async def favicon(): return FileResponse('web/img/favicon/favicon.ico')
 
-@app.get('/web/img/favicon/favicon.svg')
-async def favicon(): return FileResponse('web/img/favicon/favicon.svg')
+@app.get('/chat/estatisticas_cache/')
+async def estatisticas_cache():
+    return {
+        'embeddings': cache_embeddings.estatisticas() if cache_embeddings else None,
+        'respostas': cache_respostas.estatisticas() if cache_respostas else None,
+        # Com SQLite, a contagem das sessões é uma consulta ao banco, feita fora do loop de eventos
+        'sessoes': await asyncio.get_running_loop().run_in_executor(gerador_de_respostas.executor, sessoes.estatisticas) if sessoes else None
+    }
 
-@app.get('/web/img/favicon/favicon-48x48.png')
-async def favicon(): return FileResponse('web/img/favicon/favicon-48x48.png')
+@app.get('/chat/estatisticas_embeddings/')
+async def estatisticas_embeddings():
+    loteador_embeddings = gerador_de_respostas.loteador_embeddings
+    return loteador_embeddings.estatisticas() if loteador_embeddings else None
 
-@app.get('/web/img/favicon/apple-touch-icon.png')
-async def favicon(): return FileResponse('web/img/favicon/apple-touch-icon.png')
+@app.get('/chat/estatisticas_servidor_modelos/')
+async def estatisticas_servidor_modelos():
+    if not cliente_servidor_modelos: return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(gerador_de_respostas.executor, cliente_servidor_modelos.requisitar, 'estatisticas')
 
-@app.get('/web/img/favicon/site.webmanifest')
-async def favicon(): return FileResponse('web/img/favicon/site.webmanifest')
+@app.get('/metrics')
+async def exportar_metricas():
+    return PlainTextResponse(metricas.gerar_texto(), media_type='text/plain; version=0.0.4; charset=utf-8')
 
-@app.get('/web/img/Assistente.png')
-async def legisberto(): return FileResponse('web/img/Assistente.png')
+@app.get('/chat/')
+async def pagina_chat(request: Request):
+    # HTML renderizado na inicialização (e quando o arquivo muda), com ETag/Last-Modified e variantes comprimidas
+    return pagina_chat_renderizada.responder(request)
 
-@app.get('/web/img/logo_al.png')
-async def legisberto(): return FileResponse('web/img/logo_al.png')
+# Imagens e favicons, com cache imutável quando referenciados com ?v=<hash> pela página do chat
+app.mount('/web/img', ArquivosEstaticosImutaveis(directory='web/img'), name='web_img')
 
 print('API inicializada')
\ No newline at end of file
@@ -1,11 +1,16 @@
+import argparse
+import hashlib
 import os
-import sys
 from ..environment.environment import environment
+from ..utils.indice_lexical import IndiceBM25, obter_url_indice_bm25
+from ..utils.indice_numpy import IndiceVetoresNumpy, obter_url_indice
 from ..utils.utils import FuncaoEmbeddings
 from torch import cuda
 
 from sentence_transformers import SentenceTransformer
 from chromadb import chromadb
+from chromadb.errors import InvalidCollectionException
+from time import time
 
 URL_LOCAL = os.path.abspath(os.path.join(os.path.dirname(__file__), "./"))
 EMBEDDING_INSTRUCTOR="hkunlp/instructor-xl"
@@ -14,19 +19,25 @@ DEVICE='cuda' if cuda.is_available() else 'cpu'
 # Valores padrão, geralmente não usados
 NOME_BANCO_VETORES=os.path.join(URL_LOCAL,"bancos_vetores/banco_teste_default")
 NOME_COLECAO='colecao_teste_default'
-COMPRIMENTO_MAX_FRAGMENTO = 300    
+COMPRIMENTO_MAX_FRAGMENTO = 300
+
+# Quantidade de fragmentos por forward pass do modelo de embeddings
+TAMANHO_LOTE_EMBEDDINGS = 32
+# Quantidade de fragmentos por escrita no ChromaDB (limitada ao máximo aceito pelo ChromaDB)
+TAMANHO_LOTE_INSERCAO = 1024
 
 class GeradorBancoVetores:
-    def run(self,
-            nome_banco_vetores=NOME_BANCO_VETORES,
-            nome_colecao=NOME_COLECAO,
-            comprimento_max_fragmento=COMPRIMENTO_MAX_FRAGMENTO,
-            instrucao=None):
+    def calcular_hash_fragmento(self, documento_origem, texto):
+        return hashlib.sha256(f'{documento_origem}\n{texto}'.encode('utf-8')).hexdigest()
+
+    def fragmentar_documentos(self,
+                              documentos_fonte=environment.DOCUMENTOS,
+                              comprimento_max_fragmento=COMPRIMENTO_MAX_FRAGMENTO):
         documentos = []
         titulos = []
         id=1
 
-        for k, v in environment.DOCUMENTOS.items():
+        for k, v in documentos_fonte.items():
             URL_DADOS = os.path.join(URL_LOCAL, v['url'])
             print(f'''Lendo o arquivo {URL_DADOS}...''')
             with open(URL_DADOS, 'r', encoding='UTF-8') as arq:
@@ -80,10 +91,45 @@ class GeradorBancoVetores:
                         'subtitulo': f'Art. {tit} - {titulos.count(tit)}',
                         'autor': f'{v["autor"]}',
                         'fonte': f'{v["fonte"]}',
+                        # Impressão digital do fragmento, usada na reindexação incremental
+                        'documento_origem': k,
+                        'hash_conteudo': self.calcular_hash_fragmento(k, artigo),
                     },
                 }
                 documentos.append(doc)
                 id += 1
+        return documentos
+
+    def incluir_documentos(self, collection, funcao_de_embeddings, documentos, tamanho_lote_insercao=TAMANHO_LOTE_INSERCAO):
+        # Os embeddings são gerados em lotes pela função de embeddings e gravados com uma única chamada
+        # a collection.upsert por lote, em vez de um forward pass e uma escrita por fragmento
+        qtd_docs = len(documentos)
+        marcador_tempo_inicio = time()
+        for inicio in range(0, qtd_docs, tamanho_lote_insercao):
+            lote = documentos[inicio:inicio + tamanho_lote_insercao]
+            textos = [doc['page_content'] for doc in lote]
+            collection.upsert(
+                documents=textos,
+                embeddings=funcao_de_embeddings(textos),
+                ids=[str(doc['id']) for doc in lote],
+                metadatas=[doc['metadata'] for doc in lote],
+            )
+            qtd_incluidos = inicio + len(lote)
+            tempo_decorrido = time() - marcador_tempo_inicio
+            print(f'\r>>> Incluídos {qtd_incluidos} de {qtd_docs} documentos ({qtd_incluidos / tempo_decorrido:.2f} fragmentos/s)', end='')
+        tempo_total = time() - marcador_tempo_inicio
+        print(f'\n>>> {qtd_docs} documentos incluídos em {tempo_total:.2f} segundos ({qtd_docs / tempo_total if tempo_total else 0:.2f} fragmentos/s)')
+
+    def run(self,
+            nome_banco_vetores=NOME_BANCO_VETORES,
+            nome_colecao=NOME_COLECAO,
+            comprimento_max_fragmento=COMPRIMENTO_MAX_FRAGMENTO,
+            instrucao=None,
+            documentos_fonte=environment.DOCUMENTOS,
+            tamanho_lote_embeddings=TAMANHO_LOTE_EMBEDDINGS,
+            tamanho_lote_insercao=TAMANHO_LOTE_INSERCAO,
+            tipo_dados_indice_numpy=None):
+        documentos = self.fragmentar_documentos(documentos_fonte, comprimento_max_fragmento)
 
         # Utilizando o ChromaDb diretamente
         client = chromadb.PersistentClient(path=nome_banco_vetores)
@@ -91,18 +137,20 @@ class GeradorBancoVetores:
             nome_modelo=EMBEDDING_INSTRUCTOR,
             tipo_modelo=SentenceTransformer,
             device=DEVICE,
-            instrucao=instrucao)
-        collection = client.create_collection(name=nome_colecao, embedding_function=funcao_de_embeddings_sentence_tranformer, metadata={'hnsw:space': 'cosine'})
+            instrucao=instrucao,
+            tamanho_lote=tamanho_lote_embeddings)
+        collection = client.create_collection(
+            name=nome_colecao,
+            embedding_function=funcao_de_embeddings_sentence_tranformer,
+            metadata=self.gerar_metadados_colecao(instrucao, comprimento_max_fragmento))
         print(f'Gerando >>> Banco {nome_banco_vetores} - Coleção {nome_colecao} - Instrução: {instrucao}')
-        qtd_docs = len(documentos)
-        for idx in range(qtd_docs):
-            print(f'\r>>> Incluindo documento {idx+1} de {qtd_docs}', end='')
-            doc = documentos[idx]
-            collection.add(
-                documents=[doc['page_content']],
-                ids=[str(doc['id'])],
-                metadatas=[doc['metadata']],
-            )
+        self.incluir_documentos(
+            collection,
+            funcao_de_embeddings_sentence_tranformer,
+            documentos,
+            tamanho_lote_insercao=min(tamanho_lote_insercao, client.get_max_batch_size()))
+        self.gerar_indice_bm25(collection, nome_banco_vetores, nome_colecao)
+        if tipo_dados_indice_numpy: self.exportar_indice_numpy(collection, nome_banco_vetores, nome_colecao, tipo_dados_indice_numpy)
         client._system.stop()
 
         #query_result = collection.query(query_texts=["O que é uma legislatura?"], n_results=5)
@@ -110,24 +158,135 @@ class GeradorBancoVetores:
 
         # client.get_collection(name='legisberto', embedding_function=funcao_de_embeddings_sentence_tranformer)
 
-if __name__ == "__main__":   
+    def gerar_indice_bm25(self, collection, nome_banco_vetores, nome_colecao):
+        # O índice lexical é barato e sempre gerado sobre os mesmos fragmentos da coleção
+        url_indice = obter_url_indice_bm25(nome_banco_vetores, nome_colecao)
+        indice = IndiceBM25.gerar_de_colecao(collection, url_indice)
+        print(f'>>> Índice BM25 com {len(indice.ids)} fragmentos salvo em {url_indice}')
+
+    def exportar_indice_numpy(self, collection, nome_banco_vetores, nome_colecao, tipo_dados):
+        url_indice = obter_url_indice(nome_banco_vetores, nome_colecao)
+        qtd_registros = IndiceVetoresNumpy.exportar_de_colecao(collection, url_indice, tipo_dados)
+        print(f'>>> Índice NumPy ({tipo_dados}) com {qtd_registros} registros exportado para {url_indice}')
+
+    def gerar_metadados_colecao(self, instrucao, comprimento_max_fragmento):
+        # O ChromaDB não aceita None como valor de metadado
+        return {'hnsw:space': 'cosine', 'instrucao': instrucao or '', 'comprimento_max_fragmento': comprimento_max_fragmento}
+
+    def atualizar(self,
+                  nome_banco_vetores=NOME_BANCO_VETORES,
+                  nome_colecao=NOME_COLECAO,
+                  comprimento_max_fragmento=COMPRIMENTO_MAX_FRAGMENTO,
+                  instrucao=None,
+                  documentos_fonte=environment.DOCUMENTOS,
+                  tamanho_lote_embeddings=TAMANHO_LOTE_EMBEDDINGS,
+                  tamanho_lote_insercao=TAMANHO_LOTE_INSERCAO,
+                  tipo_dados_indice_numpy=None):
+        '''
+        Reindexação incremental: somente fragmentos novos ou alterados passam pelo modelo de embeddings.
+        Fragmentos que deixaram de existir são removidos e os que só mudaram de metadados são atualizados.
+        '''
+        documentos = self.fragmentar_documentos(documentos_fonte, comprimento_max_fragmento)
+
+        client = chromadb.PersistentClient(path=nome_banco_vetores)
+        funcao_de_embeddings_sentence_tranformer = FuncaoEmbeddings(
+            nome_modelo=EMBEDDING_INSTRUCTOR,
+            tipo_modelo=SentenceTransformer,
+            device=DEVICE,
+            instrucao=instrucao,
+            tamanho_lote=tamanho_lote_embeddings)
+        try:
+            collection = client.get_collection(name=nome_colecao, embedding_function=funcao_de_embeddings_sentence_tranformer)
+        except (ValueError, InvalidCollectionException):
+            print(f'Coleção {nome_colecao} inexistente: todos os fragmentos serão incluídos')
+            collection = client.create_collection(
+                name=nome_colecao,
+                embedding_function=funcao_de_embeddings_sentence_tranformer,
+                metadata=self.gerar_metadados_colecao(instrucao, comprimento_max_fragmento))
+
+        # Embeddings gerados com outra instrução ou fragmentação não são comparáveis aos novos
+        metadados_colecao = collection.metadata or {}
+        for chave, valor in self.gerar_metadados_colecao(instrucao, comprimento_max_fragmento).items():
+            if chave in metadados_colecao and metadados_colecao[chave] != valor:
+                raise ValueError(f'A coleção {nome_colecao} foi gerada com {chave}={metadados_colecao[chave]!r}, mas foi solicitado {valor!r}. Gere a coleção novamente.')
+
+        print(f'Atualizando >>> Banco {nome_banco_vetores} - Coleção {nome_colecao} - Instrução: {instrucao}')
+        registros = collection.get(include=['documents', 'metadatas'])
+
+        # Coleções geradas antes da inclusão das impressões digitais têm o hash calculado a partir do texto armazenado
+        origem_por_titulo = {v['titulo']: k for k, v in environment.DOCUMENTOS.items()}
+        origem_por_titulo.update({v['titulo']: k for k, v in environment.DOCUMENTOS_CONSTITUICOES.items()})
+        ids_existentes_por_hash = {}
+        metadados_existentes = {}
+        for id_registro, texto, metadados in zip(registros['ids'], registros['documents'], registros['metadatas']):
+            hash_conteudo = metadados.get('hash_conteudo')
+            if not hash_conteudo:
+                documento_origem = metadados.get('documento_origem') or origem_por_titulo.get(metadados.get('titulo'), metadados.get('titulo'))
+                hash_conteudo = self.calcular_hash_fragmento(documento_origem, texto)
+            ids_existentes_por_hash.setdefault(hash_conteudo, []).append(id_registro)
+            metadados_existentes[id_registro] = metadados
+
+        novos = []
+        metadados_alterados = []
+        qtd_inalterados = 0
+        for doc in documentos:
+            ids_existentes = ids_existentes_por_hash.get(doc['metadata']['hash_conteudo'])
+            if ids_existentes:
+                # Fragmentos com texto repetido na mesma fonte consomem um registro existente cada
+                doc['id'] = ids_existentes.pop(0)
+                if metadados_existentes[doc['id']] != doc['metadata']: metadados_alterados.append(doc)
+                else: qtd_inalterados += 1
+            else:
+                novos.append(doc)
+        ids_removidos = [id_registro for ids in ids_existentes_por_hash.values() for id_registro in ids]
+
+        # Novos fragmentos recebem ids numéricos a partir do maior id existente, como na geração completa
+        proximo_id = max([int(id_registro) for id_registro in registros['ids'] if id_registro.isdigit()], default=0) + 1
+        for doc in novos:
+            doc['id'] = proximo_id
+            proximo_id += 1
+
+        print(f'Diferenças: {len(novos)} novos, {len(metadados_alterados)} com metadados alterados, '
+              f'{len(ids_removidos)} removidos, {qtd_inalterados} inalterados')
+
+        tamanho_lote_insercao = min(tamanho_lote_insercao, client.get_max_batch_size())
+        for inicio in range(0, len(ids_removidos), tamanho_lote_insercao):
+            collection.delete(ids=ids_removidos[inicio:inicio + tamanho_lote_insercao])
+        for inicio in range(0, len(metadados_alterados), tamanho_lote_insercao):
+            lote = metadados_alterados[inicio:inicio + tamanho_lote_insercao]
+            # Somente os metadados mudam: o embedding existente é mantido
+            collection.update(ids=[str(doc['id']) for doc in lote], metadatas=[doc['metadata'] for doc in lote])
+        if novos:
+            self.incluir_documentos(collection, funcao_de_embeddings_sentence_tranformer, novos, tamanho_lote_insercao=tamanho_lote_insercao)
+        self.gerar_indice_bm25(collection, nome_banco_vetores, nome_colecao)
+        if tipo_dados_indice_numpy: self.exportar_indice_numpy(collection, nome_banco_vetores, nome_colecao, tipo_dados_indice_numpy)
+        client._system.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gera um banco de vetores a partir dos documentos configurados no environment")
+
+    parser.add_argument('nome_banco_vetores', type=str, help="nome do banco de vetores (pasta em conteudo/bancos_vetores)")
+    parser.add_argument('nome_colecao', type=str, help="nome da coleção a ser criada")
+    parser.add_argument('comprimento_max_fragmento', type=int, help="quantidade máxima de palavras por fragmento")
+    parser.add_argument('instrucao', type=str, nargs='?', default=None, help="instrução a ser utilizada na função de embeddings")
+    parser.add_argument('--tamanho_lote_embeddings', type=int, default=TAMANHO_LOTE_EMBEDDINGS, help="fragmentos por forward pass do modelo de embeddings")
+    parser.add_argument('--tamanho_lote_insercao', type=int, default=TAMANHO_LOTE_INSERCAO, help="fragmentos por escrita no ChromaDB")
+    parser.add_argument('--incluir_constituicoes', action='store_true', help="inclui as constituições federal e estadual na coleção")
+    parser.add_argument('--exportar_indice_numpy', type=str, choices=['float32', 'float16'], help="exporta também o índice NumPy em memória mapeada, com o tipo de dados informado")
+    parser.add_argument('--incremental', action='store_true', help="atualiza uma coleção existente, gerando embeddings só para fragmentos novos ou alterados")
+
+    args = parser.parse_args()
+    documentos_fonte = dict(environment.DOCUMENTOS)
+    if args.incluir_constituicoes: documentos_fonte.update(environment.DOCUMENTOS_CONSTITUICOES)
+
     gerador_banco_vetores = GeradorBancoVetores()
-    
-    nome_banco_vetores=os.path.join(URL_LOCAL,"bancos_vetores/" + sys.argv[1])
-    nome_colecao=sys.argv[2]
-    comprimento_max_fragmento = int(sys.argv[3])
-    try:
-        instrucao = sys.argv[4]
-        gerador_banco_vetores.run(
-            nome_banco_vetores=nome_banco_vetores,
-            nome_colecao=nome_colecao,
-            comprimento_max_fragmento=comprimento_max_fragmento,
-            instrucao=instrucao)
-    except:
-        gerador_banco_vetores.run(
-            nome_banco_vetores=nome_banco_vetores,
-            nome_colecao=nome_colecao,
-            comprimento_max_fragmento=comprimento_max_fragmento,
-            instrucao=None)
-    
-    
+    metodo = gerador_banco_vetores.atualizar if args.incremental else gerador_banco_vetores.run
+    metodo(
+        nome_banco_vetores=os.path.join(URL_LOCAL, "bancos_vetores/" + args.nome_banco_vetores),
+        nome_colecao=args.nome_colecao,
+        comprimento_max_fragmento=args.comprimento_max_fragmento,
+        instrucao=args.instrucao,
+        documentos_fonte=documentos_fonte,
+        tamanho_lote_embeddings=args.tamanho_lote_embeddings,
+        tamanho_lote_insercao=args.tamanho_lote_insercao,
+        tipo_dados_indice_numpy=args.exportar_indice_numpy)
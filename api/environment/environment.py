@@ -22,8 +22,88 @@ class Environment:
         self.MODELO_LLAMA=os.getenv('MODELO_LLAMA')
         self.DEVICE=os.getenv('DEVICE') # ['cpu', cuda']
         self.NUM_DOCUMENTOS_RETORNADOS=int(os.getenv('NUM_DOCUMENTOS_RETORNADOS'))
+        # Logs (print) de cada etapa das consultas; desativar em produção, pois ficam no caminho crítico
+        self.LOG_CONSULTAS=os.getenv('LOG_CONSULTAS', 'True').lower() == 'true'
+        # Calcula os scores do Bert enquanto a resposta do Llama é transmitida
+        self.PARALELIZAR_BERT_LLAMA=os.getenv('PARALELIZAR_BERT_LLAMA', 'True').lower() == 'true'
+
+        # Cache de embeddings das consultas (tamanho 0 desativa; TTL em segundos; arquivo opcional para persistência)
+        self.CACHE_EMBEDDINGS_TAMANHO=int(os.getenv('CACHE_EMBEDDINGS_TAMANHO', 10000))
+        self.CACHE_EMBEDDINGS_TTL=float(os.getenv('CACHE_EMBEDDINGS_TTL', 7 * 24 * 3600))
+        self.URL_CACHE_EMBEDDINGS=os.getenv('URL_CACHE_EMBEDDINGS') or None
+        # Cache semântico de respostas completas (desativado por padrão; tamanho 0 desativa; TTL em segundos).
+        # Perguntas sobre dispositivos vizinhos ("Art. 57" e "Art. 58") podem superar o limiar de similaridade
+        self.CACHE_RESPOSTAS_TAMANHO=int(os.getenv('CACHE_RESPOSTAS_TAMANHO', 0))
+        self.CACHE_RESPOSTAS_LIMIAR_SIMILARIDADE=float(os.getenv('CACHE_RESPOSTAS_LIMIAR_SIMILARIDADE', 0.97))
+        self.CACHE_RESPOSTAS_TTL=float(os.getenv('CACHE_RESPOSTAS_TTL', 24 * 3600))
+
+        # Sessões de conversa no servidor (tamanho 0 desativa; TTL em segundos; SQLite opcional para persistência)
+        self.SESSOES_TAMANHO=int(os.getenv('SESSOES_TAMANHO', 10000))
+        self.SESSOES_TTL=float(os.getenv('SESSOES_TTL', 24 * 3600))
+        self.URL_SESSOES_SQLITE=os.getenv('URL_SESSOES_SQLITE') or None
+
+        # Controle de admissão das gerações no Ollama (tempos em segundos; prazos vazios ou 0 desativam)
+        self.ADMISSAO_MAX_CONCORRENTES=int(os.getenv('ADMISSAO_MAX_CONCORRENTES', 4))
+        self.ADMISSAO_TAMANHO_MAX_FILA=int(os.getenv('ADMISSAO_TAMANHO_MAX_FILA', 16))
+        self.ADMISSAO_TEMPO_MAX_FILA=float(os.getenv('ADMISSAO_TEMPO_MAX_FILA', 30))
+        self.PRAZO_PRIMEIRO_TOKEN=float(os.getenv('PRAZO_PRIMEIRO_TOKEN') or 0) or None
+        self.PRAZO_GERACAO_LLAMA=float(os.getenv('PRAZO_GERACAO_LLAMA') or 0) or None
+
+        # Agrupamento dos tokens no endpoint de eventos (tamanho em caracteres; intervalo em milissegundos)
+        self.EVENTOS_TAMANHO_MAX_AGRUPAMENTO=int(os.getenv('EVENTOS_TAMANHO_MAX_AGRUPAMENTO', 64))
+        self.EVENTOS_INTERVALO_MAX_AGRUPAMENTO_MS=float(os.getenv('EVENTOS_INTERVALO_MAX_AGRUPAMENTO_MS', 50))
+
+        # Conexões HTTP com o Ollama (pool persistente; tempos em segundos)
+        self.OLLAMA_MAX_CONEXOES=int(os.getenv('OLLAMA_MAX_CONEXOES', 20))
+        self.OLLAMA_MAX_CONEXOES_KEEPALIVE=int(os.getenv('OLLAMA_MAX_CONEXOES_KEEPALIVE', 10))
+        self.OLLAMA_TEMPO_KEEPALIVE=float(os.getenv('OLLAMA_TEMPO_KEEPALIVE', 60))
+        self.OLLAMA_TIMEOUT_CONEXAO=float(os.getenv('OLLAMA_TIMEOUT_CONEXAO', 5))
+        self.OLLAMA_TIMEOUT_LEITURA=float(os.getenv('OLLAMA_TIMEOUT_LEITURA', 120))
+        # Modo de geração: 'generate' (prompt [INST] em /api/generate) ou 'chat' (/api/chat com prefixo de sistema fixo)
+        self.MODO_OLLAMA=os.getenv('MODO_OLLAMA', 'generate')
+        # Tempo que o modelo fica carregado no Ollama entre requisições ('30m', segundos ou -1 para nunca descarregar;
+        # vazio usa o padrão do Ollama). -1 mantém o modelo ocupando a memória da GPU mesmo sem uso
+        keep_alive = os.getenv('OLLAMA_KEEP_ALIVE', '')
+        self.OLLAMA_KEEP_ALIVE=int(keep_alive) if keep_alive.lstrip('-').isdigit() else (keep_alive or None)
+        # Carrega o modelo na inicialização da API, para que a primeira pergunta não pague a carga (opcional)
+        self.OLLAMA_AQUECER_NA_INICIALIZACAO=os.getenv('OLLAMA_AQUECER_NA_INICIALIZACAO', 'False').lower() == 'true'
+        # No modo chat, mensagens anteriores mantidas como contexto da conversa (0 mantém todas)
+        self.MAX_MENSAGENS_HISTORICO=int(os.getenv('MAX_MENSAGENS_HISTORICO', 20))
+
+        # Agrupamento em lotes dos embeddings de perguntas concorrentes (opcional; espera máxima em milissegundos)
+        self.LOTEADOR_EMBEDDINGS=os.getenv('LOTEADOR_EMBEDDINGS', 'False').lower() == 'true'
+        self.LOTEADOR_TEMPO_MAX_ESPERA_MS=float(os.getenv('LOTEADOR_TEMPO_MAX_ESPERA_MS', 5))
+        self.LOTEADOR_TAMANHO_MAX_LOTE=int(os.getenv('LOTEADOR_TAMANHO_MAX_LOTE', 32))
 
         self.MODELO_DE_EMBEDDINGS = self.EMBEDDING_INSTRUCTOR
+        # Backend de inferência em CPU dos modelos de embeddings e do Bert: 'torch', 'int8' ou 'onnx'
+        # (o Bert em ONNX usa o modelo exportado com api.utils.inferencia_otimizada). Para os embeddings, 'int8' e
+        # 'onnx' são experimentais: confira com api.testes.verificar_backend_inferencia se a recuperação se mantém
+        self.BACKEND_INFERENCIA_EMBEDDINGS=os.getenv('BACKEND_INFERENCIA_EMBEDDINGS', 'torch')
+        self.BACKEND_INFERENCIA_BERT=os.getenv('BACKEND_INFERENCIA_BERT', 'torch')
+        self.URL_MODELO_BERT_ONNX=os.getenv('URL_MODELO_BERT_ONNX', 'api/conteudo/modelos_onnx/bert_qa_int8.onnx')
+        # Seleção dos documentos do prompt do Llama: relevância = (1 - PESO_BERT_RELEVANCIA) * score_distancia
+        # + PESO_BERT_RELEVANCIA * score do Bert; limiar e orçamento de tokens (0 desativa cada limite)
+        self.MONTADOR_PROMPT=os.getenv('MONTADOR_PROMPT', 'False').lower() == 'true'
+        self.ORCAMENTO_TOKENS_PROMPT=int(os.getenv('ORCAMENTO_TOKENS_PROMPT', 2048))
+        self.JANELA_CONTEXTO_LLAMA=int(os.getenv('JANELA_CONTEXTO_LLAMA', 8192))
+        self.RESERVA_TOKENS_RESPOSTA=int(os.getenv('RESERVA_TOKENS_RESPOSTA', 1024))
+        self.LIMIAR_RELEVANCIA_PROMPT=float(os.getenv('LIMIAR_RELEVANCIA_PROMPT', 0))
+        self.PESO_BERT_RELEVANCIA=float(os.getenv('PESO_BERT_RELEVANCIA', 0.5))
+        self.MIN_DOCUMENTOS_PROMPT=int(os.getenv('MIN_DOCUMENTOS_PROMPT', 1))
+        # Sem tokenizador (nome de um tokenizador do Hugging Face), os tokens são estimados por caracteres
+        self.CARACTERES_POR_TOKEN=float(os.getenv('CARACTERES_POR_TOKEN', 3.5))
+        self.TOKENIZADOR_PROMPT=os.getenv('TOKENIZADOR_PROMPT') or None
+        # Servidor de modelos compartilhado pelos workers (socket Unix ou host:porta); vazio carrega os modelos em cada worker
+        self.URL_SERVIDOR_MODELOS=os.getenv('URL_SERVIDOR_MODELOS') or None
+        self.SERVIDOR_MODELOS_TIMEOUT=float(os.getenv('SERVIDOR_MODELOS_TIMEOUT', 60))
+
+        # Backend de recuperação: 'chroma' ou 'numpy' (índice em memória mapeada exportado com api.utils.indice_numpy)
+        self.BACKEND_BANCO_VETORES=os.getenv('BACKEND_BANCO_VETORES', 'chroma')
+        # Busca híbrida: BM25 (índice gerado com api.utils.indice_lexical) + busca densa, fundidos por RRF
+        self.BUSCA_HIBRIDA=os.getenv('BUSCA_HIBRIDA', 'False').lower() == 'true'
+        self.NUM_CANDIDATOS_BUSCA_HIBRIDA=int(os.getenv('NUM_CANDIDATOS_BUSCA_HIBRIDA', 20))
+        self.K_RRF=int(os.getenv('K_RRF', 60))
 
         self.CONTEXTO_BASE = []
 
@@ -78,4 +158,32 @@ class Environment:
             }
         }
 
+        # Constituições, com volume maior de texto; indexadas à parte por GeradorBancoVetores (--incluir_constituicoes)
+        self.DOCUMENTOS_CONSTITUICOES = {
+            'constituicao_federal': {
+                'url': 'datasets/constituicao_federal.txt',
+                'titulo': 'Constituição da República Federativa do Brasil de 1988',
+                'autor': 'Assembleia Nacional Constituinte',
+                'fonte': 'https://www.planalto.gov.br/ccivil_03/constituicao/constituicao.htm'
+            },
+            'constituicao_federal_disp_trans': {
+                'url': 'datasets/constituicao_federal_disp_trans.txt',
+                'titulo': 'Constituição da República Federativa do Brasil de 1988 - Ato das Disposições Constitucionais Transitórias',
+                'autor': 'Assembleia Nacional Constituinte',
+                'fonte': 'https://www.planalto.gov.br/ccivil_03/constituicao/constituicao.htm'
+            },
+            'constituicao_rn': {
+                'url': 'datasets/constituicao_rn.txt',
+                'titulo': 'Constituição do Estado do Rio Grande do Norte',
+                'autor': 'Assembleia Legislativa do Rio Grande do Norte - ALERN',
+                'fonte': 'https://www.al.rn.leg.br'
+            },
+            'constituicao_rn_disp_trans': {
+                'url': 'datasets/constituicao_rn_disp_trans.txt',
+                'titulo': 'Constituição do Estado do Rio Grande do Norte - Ato das Disposições Constitucionais Transitórias',
+                'autor': 'Assembleia Legislativa do Rio Grande do Norte - ALERN',
+                'fonte': 'https://www.al.rn.leg.br'
+            }
+        }
+
 environment = Environment()
\ No newline at end of file
@@ -1,13 +1,21 @@
 import json
 import asyncio
-import torch
 
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
 from time import time
-from transformers import BertTokenizer, BertForQuestionAnswering, pipeline
-from typing import Callable, Generator
+from typing import Callable, Generator, List
 
 from api.environment.environment import environment
+from api.utils.admissao import ControladorAdmissao, PrazoExcedido, RejeicaoAdmissao, iterar_com_prazos
+from api.utils.cache import CacheRespostas
+from api.utils.indice_lexical import IndiceBM25, fundir_por_rrf, obter_url_indice_bm25
+from api.utils.indice_numpy import InterfaceIndiceNumpy
+from api.utils.loteador_embeddings import LoteadorEmbeddings
+from api.utils.metricas import metricas
+from api.utils.montador_prompt import MontadorPrompt
+from api.utils.reranker_bert import RerankerBert
+from api.utils.sessoes import RepositorioSessoes
 from api.utils.utils import InterfaceChroma, InterfaceOllama, DadosChat
     
 
@@ -21,31 +29,136 @@ class GeradorDeRespostas:
                 colecao_de_documentos:str=environment.NOME_COLECAO_DE_DOCUMENTOS,
                 funcao_de_embeddings:Callable=None,
                 fazer_log:bool=True,
-                device: str=None):
+                device: str=None,
+                paralelizar_bert_llama: bool=environment.PARALELIZAR_BERT_LLAMA,
+                cache_respostas: CacheRespostas=None,
+                sessoes: RepositorioSessoes=None,
+                backend_banco_vetores: str=environment.BACKEND_BANCO_VETORES,
+                busca_hibrida: bool=environment.BUSCA_HIBRIDA,
+                lotear_embeddings: bool=environment.LOTEADOR_EMBEDDINGS,
+                reranker_bert: RerankerBert=None,
+                montar_prompt: bool=environment.MONTADOR_PROMPT,
+                controlador_admissao: ControladorAdmissao=None):
 
         self.device = device
+        self.paralelizar_bert_llama = paralelizar_bert_llama
+        self.cache_respostas = cache_respostas
+        self.sessoes = sessoes
+        # Limita as gerações simultâneas no Ollama; a vaga é ocupada apenas durante a geração do Llama
+        self.controlador_admissao = controlador_admissao
+        self.qtd_prazos_excedidos = 0
         self.executor = ThreadPoolExecutor(max_workers=environment.THREADPOOL_MAX_WORKERS)
         
         if fazer_log: print(f'-- Gerador de respostas em inicialização (device={self.device})...')
 
-        self.interface_chromadb = InterfaceChroma(url_banco_vetores, colecao_de_documentos, funcao_de_embeddings, fazer_log)
+        # Ambas as interfaces seguem o mesmo contrato de consulta (formato de retorno do ChromaDB)
+        if backend_banco_vetores == 'numpy':
+            self.interface_banco_vetores = InterfaceIndiceNumpy(url_banco_vetores, colecao_de_documentos, funcao_de_embeddings, fazer_log)
+        else:
+            self.interface_banco_vetores = InterfaceChroma(url_banco_vetores, colecao_de_documentos, funcao_de_embeddings, fazer_log)
+
+        # Índice BM25 consultado em paralelo à busca densa, com fusão por reciprocal-rank fusion
+        self.indice_lexical = None
+        if busca_hibrida:
+            url_indice_bm25 = obter_url_indice_bm25(url_banco_vetores, colecao_de_documentos)
+            if fazer_log: print(f'--- carregando índice BM25 para busca híbrida (usando "{url_indice_bm25}")...')
+            self.indice_lexical = IndiceBM25.carregar(url_indice_bm25)
+
+        # Embeddings de perguntas de requisições concorrentes são gerados em lotes
+        self.loteador_embeddings = None
+        if lotear_embeddings:
+            self.loteador_embeddings = LoteadorEmbeddings(
+                self.interface_banco_vetores.funcao_de_embeddings,
+                self.executor,
+                tempo_max_espera_ms=environment.LOTEADOR_TEMPO_MAX_ESPERA_MS,
+                tamanho_max_lote=environment.LOTEADOR_TAMANHO_MAX_LOTE)
 
         # Carregando modelo e tokenizador pre-treinados
-        # optou-se por não usar pipeline, por ser mais lento que usar o modelo diretamente
-        if fazer_log: print(f'--- preparando modelo e tokenizador do Bert (usando {environment.EMBEDDING_SQUAD_PORTUGUESE})...')
-        self.modelo_bert_qa = BertForQuestionAnswering.from_pretrained(environment.EMBEDDING_SQUAD_PORTUGUESE).to(self.device)
-        self.tokenizador_bert = BertTokenizer.from_pretrained(environment.EMBEDDING_SQUAD_PORTUGUESE, device=self.device)
-        
-        self.modelo_bert_qa_pipeline = pipeline("question-answering", environment.EMBEDDING_SQUAD_PORTUGUESE, device=self.device)
+        # optou-se por não usar pipeline, por ser mais lento que usar o modelo diretamente; a resposta e o score
+        # equivalentes aos do pipeline são calculados pelo reranker com os mesmos logits
+        # (com o servidor de modelos, o reranker recebido é o cliente remoto, e nada é carregado aqui)
+        self.reranker_bert = reranker_bert
+        if not self.reranker_bert:
+            if fazer_log: print(f'--- preparando modelo e tokenizador do Bert (usando {environment.EMBEDDING_SQUAD_PORTUGUESE})...')
+            self.reranker_bert = RerankerBert(
+                environment.EMBEDDING_SQUAD_PORTUGUESE,
+                device=self.device,
+                backend=environment.BACKEND_INFERENCIA_BERT,
+                url_modelo_onnx=environment.URL_MODELO_BERT_ONNX)
 
         if fazer_log: print(f'--- preparando o Llama (usando {environment.MODELO_LLAMA})...')
-        self.interface_ollama = InterfaceOllama(url_llama=environment.URL_LLAMA, nome_modelo=environment.MODELO_LLAMA)
+        # OLLAMA_KEEP_ALIVE vale apenas para a API; os scripts de avaliação usam o padrão do Ollama
+        self.interface_ollama = InterfaceOllama(url_llama=environment.URL_LLAMA, nome_modelo=environment.MODELO_LLAMA, keep_alive=environment.OLLAMA_KEEP_ALIVE)
+
+        # Seleção dos documentos do prompt por relevância e orçamento de tokens (sem ela, todos os documentos entram)
+        self.montador_prompt = None
+        if montar_prompt:
+            parametros_montador = {
+                'orcamento_tokens': environment.ORCAMENTO_TOKENS_PROMPT,
+                'janela_contexto': environment.JANELA_CONTEXTO_LLAMA,
+                'reserva_tokens_resposta': environment.RESERVA_TOKENS_RESPOSTA,
+                'limiar_relevancia': environment.LIMIAR_RELEVANCIA_PROMPT,
+                'peso_bert': environment.PESO_BERT_RELEVANCIA,
+                'min_documentos': environment.MIN_DOCUMENTOS_PROMPT,
+                'caracteres_por_token': environment.CARACTERES_POR_TOKEN}
+            if environment.TOKENIZADOR_PROMPT:
+                if fazer_log: print(f'--- carregando o tokenizador do prompt ({environment.TOKENIZADOR_PROMPT})...')
+                self.montador_prompt = MontadorPrompt.com_tokenizador(environment.TOKENIZADOR_PROMPT, **parametros_montador)
+            else:
+                self.montador_prompt = MontadorPrompt(**parametros_montador)
+
+    async def consultar_documentos_banco_vetores(self, pergunta: str, num_resultados:int=environment.NUM_DOCUMENTOS_RETORNADOS, embedding_pergunta: List[float]=None):
+        # O embedding é sempre gerado à parte (e medido em tempo_embedding); a busca recebe apenas o vetor
+        if embedding_pergunta is None: embedding_pergunta = await self.gerar_embedding_pergunta(pergunta)
+        if self.indice_lexical:
+            return await self.consultar_documentos_hibrido(pergunta, num_resultados, embedding_pergunta)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.interface_banco_vetores.consultar_documentos, pergunta, num_resultados, embedding_pergunta)
+
+    async def consultar_documentos_hibrido(self, pergunta: str, num_resultados: int, embedding_pergunta: List[float]):
+        loop = asyncio.get_running_loop()
+
+        # Busca densa e lexical em paralelo, cada uma com mais candidatos que o número final de documentos
+        num_candidatos = max(num_resultados, environment.NUM_CANDIDATOS_BUSCA_HIBRIDA)
+        documentos_densos, resultados_lexicos = await asyncio.gather(
+            loop.run_in_executor(self.executor, self.interface_banco_vetores.consultar_documentos, pergunta, num_candidatos, embedding_pergunta),
+            loop.run_in_executor(self.executor, self.indice_lexical.consultar, pergunta, num_candidatos))
+        resultados_fundidos = fundir_por_rrf(
+            [documentos_densos['ids'][0], [id_documento for id_documento, _ in resultados_lexicos]],
+            k=environment.K_RRF)[:num_resultados]
+
+        # Documentos encontrados só pela busca lexical têm a distância calculada à parte, para manter score_distancia
+        encontrados = {
+            id_documento: (distancia, documento, metadados)
+            for id_documento, distancia, documento, metadados in zip(
+                documentos_densos['ids'][0], documentos_densos['distances'][0], documentos_densos['documents'][0], documentos_densos['metadatas'][0])}
+        ausentes = [id_documento for id_documento, _ in resultados_fundidos if id_documento not in encontrados]
+        if ausentes:
+            distancias = await loop.run_in_executor(self.executor, self.interface_banco_vetores.calcular_distancias, ausentes, embedding_pergunta)
+            for id_documento in ausentes:
+                encontrados[id_documento] = (distancias[id_documento], *self.indice_lexical.obter_documento(id_documento))
 
-    async def consultar_documentos_banco_vetores(self, pergunta: str, num_resultados:int=environment.NUM_DOCUMENTOS_RETORNADOS):
-        return self.interface_chromadb.consultar_documentos(pergunta, num_resultados)
+        # Mesmo formato de retorno de collection.query do ChromaDB, acrescido do score da fusão
+        return {
+            'ids': [[id_documento for id_documento, _ in resultados_fundidos]],
+            'distances': [[encontrados[id_documento][0] for id_documento, _ in resultados_fundidos]],
+            'documents': [[encontrados[id_documento][1] for id_documento, _ in resultados_fundidos]],
+            'metadatas': [[encontrados[id_documento][2] for id_documento, _ in resultados_fundidos]],
+            'scores_rrf': [[score_rrf for _, score_rrf in resultados_fundidos]]
+        }
+
+    async def gerar_embedding_pergunta(self, pergunta: str):
+        marcador_tempo_inicio = time()
+        if self.loteador_embeddings:
+            embedding = await self.loteador_embeddings.gerar_embedding(pergunta)
+        else:
+            loop = asyncio.get_running_loop()
+            embedding = await loop.run_in_executor(self.executor, self.interface_banco_vetores.gerar_embedding_consulta, pergunta)
+        metricas.tempo_embedding.observar(time() - marcador_tempo_inicio)
+        return embedding
     
     def formatar_lista_documentos(self, documentos: dict):
-        return [
+        lista_documentos = [
             {
                 'id': documentos['ids'][0][idx],
                  'score_distancia': 1 - documentos['distances'][0][idx], # Distância do cosseno vaia entre 1 e 0
@@ -53,6 +166,10 @@ class GeradorDeRespostas:
                  'conteudo': f"{documentos['documents'][0][idx]}"
             }
             for idx in range(len(documentos['ids'][0]))]
+        if 'scores_rrf' in documentos:
+            for documento, score_rrf in zip(lista_documentos, documentos['scores_rrf'][0]):
+                documento['score_rrf'] = score_rrf
+        return lista_documentos
 
     # AFAZER: Considerar remover essa função.
     # Era utilizada com gerar_resposta_llama, mas ficou obsoleta usando o for assíncrono
@@ -61,134 +178,253 @@ class GeradorDeRespostas:
         for item in sync_generator:
             yield await loop.run_in_executor(self.executor, lambda x=item: x)
 
-    async def estimar_resposta(self, pergunta, texto_documento: str):
-        # Optou-se por não utilizar a abordagem com pipeline por ser mais lenta
-        res = self.modelo_bert_qa_pipeline(question=pergunta, context=texto_documento)
-        inputs = self.tokenizador_bert.encode_plus(
-            pergunta,
-            texto_documento,
-            return_tensors="pt",
-            truncation=True,
-            max_length=512
-        )
-
-        inputs = {key: value.to(self.device) for key, value in inputs.items()}
-        
-        with torch.no_grad():
-            outputs = self.modelo_bert_qa(**inputs)
+    def calcular_scores_bert(self, pergunta: str, textos_documentos: List[str]):
+        return self.reranker_bert.calcular_scores(pergunta, textos_documentos)
 
-        # AFAZER: Avaliar se score ponderado faz sentido
-        # Extraindo os logits como tensores
-        logits_inicio = outputs.start_logits
-        logits_fim = outputs.end_logits
+    async def estimar_respostas(self, pergunta: str, textos_documentos: List[str]):
+        if not textos_documentos: return []
+        # A inferência do Bert é síncrona: roda no executor para não bloquear o event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.calcular_scores_bert, pergunta, textos_documentos)
 
-        # Obtenção dos logits positivos
-        logits_inicio_positivos = logits_inicio[0][logits_inicio[0] > 0]
-        logits_fim_positivos = logits_fim[0][logits_fim[0] > 0]
+    def calcular_scores_bert_cronometrado(self, pergunta: str, textos_documentos: List[str]):
+        marcador_tempo_inicio = time()
+        resultados = self.calcular_scores_bert(pergunta, textos_documentos) if textos_documentos else []
+        return resultados, time() - marcador_tempo_inicio
 
-        # Média dos logits positivos
-        media_logits_inicio_positivos = logits_inicio_positivos.mean().item() if logits_inicio_positivos.numel() > 0 else 0
-        media_logits_fim_positivos = logits_fim_positivos.mean().item() if logits_fim_positivos.numel() > 0 else 0
+    def aplicar_scores_bert(self, lista_documentos: List[dict], respostas_estimadas: List[dict]):
+        for documento, resposta_estimada in zip(lista_documentos, respostas_estimadas):
+            documento['score_bert'] = resposta_estimada['score']
+            documento['score_ponderado'] = resposta_estimada['score_ponderado']
+            documento['resposta_bert'] = resposta_estimada['resposta']
 
-        # Obtendo os índices e valores dos melhores logits
-        indice_melhor_logit_inicio = logits_inicio[0].argmax().item()
-        melhor_logit_inicio = logits_inicio[0][indice_melhor_logit_inicio].item()
+    async def estimar_resposta(self, pergunta, texto_documento: str):
+        return (await self.estimar_respostas(pergunta, [texto_documento]))[0]
 
-        indice_melhor_logit_fim = logits_fim[0].argmax().item()
-        melhor_logit_fim = logits_fim[0][indice_melhor_logit_fim].item()
+    async def executar_sessoes(self, metodo: Callable, *args):
+        # Com SQLite, consultas e commits das sessões são feitos no executor, fora do loop de eventos
+        if not self.sessoes.conexao: return metodo(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, metodo, *args)
 
-        # Calcula media_logits_positivos
-        media_logits_positivos = (media_logits_inicio_positivos + media_logits_fim_positivos) / 2
+    async def resolver_sessao(self, dados_chat: DadosChat):
+        # Retorna o id da sessão (None quando o cliente envia o próprio contexto) e o contexto do Ollama a usar
+        if not self.sessoes or dados_chat.contexto is not None:
+            return None, dados_chat.contexto if dados_chat.contexto is not None else environment.CONTEXTO_BASE
+        if dados_chat.id_sessao:
+            contexto = await self.executar_sessoes(self.sessoes.obter_contexto, dados_chat.id_sessao)
+            # Sessões expiradas recomeçam a conversa, mantendo o mesmo id
+            return dados_chat.id_sessao, contexto if contexto is not None else environment.CONTEXTO_BASE
+        return self.sessoes.criar_id_sessao(), environment.CONTEXTO_BASE
 
-        # scores em formato float para serialização com JSON
-        score = float(melhor_logit_inicio + melhor_logit_fim)
-        score_ponderado = float(score * media_logits_positivos)
+    async def finalizar_dados_sessao(self, dados_resposta: dict, id_sessao: str):
+        # Com sessão, o contexto do Ollama fica no servidor e não é devolvido ao cliente
+        if id_sessao is None: return dados_resposta
+        await self.executar_sessoes(self.sessoes.salvar_contexto, id_sessao, dados_resposta['resposta_llama'].get('context'))
+        resposta_llama = {chave: valor for chave, valor in dados_resposta['resposta_llama'].items() if chave != 'context'}
+        return {**dados_resposta, 'resposta_llama': resposta_llama, 'id_sessao': id_sessao}
 
-        # calculando score estimado
-        start_logits_softmax = torch.softmax(logits_inicio, dim=-1)
-        end_logits_softmax = torch.softmax(logits_fim, dim=-1)
-        score_estimado = float(torch.max(start_logits_softmax).item() * torch.max(end_logits_softmax).item())
+    async def reproduzir_resposta_em_cache(self, pergunta: str, resposta_em_cache: dict, similaridade: float, tempo_consulta: float, contexto: list, id_sessao: str=None):
+        # Reproduz a resposta armazenada com os mesmos eventos de uma consulta completa
+        marcador_tempo_inicio = time()
+        yield {'tipo': 'documentos', 'documentos': resposta_em_cache['dados']['documentos'], 'tempo_consulta': tempo_consulta}
+        for fragmento in resposta_em_cache['fragmentos']:
+            yield {'tipo': 'token', 'texto': fragmento}
+        yield {'tipo': 'fim_texto'}
 
-        # score: soma do melhor Logit inicial com o melhor logit final
-        # score_estimado: multiplicação do softmax dos logits de inicio pelo dos logits de fim
-        # -- (manter somente se a performance do score do Bert pelo pipeline ficar lenta)
-        # score_ponderado: score ponderado pela média dos logits de inicio e fim, só quando positivos 
-        # -- (quanto mais logits positivos, mais o documento tem melhor avaliação)
+        dados_resposta = dict(resposta_em_cache['dados'])
+        # O contexto armazenado é o da conversa de quem fez a pergunta original; o de quem recebe a resposta do
+        # cache é derivado da sua própria pergunta
+        resposta_llama = dict(dados_resposta['resposta_llama'])
+        resposta_llama['context'] = self.interface_ollama.derivar_contexto(contexto, pergunta, resposta_llama.get('response', dados_resposta['resposta']))
+        dados_resposta.update({
+            "pergunta": pergunta,
+            "resposta_llama": resposta_llama,
+            "tempo_consulta": tempo_consulta,
+            "tempo_bert": 0.0,
+            "tempo_inicio_resposta": 0.0,
+            "tempo_llama_total": time() - marcador_tempo_inicio,
+            "cache": {
+                "pergunta_original": resposta_em_cache['dados']['pergunta'],
+                "similaridade": similaridade
+            }
+        })
+        yield self.gerar_evento_tempos(dados_resposta)
+        yield {'tipo': 'fim', 'dados': await self.finalizar_dados_sessao(dados_resposta, id_sessao)}
 
-        tokens_resposta = inputs['input_ids'][0][indice_melhor_logit_inicio:indice_melhor_logit_fim + 1]
-        resposta = self.tokenizador_bert.decode(tokens_resposta, skip_special_tokens=True)
-        
+    def gerar_evento_scores(self, lista_documentos: List[dict], tempo_bert: float):
         return {
-            'resposta': (resposta, res['answer']),
-            'score': (score, res['score'], score_estimado),
-            'score_ponderado': score_ponderado
+            'tipo': 'scores',
+            'scores': [
+                {
+                    'id': documento['id'],
+                    'score_bert': documento['score_bert'],
+                    'score_ponderado': documento['score_ponderado'],
+                    'resposta_bert': documento['resposta_bert']
+                }
+                for documento in lista_documentos],
+            'tempo_bert': tempo_bert
         }
 
-    async def consultar(self, dados_chat: DadosChat, fazer_log:bool=True):
-        contexto = dados_chat.contexto
+    def gerar_evento_tempos(self, dados_resposta: dict):
+        return {'tipo': 'tempos', **{chave: dados_resposta[chave] for chave in ['tempo_consulta', 'tempo_bert', 'tempo_inicio_resposta', 'tempo_llama_total']}}
+
+    async def consultar_eventos(self, dados_chat: DadosChat, fazer_log:bool=None):
+        '''
+        Núcleo da consulta. Gera eventos tipados (dicionários com a chave 'tipo'), na ordem em que ficam prontos:
+        'documentos' (resultado da recuperação), 'token' (fragmento de texto do Llama), 'scores' (scores do Bert),
+        'fim_texto' (fim do texto do Llama), 'tempos' e 'fim' (dados compilados da resposta). Se a geração
+        exceder um dos prazos, um evento 'erro' encerra a consulta.
+        '''
+        if fazer_log is None: fazer_log = environment.LOG_CONSULTAS
+        id_sessao, contexto = await self.resolver_sessao(dados_chat)
         pergunta = dados_chat.pergunta
 
         if fazer_log: print(f'Gerador de respostas: realizando consulta para "{pergunta}"...')
 
-        # Recuperando documentos usando o ChromaDB
-        marcador_tempo_inicio = time()
-        documentos = await self.consultar_documentos_banco_vetores(pergunta)
+        marcador_tempo_inicio = instante_inicio_consulta = time()
+        embedding_pergunta = None
+        if self.cache_respostas:
+            # Uma recriação da coleção invalida todas as respostas armazenadas
+            self.cache_respostas.verificar_versao_colecao(self.interface_banco_vetores.versao_colecao())
+            embedding_pergunta = await self.gerar_embedding_pergunta(pergunta)
+            resultado_cache = self.cache_respostas.obter(embedding_pergunta, contexto)
+            if resultado_cache:
+                resposta_em_cache, similaridade = resultado_cache
+                if fazer_log: print(f'--- resposta encontrada no cache (similaridade {similaridade})')
+                metricas.acertos_cache_respostas.incrementar()
+                async for evento in self.reproduzir_resposta_em_cache(pergunta, resposta_em_cache, similaridade, time() - marcador_tempo_inicio, contexto, id_sessao):
+                    yield evento
+                metricas.tempo_consulta_total.observar(time() - instante_inicio_consulta)
+                return
+
+        # Recuperando documentos do banco de vetores
+        # O embedding da pergunta (em lote, com o loteador) é medido à parte; a busca usa query_embeddings
+        if embedding_pergunta is None:
+            embedding_pergunta = await self.gerar_embedding_pergunta(pergunta)
+        marcador_tempo_busca = time()
+        documentos = await self.consultar_documentos_banco_vetores(pergunta, embedding_pergunta=embedding_pergunta)
         lista_documentos = self.formatar_lista_documentos(documentos)
         marcador_tempo_fim = time()
+        metricas.tempo_busca_vetores.observar(marcador_tempo_fim - marcador_tempo_busca)
         tempo_consulta = marcador_tempo_fim - marcador_tempo_inicio
         if fazer_log: print(f'--- consulta no banco concluída ({tempo_consulta} segundos)')
+        yield {'tipo': 'documentos', 'documentos': lista_documentos, 'tempo_consulta': tempo_consulta}
 
         # Atribuindo scores usando Bert
-        if fazer_log: print(f'--- aplicando scores do Bert aos documentos recuperados...')
-        marcador_tempo_inicio = time()
-        for documento in lista_documentos:
-            resposta_estimada = await self.estimar_resposta(pergunta, documento['conteudo'])
-            documento['score_bert'] = resposta_estimada['score']
-            documento['score_ponderado'] = resposta_estimada['score_ponderado']
-            documento['resposta_bert'] = resposta_estimada['resposta']
-        marcador_tempo_fim = time()
-        tempo_bert = marcador_tempo_fim - marcador_tempo_inicio
-        if fazer_log: print(f'--- scores atribuídos ({tempo_bert} segundos)')
+        # Sem o montador de prompt (ou com ele ignorando o Bert), o prompt do Llama usa apenas os documentos
+        # recuperados. Assim, no modo paralelo, os scores são calculados no executor enquanto a resposta do Llama
+        # é transmitida, sendo agregados apenas no JSON final
+        textos_documentos = [documento['conteudo'] for documento in lista_documentos]
+        tarefa_bert = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.calcular_scores_bert_cronometrado, pergunta, textos_documentos)
+        bert_antes_llama = not self.paralelizar_bert_llama or (self.montador_prompt is not None and self.montador_prompt.usa_scores_bert)
+        if bert_antes_llama:
+            if fazer_log: print(f'--- aplicando scores do Bert aos documentos recuperados...')
+            respostas_estimadas, tempo_bert = await tarefa_bert
+            metricas.tempo_rerank.observar(tempo_bert)
+            self.aplicar_scores_bert(lista_documentos, respostas_estimadas)
+            if fazer_log: print(f'--- scores atribuídos ({tempo_bert} segundos)')
+            yield self.gerar_evento_scores(lista_documentos, tempo_bert)
         
+        # Inclui o título dos documentos no prompt do Llama
+        documentos_prompt = [f"{documento['metadados']['titulo']} - {documento['conteudo']}" for documento in lista_documentos]
+        relatorio_prompt = None
+        if self.montador_prompt:
+            prompt_base = self.interface_ollama.criar_prompt_llama(self.interface_ollama.formatar_prompt_usuario(pergunta, []))
+            documentos_prompt, relatorio_prompt = self.montador_prompt.selecionar(lista_documentos, documentos_prompt, prompt_base, contexto)
+            if fazer_log: print(f'--- {len(documentos_prompt)} de {len(lista_documentos)} documentos no prompt ({relatorio_prompt["tokens_documentos"]} tokens estimados)')
+
+        # Aguardando uma vaga de geração no Ollama (recuperação e Bert não ocupam vaga)
+        permissao = None
+        if self.controlador_admissao:
+            try:
+                permissao = await self.controlador_admissao.admitir()
+            except RejeicaoAdmissao as rejeicao:
+                metricas.rejeicoes.incrementar(str(rejeicao.status_code))
+                if fazer_log: print(f'--- geração recusada pelo controle de admissão: {rejeicao.motivo}')
+                yield {'tipo': 'erro', 'etapa': 'admissao', 'retry_after': rejeicao.retry_after,
+                       'mensagem': f'O assistente está com muitas perguntas no momento. Tente novamente em {rejeicao.retry_after} segundos.'}
+                return
+
         # Gerando resposta utilizando o Llama
         if fazer_log: print(f'--- gerando resposta com o Llama')
         marcador_tempo_inicio = time()
         texto_resposta_llama = ''
+        fragmentos_resposta = []
         flag_tempo_resposta = False
-        async for item in self.interface_ollama.gerar_resposta_llama(
-                    pergunta=pergunta,
-                    # Inclui o título dos documentos no prompt do Llama
-                    documentos=[f"{doc[0]['titulo']} - {doc[1]}" for doc in zip(documentos['metadatas'][0], documentos['documents'][0])],
-                    contexto=contexto):
-            
-            texto_resposta_llama += item['response']
-            yield item['response']
-            if not flag_tempo_resposta:
-                flag_tempo_resposta = True
-                tempo_inicio_resposta = time() - marcador_tempo_inicio
-                if fazer_log: print(f'----- iniciou retorno da resposta ({tempo_inicio_resposta} segundos)')
+        resposta_llama = self.interface_ollama.gerar_resposta_llama(
+            pergunta=pergunta,
+            documentos=documentos_prompt,
+            contexto=contexto)
+        if permissao: resposta_llama = permissao.envolver(resposta_llama)
+        try:
+            # Prazos para o primeiro token e para a geração completa, para não prender a vaga de admissão
+            async for item in iterar_com_prazos(resposta_llama, environment.PRAZO_PRIMEIRO_TOKEN, environment.PRAZO_GERACAO_LLAMA):
+                texto_resposta_llama += item['response']
+                fragmentos_resposta.append(item['response'])
+                yield {'tipo': 'token', 'texto': item['response']}
+                metricas.tokens_transmitidos.incrementar()
+                if not flag_tempo_resposta:
+                    flag_tempo_resposta = True
+                    tempo_inicio_resposta = time() - marcador_tempo_inicio
+                    metricas.tempo_primeiro_token.observar(tempo_inicio_resposta)
+                    if fazer_log: print(f'----- iniciou retorno da resposta ({tempo_inicio_resposta} segundos)')
+        except PrazoExcedido as erro:
+            self.qtd_prazos_excedidos += 1
+            metricas.erros.incrementar(f'llama_{erro.etapa}')
+            if fazer_log: print(f'--- geração interrompida: {erro}')
+            yield {'tipo': 'erro', 'etapa': f'llama_{erro.etapa}', 'mensagem': 'Não foi possível concluir a resposta a tempo. Tente novamente em instantes.'}
+            return
+        finally:
+            # Fecha o stream do Llama, devolvendo a vaga, também quando a consulta é encerrada antes do fim
+            await resposta_llama.aclose()
 
         item['response'] = texto_resposta_llama
         marcador_tempo_fim = time()
         tempo_llama = marcador_tempo_fim - marcador_tempo_inicio
+        metricas.tempo_geracao.observar(tempo_llama)
         if fazer_log: print(f'--- resposta do Llama concluída ({tempo_llama} segundos)')
+        yield {'tipo': 'fim_texto'}
 
-        yield "CHEGOU_AO_FIM_DO_TEXTO_DA_RESPOSTA"
+        if not bert_antes_llama:
+            respostas_estimadas, tempo_bert = await tarefa_bert
+            metricas.tempo_rerank.observar(tempo_bert)
+            self.aplicar_scores_bert(lista_documentos, respostas_estimadas)
+            if fazer_log: print(f'--- scores do Bert atribuídos em paralelo ({tempo_bert} segundos)')
+            yield self.gerar_evento_scores(lista_documentos, tempo_bert)
 
         # Retornando dados compilados
-        yield json.dumps(
-            {
-                "pergunta": pergunta,
-                "documentos": lista_documentos,
-                "resposta_llama": item,
-                "resposta": texto_resposta_llama.replace('\n\n', '\n'),
-                "tempo_consulta": tempo_consulta,
-                "tempo_bert": tempo_bert,
-                "tempo_inicio_resposta": tempo_inicio_resposta,
-                "tempo_llama_total": tempo_llama
-            },
-            ensure_ascii=False
-        )
-        print('Concluído')
-
-    
\ No newline at end of file
+        dados_resposta = {
+            "pergunta": pergunta,
+            "documentos": lista_documentos,
+            "resposta_llama": item,
+            "resposta": texto_resposta_llama.replace('\n\n', '\n'),
+            "tempo_consulta": tempo_consulta,
+            "tempo_bert": tempo_bert,
+            "tempo_inicio_resposta": tempo_inicio_resposta,
+            "tempo_llama_total": tempo_llama
+        }
+        # Documentos incluídos e descartados do prompt, com relevância e tokens estimados
+        if relatorio_prompt: dados_resposta['prompt'] = relatorio_prompt
+        if self.cache_respostas:
+            # Sem o contexto da conversa: ele pertence à sessão de quem perguntou e não é reaproveitado
+            dados_cache = {**dados_resposta, 'resposta_llama': {chave: valor for chave, valor in item.items() if chave != 'context'}}
+            self.cache_respostas.incluir(embedding_pergunta, contexto, {'fragmentos': fragmentos_resposta, 'dados': dados_cache})
+        yield self.gerar_evento_tempos(dados_resposta)
+        yield {'tipo': 'fim', 'dados': await self.finalizar_dados_sessao(dados_resposta, id_sessao)}
+        metricas.tempo_consulta_total.observar(time() - instante_inicio_consulta)
+        if fazer_log: print('Concluído')
+
+    async def consultar(self, dados_chat: DadosChat, fazer_log:bool=None):
+        # Protocolo original: texto da resposta, marcador de fim do texto e JSON com os dados compilados
+        async with aclosing(self.consultar_eventos(dados_chat, fazer_log)) as eventos:
+            async for evento in eventos:
+                if evento['tipo'] == 'token':
+                    yield evento['texto']
+                elif evento['tipo'] == 'fim':
+                    yield "CHEGOU_AO_FIM_DO_TEXTO_DA_RESPOSTA"
+                    yield json.dumps(evento['dados'], ensure_ascii=False)
+                elif evento['tipo'] == 'erro':
+                    yield evento['mensagem']
+                    yield "CHEGOU_AO_FIM_DO_TEXTO_DA_RESPOSTA"
+                    yield json.dumps({'erro': evento}, ensure_ascii=False)
@@ -6,6 +6,7 @@ from sentence_transformers import SentenceTransformer
 from ..environment.environment import environment
 from ..gerador_de_respostas import GeradorDeRespostas
 from ..utils.utils import FuncaoEmbeddings
+from .checkpoint_jsonl import CheckpointJsonl, gerar_chave, obter_url_checkpoint, salvar_json_atomico
 from time import time
 import asyncio
 import os
@@ -24,7 +25,13 @@ async def avaliar_recuperacao_documentos(
     instrucao=None,
     fazer_log=False):
     
-    if not url_arquivo_saida: url_arquivo_saida = url_arquivo_entrada.split('.')[0] + '_recup_docs.json'
+    if not url_arquivo_saida: url_arquivo_saida = os.path.splitext(url_arquivo_entrada)[0] + '_recup_docs.json'
+    # Resultados de outra configuração (banco, coleção, instrução ou modelo) não são reaproveitados
+    configuracao = {'nome_banco_vetores': nome_banco_vetores, 'nome_colecao': nome_colecao, 'instrucao': instrucao, 'modelo_embeddings': EMBEDDING_INSTRUCTOR}
+    url_checkpoint = obter_url_checkpoint(url_arquivo_saida)
+    # Aberto antes da carga dos modelos: um checkpoint de outra configuração é recusado de imediato
+    checkpoint = CheckpointJsonl(url_checkpoint, configuracao=configuracao)
+
     url_banco_vetores = os.path.join(URL_LOCAL, f"../conteudo/bancos_vetores/{nome_banco_vetores}")
     print(f'Criando GeradorDeRespostas (usando {EMBEDDING_INSTRUCTOR} e instrução "{instrucao}")...')
     funcao_de_embeddings = FuncaoEmbeddings(nome_modelo=EMBEDDING_INSTRUCTOR, tipo_modelo=SentenceTransformer, device=DEVICE, instrucao=instrucao)
@@ -43,10 +50,26 @@ async def avaliar_recuperacao_documentos(
             except:
                 print(pergunta)
 
+    # Cada pergunta concluída é acrescentada ao checkpoint JSONL; uma nova execução retoma de onde parou
+    print(f'Checkpoint em {url_checkpoint} ({len(checkpoint)} perguntas já avaliadas)')
+    try:
+        await avaliar_perguntas(gerador_de_respostas, perguntas, checkpoint, fazer_log)
+    finally:
+        checkpoint.fechar()
+        # Compactação no layout original (lista de perguntas), inclusive após uma interrupção
+        salvar_json_atomico(url_arquivo_saida, perguntas)
+        print(f'\nResultados salvos em {url_arquivo_saida}')
+
+
+async def avaliar_perguntas(gerador_de_respostas, perguntas, checkpoint, fazer_log=False):
     qtd_perguntas = len(perguntas)
     for idx in range(qtd_perguntas):
         pergunta = perguntas[idx]
         print(f'\rPergunta {idx+1} de {qtd_perguntas}', end='')
+        chave = gerar_chave(pergunta['id'], pergunta['pergunta'])
+        if chave in checkpoint:
+            pergunta.update(checkpoint.obter(chave))
+            continue
         if fazer_log: print(f'''-- realizando consulta para: "{pergunta['pergunta']}"...''')
 
         # Recuperando documentos usando o ChromaDB
@@ -60,15 +83,15 @@ async def avaliar_recuperacao_documentos(
         # Atribuindo scores usando Bert
         if fazer_log: print(f'--- aplicando scores do Bert aos documentos recuperados...')
         marcador_tempo_inicio = time()
-        for documento in lista_documentos:
-            resposta_estimada = await gerador_de_respostas.estimar_resposta(pergunta['pergunta'], documento['conteudo'])
+        respostas_estimadas = await gerador_de_respostas.estimar_respostas(pergunta['pergunta'], [documento['conteudo'] for documento in lista_documentos])
+        for documento, resposta_estimada in zip(lista_documentos, respostas_estimadas):
             documento['score_bert'] = resposta_estimada['score']
             documento['score_ponderado'] = resposta_estimada['score_ponderado']
             documento['resposta_bert'] = resposta_estimada['resposta']
         marcador_tempo_fim = time()
         tempo_bert = marcador_tempo_fim - marcador_tempo_inicio
         if fazer_log: print(f'--- scores atribuídos ({tempo_bert} segundos)\n\n\n')
-        pergunta.update({
+        resultado = {
             'documentos': [
                 {'id': doc['id'],
                 'titulo': doc['metadados']['titulo'],
@@ -80,11 +103,9 @@ async def avaliar_recuperacao_documentos(
                 } for doc in lista_documentos],
             'tempo_consulta': tempo_consulta,
             'tempo_bert': tempo_bert
-            })
-
-
-        with open(url_arquivo_saida, 'w', encoding='utf-8') as arq:
-            json.dump(perguntas, arq, indent=4, ensure_ascii=False)
+            }
+        pergunta.update(resultado)
+        checkpoint.gravar(chave, resultado)
 
 
 
@@ -0,0 +1,177 @@
+import argparse
+import json
+import numpy as np
+import os
+
+from time import perf_counter
+
+URL_LOCAL = os.path.abspath(os.path.join(os.path.dirname(__file__), "./"))
+EMBEDDING_INSTRUCTOR="hkunlp/instructor-xl"
+VALORES_K = [1, 3, 5, 10]
+# Quantidade de perguntas por chamada a collection.query e por bloco do produto de matrizes
+TAMANHO_LOTE_CONSULTA = 256
+
+
+def obter_chave_artigo(metadados: dict):
+    # "Art. 12 - 2" é o segundo fragmento do artigo 12; a chave do artigo ignora o número do fragmento
+    return f"{metadados['titulo']}::{metadados['subtitulo'].rsplit(' - ', 1)[0]}"
+
+
+def carregar_perguntas(url_arquivo_entrada: str, relevancia: str='id'):
+    '''
+    Lê o conjunto de perguntas (mesmo formato de avaliar_recuperacao_documentos) e retorna os textos das perguntas
+    e a chave do documento relevante de cada uma: o id do fragmento que gerou a pergunta ou, com relevancia='artigo',
+    o artigo de origem, que permite comparar bancos gerados com tamanhos de fragmento diferentes.
+    '''
+    with open(url_arquivo_entrada, 'r') as arq:
+        docs = json.load(arq)
+    textos, chaves_relevantes = [], []
+    for item in docs['dados']:
+        chave = str(item['id']) if relevancia == 'id' else obter_chave_artigo(item['metadata'])
+        for pergunta in item['perguntas']:
+            if pergunta.get('resposta', '') == '': continue
+            textos.append(pergunta['pergunta'])
+            chaves_relevantes.append(chave)
+    return textos, np.array(chaves_relevantes, dtype=object)
+
+
+def normalizar(matriz: np.ndarray):
+    normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+    return matriz / np.where(normas == 0, 1.0, normas)
+
+
+def buscar_chroma(colecao, embeddings: np.ndarray, num_resultados: int, relevancia: str='id'):
+    # Várias perguntas por chamada: o ChromaDB percorre o HNSW para todas elas em uma única requisição
+    chaves = []
+    for inicio in range(0, len(embeddings), TAMANHO_LOTE_CONSULTA):
+        resultado = colecao.query(
+            query_embeddings=embeddings[inicio:inicio + TAMANHO_LOTE_CONSULTA].tolist(),
+            n_results=num_resultados,
+            include=['metadatas'] if relevancia == 'artigo' else [])
+        if relevancia == 'artigo':
+            chaves.extend([obter_chave_artigo(metadados) for metadados in linha] for linha in resultado['metadatas'])
+        else:
+            chaves.extend(resultado['ids'])
+    return chaves
+
+
+def buscar_matricial(colecao, embeddings: np.ndarray, num_resultados: int, relevancia: str='id'):
+    # Busca exata: produto das perguntas pela matriz de documentos (ambos normalizados) e argpartition por linha
+    registros = colecao.get(include=['embeddings', 'metadatas'])
+    documentos = normalizar(np.asarray(registros['embeddings'], dtype=np.float32))
+    if relevancia == 'artigo':
+        chaves_documentos = np.array([obter_chave_artigo(metadados) for metadados in registros['metadatas']], dtype=object)
+    else:
+        chaves_documentos = np.array(registros['ids'], dtype=object)
+    consultas = normalizar(embeddings)
+
+    num_resultados = min(num_resultados, len(documentos))
+    indices = []
+    for inicio in range(0, len(consultas), TAMANHO_LOTE_CONSULTA):
+        similaridades = consultas[inicio:inicio + TAMANHO_LOTE_CONSULTA] @ documentos.T
+        melhores = np.argpartition(-similaridades, num_resultados - 1, axis=1)[:, :num_resultados]
+        ordem = np.argsort(-np.take_along_axis(similaridades, melhores, axis=1), axis=1)
+        indices.append(np.take_along_axis(melhores, ordem, axis=1))
+    return chaves_documentos[np.concatenate(indices)].tolist()
+
+
+def calcular_posicoes(chaves_recuperadas: list, chaves_relevantes: np.ndarray):
+    # Posição (a partir de 1) do primeiro documento relevante entre os recuperados de cada pergunta; 0 se ausente
+    largura = max((len(linha) for linha in chaves_recuperadas), default=0)
+    recuperadas = np.full((len(chaves_recuperadas), largura), None, dtype=object)
+    for idx, linha in enumerate(chaves_recuperadas):
+        recuperadas[idx, :len(linha)] = linha
+    acertos = recuperadas == chaves_relevantes[:, None]
+    return np.where(acertos.any(axis=1), acertos.argmax(axis=1) + 1, 0)
+
+
+def calcular_metricas(posicoes: np.ndarray, valores_k=VALORES_K):
+    # Um único documento relevante por pergunta: o IDCG é 1, e o nDCG@k é 1/log2(posição+1) dentro do top-k
+    encontrado = posicoes > 0
+    metricas = {'mrr': float(np.where(encontrado, 1 / np.maximum(posicoes, 1), 0).mean())}
+    for k in valores_k:
+        no_top_k = encontrado & (posicoes <= k)
+        metricas[f'recall@{k}'] = float(no_top_k.mean())
+        metricas[f'ndcg@{k}'] = float(np.where(no_top_k, 1 / np.log2(np.maximum(posicoes, 1) + 1), 0).mean())
+    return metricas
+
+
+def imprimir_tabela(resultados: list, valores_k=VALORES_K):
+    colunas = ['mrr'] + [f'recall@{k}' for k in valores_k] + [f'ndcg@{k}' for k in valores_k]
+    largura_nome = max([len(resultado['configuracao']) for resultado in resultados] + [13])
+    print(f'{"configuração":<{largura_nome}} {"emb. (s)":>9} {"busca (s)":>10} ' + ' '.join(f'{coluna:>9}' for coluna in colunas))
+    for resultado in resultados:
+        print(f'{resultado["configuracao"]:<{largura_nome}} {resultado["tempo_embeddings"]:>9.2f} {resultado["tempo_busca"]:>10.2f} '
+              + ' '.join(f'{resultado["metricas"][coluna]:>9.4f}' for coluna in colunas))
+
+
+def avaliar(url_arquivo_entrada, configuracoes, instrucoes, relevancia='id', busca_matricial=False,
+            valores_k=VALORES_K, tamanho_lote=128, url_arquivo_saida=None, device=None):
+    '''
+    Avalia cada combinação de banco de vetores (nome_banco_vetores, nome_colecao) e instrução. As perguntas são
+    convertidas em embeddings uma única vez por instrução, em lotes grandes, e consultadas em lote; as métricas
+    são calculadas sobre o vetor de posições do documento relevante.
+    '''
+    from chromadb import chromadb
+    from sentence_transformers import SentenceTransformer
+    from ..utils.utils import FuncaoEmbeddings
+
+    textos, chaves_relevantes = carregar_perguntas(url_arquivo_entrada, relevancia)
+    print(f'{len(textos)} perguntas em {url_arquivo_entrada}')
+    num_resultados = max(valores_k)
+    # O modelo é carregado uma vez; a instrução é trocada a cada configuração
+    funcao_de_embeddings = FuncaoEmbeddings(nome_modelo=EMBEDDING_INSTRUCTOR, tipo_modelo=SentenceTransformer, device=device, instrucao=None, tamanho_lote=tamanho_lote)
+
+    resultados = []
+    for instrucao in instrucoes:
+        print(f'Gerando embeddings das perguntas (instrução "{instrucao}")...')
+        funcao_de_embeddings.instrucao = instrucao
+        marcador_tempo_inicio = perf_counter()
+        embeddings = np.asarray(funcao_de_embeddings.gerar_embeddings(textos), dtype=np.float32)
+        tempo_embeddings = perf_counter() - marcador_tempo_inicio
+
+        for nome_banco_vetores, nome_colecao in configuracoes:
+            url_banco_vetores = os.path.join(URL_LOCAL, f"../conteudo/bancos_vetores/{nome_banco_vetores}")
+            colecao = chromadb.PersistentClient(path=url_banco_vetores).get_collection(name=nome_colecao)
+            print(f'Consultando {nome_banco_vetores}/{nome_colecao} ({colecao.count()} documentos)...')
+            marcador_tempo_inicio = perf_counter()
+            buscar = buscar_matricial if busca_matricial else buscar_chroma
+            chaves_recuperadas = buscar(colecao, embeddings, min(num_resultados, colecao.count()), relevancia)
+            tempo_busca = perf_counter() - marcador_tempo_inicio
+
+            posicoes = calcular_posicoes(chaves_recuperadas, chaves_relevantes)
+            resultados.append({
+                'configuracao': f'{nome_banco_vetores}/{nome_colecao} | {instrucao or "sem instrução"}',
+                'nome_banco_vetores': nome_banco_vetores,
+                'nome_colecao': nome_colecao,
+                'instrucao': instrucao,
+                'tempo_embeddings': tempo_embeddings,
+                'tempo_busca': tempo_busca,
+                'metricas': calcular_metricas(posicoes, valores_k)
+            })
+
+    imprimir_tabela(resultados, valores_k)
+    if url_arquivo_saida:
+        with open(url_arquivo_saida, 'w', encoding='utf-8') as arq:
+            json.dump(resultados, arq, indent=4, ensure_ascii=False)
+        print(f'Resultados salvos em {url_arquivo_saida}')
+    return resultados
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Avalia a recuperação de documentos em lote (recall@k, MRR e nDCG) para várias configurações de banco e instrução")
+
+    parser.add_argument('--url_entrada', type=str, required=True, help="caminho para arquivo com as perguntas")
+    parser.add_argument('--configuracoes', type=str, nargs='+', required=True, help="pares nome_banco_vetores:nome_colecao a serem comparados")
+    parser.add_argument('--instrucoes', type=str, nargs='+', default=[''], help="instruções da função de embeddings ('' para nenhuma)")
+    parser.add_argument('--relevancia', type=str, choices=['id', 'artigo'], default='id', help="documento relevante: o fragmento que gerou a pergunta ou qualquer fragmento do mesmo artigo")
+    parser.add_argument('--busca_matricial', action='store_true', help="busca exata por produto de matrizes, em vez de collection.query")
+    parser.add_argument('--valores_k', type=int, nargs='+', default=VALORES_K, help="valores de k para recall@k e nDCG@k")
+    parser.add_argument('--tamanho_lote', type=int, default=128, help="perguntas por lote na geração de embeddings")
+    parser.add_argument('--url_saida', type=str, help="caminho para arquivo JSON em que serão salvas as métricas")
+
+    args = parser.parse_args()
+    configuracoes = [tuple(configuracao.split(':', 1)) for configuracao in args.configuracoes]
+    instrucoes = [instrucao or None for instrucao in args.instrucoes]
+    avaliar(args.url_entrada, configuracoes, instrucoes, args.relevancia, args.busca_matricial,
+            sorted(args.valores_k), args.tamanho_lote, args.url_saida)
@@ -1,12 +1,14 @@
 ## print('Para simplicidade, mover o arquivo para a pasta principal para executar')
 print('Importando bibliotecas')
 import argparse
+import httpx
 import json
 from time import time
 from sentence_transformers import SentenceTransformer
 from chromadb import chromadb
 from ..environment.environment import environment
 from ..utils.utils import FuncaoEmbeddings, InterfaceOllama
+from .checkpoint_jsonl import CheckpointJsonl, gerar_chave, obter_url_checkpoint, salvar_json_atomico
 import asyncio
 import os
 from torch import cuda
@@ -24,14 +26,23 @@ URL_BANCO_VETORES=os.path.join(URL_LOCAL,"../conteudo/bancos_vetores/banco_vetor
 NOME_COLECAO='regimento_resolucoes_rh'
 DEVICE='cuda' if cuda.is_available() else 'cpu'
 
-async def avaliar_respostas_llama(url_arquivo_entrada, nome_banco_vetores, nome_colecao, url_arquivo_saida=None, instrucao=None):
-    if not url_arquivo_saida: url_arquivo_saida = url_arquivo_entrada
+async def avaliar_respostas_llama(url_arquivo_entrada, nome_banco_vetores, nome_colecao, url_arquivo_saida=None, instrucao=None,
+                                  url_llama=URL_LLAMA, concorrencia=1, timeout_requisicao=300, tentativas=3):
+    # A saída nunca é o próprio arquivo de entrada: a compactação após uma interrupção o sobrescreveria
+    if not url_arquivo_saida: url_arquivo_saida = os.path.splitext(url_arquivo_entrada)[0] + '_respostas_llama.json'
+    if os.path.abspath(url_arquivo_saida) == os.path.abspath(url_arquivo_entrada):
+        raise ValueError(f'O arquivo de saída não pode ser o de entrada ({url_arquivo_entrada})')
     if FAZER_LOG: print('Carregando JSON')
     with open(url_arquivo_entrada, 'r', encoding='utf-8') as arq:
-        dados = json.load(arq)
-        dados=dados['dados'] # por motivodfe mudança na estrutura do arquivo
+        conteudo_entrada = json.load(arq)
+        dados=conteudo_entrada['dados'] # por motivodfe mudança na estrutura do arquivo
     if FAZER_LOG: print('Criando interface Ollama')
-    interface_ollama = InterfaceOllama(url_llama=URL_LLAMA, nome_modelo=MODELO_LLAMA)
+    interface_ollama = InterfaceOllama(url_llama=url_llama, nome_modelo=MODELO_LLAMA)
+
+    # Respostas de outro modelo, modo do Ollama ou coleção não são reaproveitadas
+    configuracao = {'modelo_llama': MODELO_LLAMA, 'modo_ollama': interface_ollama.modo, 'nome_banco_vetores': nome_banco_vetores, 'nome_colecao': nome_colecao}
+    url_checkpoint = obter_url_checkpoint(url_arquivo_saida)
+    checkpoint = CheckpointJsonl(url_checkpoint, configuracao=configuracao)
 
     if FAZER_LOG: print('Criando cliente Chroma')
     url_banco_vetores = os.path.join(URL_LOCAL, f"../conteudo/bancos_vetores/{nome_banco_vetores}")
@@ -41,38 +52,134 @@ async def avaliar_respostas_llama(url_arquivo_entrada, nome_banco_vetores, nome_
     if FAZER_LOG: print('Definindo Coleção')
     collection = client.get_collection(name=nome_colecao, embedding_function=funcao_de_embeddings_sentence_tranformer)
     
-    if FAZER_LOG: print('Processando perguntas')
-    num_itens = len(dados)
-    for idx in range(num_itens):
-        print(f'\rPergunta {idx+1} de {num_itens}', end="")
-        item = dados[idx]
+    # Cada resposta concluída é acrescentada ao checkpoint JSONL; uma nova execução retoma de onde parou
+    print(f'Checkpoint em {url_checkpoint} ({len(checkpoint)} respostas já geradas)')
+    try:
+        await gerar_respostas(interface_ollama, collection, dados, checkpoint, concorrencia, timeout_requisicao, tentativas)
+    finally:
+        await interface_ollama.fechar()
+        checkpoint.fechar()
+        # Compactação no layout original ({"dados": [...]}, lido por bert_scorer), inclusive após uma interrupção
+        if FAZER_LOG: print('salvando json')
+        salvar_json_atomico(url_arquivo_saida, {**conteudo_entrada, 'dados': dados})
+
+class ProgressoExecucao:
+    # Progresso e vazão da geração: perguntas concluídas por minuto e tokens gerados por segundo (eval_count do Ollama)
+    def __init__(self, total: int, intervalo_relatorio: float=1.0):
+        self.total = total
+        self.intervalo_relatorio = intervalo_relatorio
+        self.concluidas = 0
+        self.reaproveitadas = 0
+        self.falhas = 0
+        self.tentativas_extras = 0
+        self.tokens_gerados = 0
+        self.instante_inicio = time()
+        self.instante_ultimo_relatorio = 0
+
+    def registrar(self, resposta: dict=None, falha: bool=False):
+        if falha: self.falhas += 1
+        else:
+            self.concluidas += 1
+            self.tokens_gerados += resposta.get('eval_count', 0)
+        if time() - self.instante_ultimo_relatorio >= self.intervalo_relatorio: self.relatar()
+
+    def relatar(self, final: bool=False):
+        self.instante_ultimo_relatorio = time()
+        tempo_decorrido = max(time() - self.instante_inicio, 1e-9)
+        processadas = self.reaproveitadas + self.concluidas + self.falhas
+        print(f'\rPergunta {processadas} de {self.total} | {self.concluidas} geradas, {self.reaproveitadas} do checkpoint, '
+              f'{self.falhas} falhas | {60 * self.concluidas / tempo_decorrido:.1f} perguntas/min, '
+              f'{self.tokens_gerados / tempo_decorrido:.1f} tokens/s', end='\n' if final else '')
+
+
+class RespostaInvalidaOllama(Exception):
+    # Stream sem nenhum fragmento ou com um objeto de erro do Ollama no lugar da resposta
+    pass
+
+
+# Falhas de uma pergunta que levam a uma nova tentativa e, esgotadas as tentativas, apenas deixam a pergunta sem resposta
+ERROS_REQUISICAO = (asyncio.TimeoutError, httpx.HTTPError, httpx.StreamError, json.JSONDecodeError, RespostaInvalidaOllama)
+
 
+async def gerar_resposta(interface_ollama, pergunta, documentos):
+    texto_resposta_llama = ''
+    resp_llama = None
+    async for resp_llama in interface_ollama.gerar_resposta_llama(pergunta=pergunta, documentos=documentos, contexto=[]):
+        if 'error' in resp_llama: raise RespostaInvalidaOllama(resp_llama['error'])
+        texto_resposta_llama += resp_llama.get('response', '')
+    if resp_llama is None: raise RespostaInvalidaOllama('Resposta do Ollama sem nenhum fragmento')
+
+    resp_llama['response'] = texto_resposta_llama
+    resp_llama['context'] = []
+    return resp_llama
+
+
+async def gerar_resposta_com_tentativas(interface_ollama, pergunta, documentos, timeout_requisicao, tentativas, progresso):
+    # O timeout vale para a transmissão inteira; entre as tentativas, espera exponencial (1s, 2s, 4s...)
+    for tentativa in range(tentativas):
+        try:
+            return await asyncio.wait_for(gerar_resposta(interface_ollama, pergunta, documentos), timeout=timeout_requisicao)
+        except ERROS_REQUISICAO as erro:
+            if tentativa == tentativas - 1: raise
+            progresso.tentativas_extras += 1
+            if FAZER_LOG: print(f'\nFalha na tentativa {tentativa + 1} ({type(erro).__name__}): nova tentativa')
+            await asyncio.sleep(2 ** tentativa)
+
+
+async def gerar_respostas(interface_ollama, collection, dados, checkpoint, concorrencia=1, timeout_requisicao=300, tentativas=3):
+    '''
+    Gera as respostas com até `concorrencia` requisições simultâneas ao Ollama (o servidor precisa aceitar requisições
+    paralelas, com OLLAMA_NUM_PARALLEL). Cada worker retira o índice da próxima pergunta de uma fila; as respostas
+    terminam fora de ordem e são gravadas no item do seu índice e no checkpoint assim que concluídas. Perguntas que
+    falham em todas as tentativas ficam sem resposta e são refeitas na próxima execução.
+    '''
+    if FAZER_LOG: print('Processando perguntas')
+    progresso = ProgressoExecucao(len(dados))
+    pendentes = []
+    for idx, item in enumerate(dados):
         # Ignora Cada item que já tem uma resposta do llama
-        if 'llama' in item: continue
-
-        pergunta = item['pergunta']
-        if FAZER_LOG: print('Recuperando documentos')
-        documentos = collection.get(
-            ids=[doc['id'] for doc in item['documentos']]
-        )
-        if FAZER_LOG: print('Enviando dados para o ollama')
-        texto_resposta_llama = ''
-        async for resp_llama in interface_ollama.gerar_resposta_llama(
-                    pergunta=pergunta,
-                    # Inclui o título dos documentos no prompt do Llama
-                    documentos=[f"{doc[0]['titulo']} - {doc[1]}" for doc in zip(documentos['metadatas'], documentos['documents'])],
-                    contexto=[]):
-            
-            texto_resposta_llama += resp_llama['response']
-
-        resp_llama['response'] = texto_resposta_llama
-        resp_llama['context'] = []
-
-        item['llama'] = resp_llama
+        if 'llama' in item:
+            progresso.reaproveitadas += 1
+            continue
+        chave = gerar_chave(item.get('id'), item['pergunta'])
+        if chave in checkpoint:
+            item['llama'] = checkpoint.obter(chave)
+            progresso.reaproveitadas += 1
+            continue
+        pendentes.append((idx, chave))
 
-        if FAZER_LOG: print('salvando json')
-        with open(os.path.join(url_arquivo_saida), 'w', encoding='utf-8') as arq:
-            arq.write(json.dumps(dados, ensure_ascii=False, indent=4))
+    if FAZER_LOG: print('Recuperando documentos')
+    # Os documentos de todas as perguntas pendentes são lidos em uma única consulta ao ChromaDB
+    ids = list({doc['id'] for idx, _ in pendentes for doc in dados[idx]['documentos']})
+    registros = collection.get(ids=ids) if ids else {'ids': [], 'metadatas': [], 'documents': []}
+    # Inclui o título dos documentos no prompt do Llama
+    textos_documentos = {id_doc: f"{metadados['titulo']} - {documento}" for id_doc, metadados, documento in zip(registros['ids'], registros['metadatas'], registros['documents'])}
+
+    fila = asyncio.Queue()
+    for pendente in pendentes: fila.put_nowait(pendente)
+
+    async def worker():
+        while True:
+            try:
+                idx, chave = fila.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            item = dados[idx]
+            documentos = [textos_documentos[doc['id']] for doc in item['documentos'] if doc['id'] in textos_documentos]
+            try:
+                resp_llama = await gerar_resposta_com_tentativas(interface_ollama, item['pergunta'], documentos, timeout_requisicao, tentativas, progresso)
+            except ERROS_REQUISICAO as erro:
+                print(f'\nPergunta {idx + 1} sem resposta após {tentativas} tentativas ({type(erro).__name__}: {erro})')
+                progresso.registrar(falha=True)
+                continue
+            item['llama'] = resp_llama
+            checkpoint.gravar(chave, resp_llama)
+            progresso.registrar(resp_llama)
+
+    await asyncio.gather(*[worker() for _ in range(max(1, concorrencia))])
+    progresso.relatar(final=True)
+    if progresso.tentativas_extras: print(f'{progresso.tentativas_extras} novas tentativas após falhas ou timeouts')
+    return progresso
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Gera resultados de busca por documentos a partir de uma lista de perguntas")
@@ -80,8 +187,12 @@ if __name__ == '__main__':
     parser.add_argument('--url_entrada', type=str, required=True, help="caminho para arquivo com as perguntas")
     parser.add_argument('--nome_banco_vetores', type=str, required=True, help="nome do banco de vetores a ser consultado")
     parser.add_argument('--nome_colecao', type=str, required=True, help="coleçaõ do banco a ser utilizada")
-    parser.add_argument('--url_saida', type=str, help="caminho para arquivo em que serão salvos os resultados")
+    parser.add_argument('--url_saida', type=str, help="caminho para arquivo em que serão salvos os resultados (padrão: <entrada>_respostas_llama.json)")
     parser.add_argument('--instrucao', type=str, help="instrucao a ser utilizada na função de embeddings")
+    parser.add_argument('--url_llama', type=str, default=URL_LLAMA, help="URL do Ollama (ou do servidor simulado de api.testes.ollama_simulado)")
+    parser.add_argument('--concorrencia', type=int, default=1, help="quantidade de requisições simultâneas ao Ollama")
+    parser.add_argument('--timeout', type=float, default=300, help="tempo máximo (s) de cada resposta, incluindo a transmissão")
+    parser.add_argument('--tentativas', type=int, default=3, help="tentativas por pergunta em caso de erro ou timeout")
 
     args = parser.parse_args()
     url_entrada = args.url_entrada
@@ -94,7 +205,11 @@ if __name__ == '__main__':
         nome_banco_vetores=nome_banco_vetores,
         nome_colecao=nome_colecao,
         url_arquivo_saida=url_saida,
-        instrucao=instrucao
+        instrucao=instrucao,
+        url_llama=args.url_llama,
+        concorrencia=args.concorrencia,
+        timeout_requisicao=args.timeout,
+        tentativas=args.tentativas
     ))
 # else:
 #     avaliar_respostas_llama(
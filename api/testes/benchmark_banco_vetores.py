@@ -0,0 +1,96 @@
+import argparse
+import multiprocessing
+import numpy as np
+import os
+
+from time import perf_counter
+
+URL_LOCAL = os.path.abspath(os.path.join(os.path.dirname(__file__), "./"))
+
+
+def obter_rss_mb():
+    # RSS atual do processo (Linux); em outros sistemas, o pico de RSS informado por resource
+    try:
+        with open('/proc/self/status', 'r') as arq:
+            for linha in arq:
+                if linha.startswith('VmRSS:'): return int(linha.split()[1]) / 1024
+    except FileNotFoundError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def medir_backend(backend, url_banco_vetores, nome_colecao, consultas, num_resultados, fila):
+    # Executado em um processo próprio, para que o RSS de um backend não contamine o do outro
+    rss_inicial = obter_rss_mb()
+    marcador_tempo_inicio = perf_counter()
+    if backend == 'numpy':
+        from ..utils.indice_numpy import IndiceVetoresNumpy, obter_url_indice
+        indice = IndiceVetoresNumpy(obter_url_indice(url_banco_vetores, nome_colecao))
+        consultar = lambda embedding: indice.consultar(embedding, num_resultados)
+    else:
+        from chromadb import chromadb
+        client = chromadb.PersistentClient(path=url_banco_vetores)
+        colecao = client.get_collection(name=nome_colecao)
+        consultar = lambda embedding: colecao.query(query_embeddings=[embedding], n_results=num_resultados)
+    # A primeira consulta faz parte da inicialização (carga do HNSW no ChromaDB, páginas do mmap no NumPy)
+    ids_primeira_consulta = consultar(consultas[0])['ids'][0]
+    tempo_inicializacao = perf_counter() - marcador_tempo_inicio
+
+    latencias = []
+    for embedding in consultas:
+        marcador_tempo_inicio = perf_counter()
+        consultar(embedding)
+        latencias.append(perf_counter() - marcador_tempo_inicio)
+    latencias = np.array(latencias) * 1000
+
+    fila.put({
+        'backend': backend,
+        'tempo_inicializacao_s': tempo_inicializacao,
+        'rss_mb': obter_rss_mb() - rss_inicial,
+        'latencia_media_ms': float(latencias.mean()),
+        'latencia_p50_ms': float(np.percentile(latencias, 50)),
+        'latencia_p95_ms': float(np.percentile(latencias, 95)),
+        'ids_primeira_consulta': ids_primeira_consulta
+    })
+
+
+def benchmark(nome_banco_vetores, nome_colecao, num_consultas=200, num_resultados=5, semente=0):
+    from ..utils.indice_numpy import IndiceVetoresNumpy, obter_url_indice
+
+    url_banco_vetores = os.path.join(URL_LOCAL, f"../conteudo/bancos_vetores/{nome_banco_vetores}")
+    # Consultas sintéticas: embeddings armazenados com ruído, para não depender do modelo de embeddings
+    indice = IndiceVetoresNumpy(obter_url_indice(url_banco_vetores, nome_colecao))
+    aleatorio = np.random.default_rng(semente)
+    base = np.asarray(indice.embeddings[aleatorio.integers(0, len(indice.embeddings), num_consultas)], dtype=np.float32)
+    consultas = (base + 0.05 * aleatorio.standard_normal(base.shape).astype(np.float32)).tolist()
+    del indice
+
+    contexto = multiprocessing.get_context('spawn')
+    resultados = []
+    for backend in ['chroma', 'numpy']:
+        fila = contexto.Queue()
+        processo = contexto.Process(target=medir_backend, args=(backend, url_banco_vetores, nome_colecao, consultas, num_resultados, fila))
+        processo.start()
+        resultados.append(fila.get())
+        processo.join()
+
+    print(f'{"backend":<8} {"inicialização (s)":>18} {"RSS (MB)":>10} {"média (ms)":>11} {"p50 (ms)":>9} {"p95 (ms)":>9}')
+    for resultado in resultados:
+        print(f'{resultado["backend"]:<8} {resultado["tempo_inicializacao_s"]:>18.3f} {resultado["rss_mb"]:>10.1f} '
+              f'{resultado["latencia_media_ms"]:>11.3f} {resultado["latencia_p50_ms"]:>9.3f} {resultado["latencia_p95_ms"]:>9.3f}')
+    # O HNSW é aproximado: a concordância dos resultados indica o quanto a busca exata difere dele
+    ids_chroma, ids_numpy = resultados[0]['ids_primeira_consulta'], resultados[1]['ids_primeira_consulta']
+    print(f'Concordância entre os top-{num_resultados} da primeira consulta: {len(set(ids_chroma) & set(ids_numpy))}/{num_resultados}')
+    return resultados
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compara latência e memória do ChromaDB com o índice NumPy em memória mapeada")
+
+    parser.add_argument('--nome_banco_vetores', type=str, required=True, help="nome do banco de vetores a ser consultado")
+    parser.add_argument('--nome_colecao', type=str, required=True, help="coleção do banco a ser utilizada (já exportada para NumPy)")
+    parser.add_argument('--num_consultas', type=int, default=200, help="quantidade de consultas medidas")
+    parser.add_argument('--num_resultados', type=int, default=5, help="quantidade de documentos por consulta")
+
+    args = parser.parse_args()
+    benchmark(args.nome_banco_vetores, args.nome_colecao, args.num_consultas, args.num_resultados)
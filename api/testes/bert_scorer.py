@@ -1,11 +1,121 @@
 print('Fazendo imports...')
 import argparse
+import hashlib
 import json
-from bert_score import score
+import os
+import torch
 
-def aplicar_score(url_arquivo_entrada, url_arquivo_saida=None):
+from bert_score.utils import get_bert_embedding, get_model, get_tokenizer, greedy_cos_idf, lang2model, model2layers
+from collections import defaultdict
+from torch.nn.utils.rnn import pad_sequence
+
+from .checkpoint_jsonl import salvar_json_atomico
+
+
+class BertScoreIncremental:
+    '''
+    BERTScore equivalente a bert_score.score (sem idf e sem rescale), mas com os embeddings de cada texto
+    calculados uma única vez: os textos repetidos são deduplicados, e os de um dos lados (as respostas do conjunto
+    de perguntas, que não mudam entre execuções) podem ser guardados em um cache em disco. Os lotes são montados
+    com textos de comprimento semelhante, para reduzir o padding.
+    '''
+    def __init__(self, lang: str='pt-br', model_type: str=None, num_layers: int=None, tamanho_lote: int=64,
+                 ordenar_por_comprimento: bool=True, url_cache_embeddings: str=None, device: str=None):
+        self.model_type = model_type or lang2model[lang.lower()]
+        self.num_layers = num_layers if num_layers is not None else model2layers[self.model_type]
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.tamanho_lote = tamanho_lote
+        self.ordenar_por_comprimento = ordenar_por_comprimento
+        self.url_cache_embeddings = url_cache_embeddings
+        self.cache_embeddings = self.carregar_cache()
+        self.cache_alterado = False
+        # O modelo só é carregado se algum texto não estiver no cache
+        self.modelo = None
+
+    def carregar_modelo(self):
+        self.tokenizador = get_tokenizer(self.model_type, use_fast=False)
+        self.modelo = get_model(self.model_type, self.num_layers)
+        self.modelo.to(self.device)
+        # Sem idf, como na chamada padrão de bert_score.score: peso 1 para todos os tokens, exceto [SEP] e [CLS]
+        self.idf_dict = defaultdict(lambda: 1.0)
+        self.idf_dict[self.tokenizador.sep_token_id] = 0
+        self.idf_dict[self.tokenizador.cls_token_id] = 0
+
+    def gerar_chave_texto(self, texto: str):
+        return hashlib.sha256(f'{self.model_type}\n{self.num_layers}\n{texto}'.encode('utf-8')).hexdigest()
+
+    def gerar_chave_par(self, candidato: str, referencia: str):
+        return hashlib.sha256(json.dumps([self.model_type, self.num_layers, candidato, referencia], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def carregar_cache(self):
+        if not self.url_cache_embeddings or not os.path.exists(self.url_cache_embeddings): return {}
+        return torch.load(self.url_cache_embeddings, weights_only=True)
+
+    def salvar_cache(self):
+        if not self.url_cache_embeddings or not self.cache_alterado: return
+        url_temporaria = self.url_cache_embeddings + '.tmp'
+        torch.save(self.cache_embeddings, url_temporaria)
+        os.replace(url_temporaria, self.url_cache_embeddings)
+        self.cache_alterado = False
+
+    def calcular_embeddings(self, textos: list, usar_cache: bool=False):
+        # Retorna, para cada texto distinto, os embeddings dos tokens e os pesos (idf) usados no casamento guloso
+        embeddings, pendentes = {}, []
+        for texto in set(textos):
+            chave = self.gerar_chave_texto(texto)
+            if usar_cache and chave in self.cache_embeddings: embeddings[texto] = self.cache_embeddings[chave]
+            else: pendentes.append(texto)
+        if not pendentes: return embeddings
+
+        if self.modelo is None: self.carregar_modelo()
+        if self.ordenar_por_comprimento: pendentes.sort(key=lambda texto: len(texto.split(' ')), reverse=True)
+        for inicio in range(0, len(pendentes), self.tamanho_lote):
+            lote = pendentes[inicio:inicio + self.tamanho_lote]
+            embs, mascaras, idfs = get_bert_embedding(lote, self.modelo, self.tokenizador, self.idf_dict, device=self.device)
+            embs, mascaras, idfs = embs.cpu(), mascaras.cpu(), idfs.cpu()
+            for idx, texto in enumerate(lote):
+                comprimento = mascaras[idx].sum().item()
+                # clone: sem ele, cada item guardaria (e o cache gravaria em disco) o tensor do lote inteiro
+                embeddings[texto] = (embs[idx, :comprimento].clone(), idfs[idx, :comprimento].clone())
+                if usar_cache:
+                    self.cache_embeddings[self.gerar_chave_texto(texto)] = embeddings[texto]
+                    self.cache_alterado = True
+        return embeddings
+
+    def preencher_lote(self, itens: list):
+        # Mesmo padding de bert_score: embeddings completados com 2.0 e máscara pelo comprimento de cada texto
+        embs, idfs = zip(*itens)
+        comprimentos = torch.tensor([emb.size(0) for emb in embs], dtype=torch.long)
+        mascara = torch.arange(comprimentos.max()).expand(len(itens), -1) < comprimentos.unsqueeze(1)
+        return (pad_sequence([emb.to(self.device) for emb in embs], batch_first=True, padding_value=2.0),
+                mascara.to(self.device),
+                pad_sequence([idf.to(self.device) for idf in idfs], batch_first=True))
+
+    def pontuar(self, candidatos: list, referencias: list, usar_cache_candidatos: bool=False, usar_cache_referencias: bool=False):
+        '''
+        Retorna precision, recall e f1 de cada par, na mesma ordem e com o mesmo significado de bert_score.score.
+        '''
+        embeddings_candidatos = self.calcular_embeddings(candidatos, usar_cache_candidatos)
+        embeddings_referencias = self.calcular_embeddings(referencias, usar_cache_referencias)
+
+        ordem = list(range(len(candidatos)))
+        if self.ordenar_por_comprimento:
+            ordem.sort(key=lambda idx: max(embeddings_candidatos[candidatos[idx]][0].size(0), embeddings_referencias[referencias[idx]][0].size(0)))
+        scores = torch.zeros(len(candidatos), 3)
+        with torch.no_grad():
+            for inicio in range(0, len(ordem), self.tamanho_lote):
+                lote = ordem[inicio:inicio + self.tamanho_lote]
+                P, R, F1 = greedy_cos_idf(
+                    *self.preencher_lote([embeddings_referencias[referencias[idx]] for idx in lote]),
+                    *self.preencher_lote([embeddings_candidatos[candidatos[idx]] for idx in lote]))
+                scores[lote] = torch.stack((P, R, F1), dim=-1).cpu()
+        return scores[:, 0], scores[:, 1], scores[:, 2]
+
+
+def aplicar_score(url_arquivo_entrada, url_arquivo_saida=None, tamanho_lote=64, ordenar_por_comprimento=True, url_cache_embeddings=None, model_type=None, num_layers=None):
     if not url_arquivo_saida: url_arquivo_saida = url_arquivo_entrada.split('.')[0] + '_bertscore.json'
-    
+    if not url_cache_embeddings: url_cache_embeddings = os.path.splitext(url_arquivo_saida)[0] + '_embeddings.pt'
+
     print(f'Carregando dados({url_arquivo_entrada})...')
     with open(url_arquivo_entrada, 'r') as arq:
         dados = json.load(arq)
@@ -22,28 +132,52 @@ def aplicar_score(url_arquivo_entrada, url_arquivo_saida=None):
             candidates.append(item['resposta'])
             references.append(item['llama']['response'])
 
-    print('Calculando BertScore...')
-    P, R, F1 = score(candidates, references, lang="pt-br", verbose=False)
+    scorer = BertScoreIncremental(lang="pt-br", model_type=model_type, num_layers=num_layers, tamanho_lote=tamanho_lote,
+                                  ordenar_por_comprimento=ordenar_por_comprimento, url_cache_embeddings=url_cache_embeddings)
+    chaves = [scorer.gerar_chave_par(candidato, referencia) for candidato, referencia in zip(candidates, references)]
+
+    # Resultados de execuções anteriores são reaproveitados pela chave do par (resultados sem chave são recalculados)
+    resultados_existentes = {}
+    if os.path.exists(url_arquivo_saida):
+        with open(url_arquivo_saida, 'r', encoding='utf-8') as arq:
+            resultados_existentes = {resultado['chave']: resultado for resultado in json.load(arq) if 'chave' in resultado}
+    pendentes = [i for i in range(len(candidates)) if chaves[i] not in resultados_existentes]
+    print(f'{len(candidates) - len(pendentes)} pares já calculados, {len(pendentes)} novos')
+
+    if pendentes:
+        print('Calculando BertScore...')
+        # As respostas do conjunto de perguntas não mudam entre execuções: os seus embeddings vão para o cache em disco
+        P, R, F1 = scorer.pontuar([candidates[i] for i in pendentes], [references[i] for i in pendentes], usar_cache_candidatos=True)
+        for posicao, i in enumerate(pendentes):
+            resultados_existentes[chaves[i]] = {'precision': P[posicao].item(), 'recall': R[posicao].item(), 'f1': F1[posicao].item()}
+        scorer.salvar_cache()
 
     resultado = [
         {
             'indice': indices[i],
-            'precision': P[i].item(),
-            'recall': R[i].item(),
-            'f1': F1[i].item()
+            'chave': chaves[i],
+            'precision': resultados_existentes[chaves[i]]['precision'],
+            'recall': resultados_existentes[chaves[i]]['recall'],
+            'f1': resultados_existentes[chaves[i]]['f1']
         } for i in range(len(candidates))]
-    
-    with open(url_arquivo_saida, 'w', encoding='utf-8') as arq:
-        json.dump(resultado, arq, ensure_ascii=False, indent=4)
-        
+
+    salvar_json_atomico(url_arquivo_saida, resultado)
+    print(f'Resultados salvos em {url_arquivo_saida}')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Gera resultados de busca por documentos a partir de uma lista de perguntas")
-    
+
     parser.add_argument('--url_entrada', type=str, required=True, help="caminho para arquivo com as perguntas")
     parser.add_argument('--url_saida', type=str, help="caminho para arquivo em que serão salvos os resultados")
-    
+    parser.add_argument('--tamanho_lote', type=int, default=64, help="textos por lote no cálculo dos embeddings e pares por lote no casamento")
+    parser.add_argument('--sem_ordenacao', action='store_true', help="não agrupa os textos por comprimento nos lotes")
+    parser.add_argument('--url_cache_embeddings', type=str, help="arquivo do cache de embeddings das respostas do conjunto de perguntas")
+    parser.add_argument('--modelo', type=str, help="modelo do BERTScore (padrão: o de bert_score para pt-br)")
+    parser.add_argument('--num_camadas', type=int, help="camada cujos embeddings são usados (obrigatório para modelos fora da tabela de bert_score)")
+
     args = parser.parse_args()
     url_entrada = args.url_entrada
     url_saida = None if not args.url_saida else args.url_saida
-    
-    aplicar_score(url_arquivo_entrada=url_entrada, url_arquivo_saida=url_saida)
\ No newline at end of file
+
+    aplicar_score(url_arquivo_entrada=url_entrada, url_arquivo_saida=url_saida, tamanho_lote=args.tamanho_lote,
+                  ordenar_por_comprimento=not args.sem_ordenacao, url_cache_embeddings=args.url_cache_embeddings, model_type=args.modelo, num_layers=args.num_camadas)
@@ -0,0 +1,120 @@
+import json
+import os
+
+from time import time
+
+
+def gerar_chave(*partes):
+    # Chave estável de um item avaliado (id do artigo, texto da pergunta...), independente da ordem de processamento
+    return '::'.join(str(parte) for parte in partes)
+
+
+# Chave reservada da linha de cabeçalho, com a configuração da execução que gerou o checkpoint
+CHAVE_CONFIGURACAO = '__configuracao__'
+
+
+class ConfiguracaoCheckpointDivergente(Exception):
+    def __init__(self, url_arquivo: str, configuracao_gravada, configuracao: dict):
+        super().__init__(
+            f'O checkpoint {url_arquivo} foi gerado com outra configuração ({configuracao_gravada}) e não pode ser '
+            f'retomado com {configuracao}. Informe outro arquivo de saída ou remova o checkpoint.')
+        self.configuracao_gravada = configuracao_gravada
+        self.configuracao = configuracao
+
+
+def salvar_json_atomico(url_arquivo: str, dados, indent: int=4):
+    # Grava em um arquivo temporário e o renomeia: uma interrupção nunca deixa o JSON final pela metade
+    url_temporaria = url_arquivo + '.tmp'
+    with open(url_temporaria, 'w', encoding='utf-8') as arq:
+        json.dump(dados, arq, indent=indent, ensure_ascii=False)
+        arq.flush()
+        os.fsync(arq.fileno())
+    os.replace(url_temporaria, url_arquivo)
+
+
+class CheckpointJsonl:
+    '''
+    Checkpoint de avaliações em JSONL, só com acréscimos: cada item concluído é uma linha {"chave", "registro"},
+    de modo que o custo de gravação é proporcional ao item, e não ao tamanho do resultado acumulado. As linhas
+    vão para o sistema operacional a cada item (sobrevivem à interrupção do processo), e o fsync é feito a cada
+    registros_por_fsync itens ou intervalo_fsync segundos. Ao reabrir, os itens já gravados são carregados para
+    retomar a execução; ao final, o resultado é compactado no JSON original com salvar_json_atomico.
+    Com configuracao (banco, coleção, instrução, modelo...), a primeira linha do checkpoint registra a configuração
+    da execução, e um checkpoint gerado com outra configuração (ou sem ela) é recusado com
+    ConfiguracaoCheckpointDivergente, em vez de ter os seus resultados reaproveitados.
+    '''
+    def __init__(self, url_arquivo: str, registros_por_fsync: int=50, intervalo_fsync: float=5.0, configuracao: dict=None):
+        self.url_arquivo = url_arquivo
+        self.registros_por_fsync = registros_por_fsync
+        self.intervalo_fsync = intervalo_fsync
+        self.configuracao = configuracao
+        self.registros = self.carregar()
+        configuracao_gravada = self.registros.pop(CHAVE_CONFIGURACAO, None)
+        if configuracao is not None and self.registros and configuracao_gravada != configuracao:
+            raise ConfiguracaoCheckpointDivergente(url_arquivo, configuracao_gravada, configuracao)
+        if os.path.dirname(url_arquivo): os.makedirs(os.path.dirname(url_arquivo), exist_ok=True)
+        self.arquivo = open(url_arquivo, 'a', encoding='utf-8')
+        self.pendentes_fsync = 0
+        self.instante_ultimo_fsync = time()
+        if configuracao is not None and configuracao_gravada != configuracao:
+            self.gravar(CHAVE_CONFIGURACAO, configuracao)
+            self.registros.pop(CHAVE_CONFIGURACAO)
+
+    def carregar(self):
+        registros = {}
+        if not os.path.exists(self.url_arquivo): return registros
+        with open(self.url_arquivo, 'rb') as arq:
+            conteudo = arq.read()
+        # Uma linha incompleta no final (interrupção durante a escrita) é descartada do arquivo
+        fim_ultima_linha = conteudo.rfind(b'\n') + 1
+        if fim_ultima_linha < len(conteudo):
+            with open(self.url_arquivo, 'r+b') as arq:
+                arq.truncate(fim_ultima_linha)
+        for linha in conteudo[:fim_ultima_linha].splitlines():
+            if not linha.strip(): continue
+            try:
+                item = json.loads(linha)
+            except json.JSONDecodeError:
+                continue
+            # Linhas posteriores substituem as anteriores da mesma chave
+            registros[item['chave']] = item['registro']
+        return registros
+
+    def __contains__(self, chave: str):
+        return chave in self.registros
+
+    def __len__(self):
+        return len(self.registros)
+
+    def obter(self, chave: str, padrao=None):
+        return self.registros.get(chave, padrao)
+
+    def gravar(self, chave: str, registro):
+        self.registros[chave] = registro
+        self.arquivo.write(json.dumps({'chave': chave, 'registro': registro}, ensure_ascii=False) + '\n')
+        self.arquivo.flush()
+        self.pendentes_fsync += 1
+        if self.pendentes_fsync >= self.registros_por_fsync or time() - self.instante_ultimo_fsync >= self.intervalo_fsync:
+            self.sincronizar()
+
+    def sincronizar(self):
+        if self.pendentes_fsync:
+            os.fsync(self.arquivo.fileno())
+        self.pendentes_fsync = 0
+        self.instante_ultimo_fsync = time()
+
+    def fechar(self):
+        if self.arquivo.closed: return
+        self.arquivo.flush()
+        self.sincronizar()
+        self.arquivo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fechar()
+
+
+def obter_url_checkpoint(url_arquivo_saida: str):
+    return os.path.splitext(url_arquivo_saida)[0] + '.checkpoint.jsonl'
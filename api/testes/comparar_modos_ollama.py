@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import numpy as np
+
+from time import perf_counter
+
+from .ollama_simulado import ServidorOllamaSimulado
+from ..utils.utils import InterfaceOllama
+
+DOCUMENTOS_EXEMPLO = [
+    'Regimento Interno - Art. 3º A legislatura é o período de quatro anos que coincide com a duração do mandato dos Deputados Estaduais.',
+    'Regimento Interno - Art. 10. A Mesa da Assembleia compõe-se de Presidente, três Vice-Presidentes e quatro Secretários.',
+    'Regimento Interno - Art. 57. As sessões ordinárias realizam-se de terça a quinta-feira, com início às dez horas.',
+    'Regime Jurídico - Art. 20. O servidor habilitado em concurso público e empossado em cargo de provimento efetivo adquire estabilidade após três anos de efetivo exercício.',
+    'Regime Jurídico - Art. 77. O servidor fará jus a trinta dias de férias, que podem ser acumuladas até o máximo de dois períodos.',
+    'Resolução Nº 78 - Art. 1º Fica instituído o programa de capacitação continuada dos servidores da Assembleia Legislativa.',
+    'Regime Jurídico - Art. 102. Além do vencimento, poderão ser pagas ao servidor as indenizações de ajuda de custo, diárias e transporte.',
+    'Regimento Interno - Art. 120. As comissões permanentes têm por finalidade apreciar os assuntos submetidos ao seu exame.',
+]
+PERGUNTAS_EXEMPLO = [
+    'O que é uma legislatura?',
+    'Quem compõe a Mesa da Assembleia?',
+    'Quando ocorrem as sessões ordinárias?',
+    'Quando o servidor adquire estabilidade?',
+    'Quantos dias de férias o servidor tem?',
+    'O que institui a Resolução Nº 78?',
+    'Quais indenizações podem ser pagas ao servidor?',
+    'Qual a finalidade das comissões permanentes?',
+]
+
+
+def montar_consultas(num_perguntas: int, documentos_por_pergunta: int=3):
+    # Cada pergunta recebe um conjunto diferente de documentos, como na recuperação real
+    consultas = []
+    for idx in range(num_perguntas):
+        documentos = [DOCUMENTOS_EXEMPLO[(idx + deslocamento) % len(DOCUMENTOS_EXEMPLO)] for deslocamento in range(documentos_por_pergunta)]
+        consultas.append((PERGUNTAS_EXEMPLO[idx % len(PERGUNTAS_EXEMPLO)], documentos))
+    return consultas
+
+
+async def medir_configuracao(url_llama: str, nome_modelo: str, modo: str, keep_alive, aquecer: bool, consultas: list, multi_turno: bool, pausa: float):
+    interface = InterfaceOllama(nome_modelo=nome_modelo, url_llama=url_llama, modo=modo)
+    interface.cliente_ollama.keep_alive = keep_alive
+    if aquecer: await interface.aquecer()
+
+    contexto = []
+    tempos_primeiro_token, tempos_totais = [], []
+    for pergunta, documentos in consultas:
+        marcador_tempo_inicio = perf_counter()
+        tempo_primeiro_token = None
+        async for fragmento in interface.gerar_resposta_llama(pergunta, documentos, contexto):
+            if tempo_primeiro_token is None and fragmento.get('response'): tempo_primeiro_token = perf_counter() - marcador_tempo_inicio
+            ultimo_fragmento = fragmento
+        tempos_totais.append(perf_counter() - marcador_tempo_inicio)
+        tempos_primeiro_token.append(tempo_primeiro_token if tempo_primeiro_token is not None else tempos_totais[-1])
+        if multi_turno: contexto = ultimo_fragmento.get('context') or []
+        # Pausa entre perguntas, para observar o efeito do keep_alive (descarga do modelo ociosa)
+        if pausa: await asyncio.sleep(pausa)
+    await interface.fechar()
+
+    tempos_primeiro_token = np.array(tempos_primeiro_token) * 1000
+    return {
+        'ttft_medio_ms': float(tempos_primeiro_token.mean()),
+        'ttft_p50_ms': float(np.percentile(tempos_primeiro_token, 50)),
+        'ttft_p95_ms': float(np.percentile(tempos_primeiro_token, 95)),
+        'ttft_max_ms': float(tempos_primeiro_token.max()),
+        'tempo_total_medio_ms': float(np.mean(tempos_totais) * 1000)
+    }
+
+
+async def comparar(url_llama: str=None, nome_modelo: str='simulado', num_perguntas: int=8, multi_turno: bool=False, pausa: float=0.0, keep_alive=-1, parametros_simulacao: dict=None):
+    # Modo atual (generate, sem keep_alive explícito nem aquecimento) contra as alternativas
+    configuracoes = [
+        ('generate', None, False),
+        ('generate', keep_alive, True),
+        ('chat', keep_alive, True),
+    ]
+    consultas = montar_consultas(num_perguntas)
+    resultados = []
+    for modo, keep_alive_configuracao, aquecer in configuracoes:
+        if url_llama:
+            resultado = await medir_configuracao(url_llama, nome_modelo, modo, keep_alive_configuracao, aquecer, consultas, multi_turno, pausa)
+        else:
+            # Um servidor simulado novo por configuração, com o modelo inicialmente descarregado
+            with ServidorOllamaSimulado(**(parametros_simulacao or {})) as servidor:
+                resultado = await medir_configuracao(servidor.url, nome_modelo, modo, keep_alive_configuracao, aquecer, consultas, multi_turno, pausa)
+                resultado['cargas_modelo'] = servidor.qtd_cargas_modelo
+        resultados.append({'modo': modo, 'keep_alive': keep_alive_configuracao, 'aquecimento': aquecer, **resultado})
+
+    print(f'{"modo":<9} {"keep_alive":>10} {"aquec.":>6} {"TTFT médio":>11} {"p50":>9} {"p95":>9} {"máx.":>9} {"total médio":>12} {"cargas":>7}')
+    for resultado in resultados:
+        print(f'{resultado["modo"]:<9} {str(resultado["keep_alive"]):>10} {"sim" if resultado["aquecimento"] else "não":>6} '
+              f'{resultado["ttft_medio_ms"]:>9.1f}ms {resultado["ttft_p50_ms"]:>7.1f}ms {resultado["ttft_p95_ms"]:>7.1f}ms {resultado["ttft_max_ms"]:>7.1f}ms '
+              f'{resultado["tempo_total_medio_ms"]:>10.1f}ms {str(resultado.get("cargas_modelo", "-")):>7}')
+    return resultados
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compara o tempo até o primeiro token (TTFT) dos modos generate e chat do Ollama")
+
+    parser.add_argument('--url_llama', type=str, help="URL de um Ollama real; sem ela, usa o servidor simulado")
+    parser.add_argument('--modelo', type=str, default='simulado', help="modelo do Ollama (ex.: llama3.1:8b)")
+    parser.add_argument('--num_perguntas', type=int, default=8, help="quantidade de perguntas por configuração")
+    parser.add_argument('--multi_turno', action='store_true', help="encadeia as perguntas em uma única conversa")
+    parser.add_argument('--pausa', type=float, default=0.0, help="pausa (s) entre perguntas")
+    parser.add_argument('--keep_alive', type=str, default='-1', help="keep_alive das configurações alternativas ('30m', segundos ou -1)")
+    parser.add_argument('--atraso_carga_modelo', type=float, default=2.0, help="simulação: tempo (s) de carga do modelo descarregado")
+    parser.add_argument('--atraso_prefill_por_caractere', type=float, default=0.0002, help="simulação: tempo (s) de prefill por caractere novo da entrada")
+    parser.add_argument('--keep_alive_padrao', type=float, default=300, help="simulação: keep_alive (s) quando a requisição não informa")
+
+    args = parser.parse_args()
+    keep_alive = int(args.keep_alive) if args.keep_alive.lstrip('-').isdigit() else args.keep_alive
+    asyncio.run(comparar(
+        url_llama=args.url_llama,
+        nome_modelo=args.modelo,
+        num_perguntas=args.num_perguntas,
+        multi_turno=args.multi_turno,
+        pausa=args.pausa,
+        keep_alive=keep_alive,
+        parametros_simulacao={
+            'atraso_carga_modelo': args.atraso_carga_modelo,
+            'atraso_prefill_por_caractere': args.atraso_prefill_por_caractere,
+            'keep_alive_padrao': args.keep_alive_padrao}))
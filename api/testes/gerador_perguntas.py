@@ -34,8 +34,11 @@ class GeradorPerguntas:
         self.NOME_COLECAO = nome_colecao
         self.DEVICE = device
 
+    def criar_prompt(self, artigo):
+        return '''Considere o artigo abaixo. Crie pelo menos 5 perguntas que possam ser respondidas com fragmentos do artigo. A saída deve ser uma lista de objetos JSON, com os atributos {{"pergunta": "Texto da pergunta Gerada", "resposta": "fragmento do artigo que responde a pergunta"}}. Não adicione nada na resposta, exceto a lista de objetos JSON, sem qualquer comentário adicional. ARTIGO: {}'''.format(artigo)
+
     def gerar_perguntas(self, artigo, contexto):
-        prompt = '''Considere o artigo abaixo. Crie pelo menos 5 perguntas que possam ser respondidas com fragmentos do artigo. A saída deve ser uma lista de objetos JSON, com os atributos {{"pergunta": "Texto da pergunta Gerada", "resposta": "fragmento do artigo que responde a pergunta"}}. Não adicione nada na resposta, exceto a lista de objetos JSON, sem qualquer comentário adicional. ARTIGO: {}'''.format(artigo)
+        prompt = self.criar_prompt(artigo)
         payload = {
             "model": MODELO_LLAMA,
             "prompt": prompt,
@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+
+TEXTO_RESPOSTA_PADRAO = ('De acordo com o Regimento Interno da ALRN, a legislatura é o período de quatro anos '
+                         'que coincide com a duração do mandato dos Deputados Estaduais.')
+
+
+def interpretar_keep_alive(keep_alive, padrao: float=300):
+    # Segundos, ou duração no formato do Ollama ('30s', '5m', '1h'); valores negativos mantêm o modelo carregado
+    if keep_alive is None: return padrao
+    if isinstance(keep_alive, (int, float)): return float('inf') if keep_alive < 0 else float(keep_alive)
+    correspondencia = re.fullmatch(r'(-?[\d.]+)([smh]?)', str(keep_alive).strip())
+    if not correspondencia: return padrao
+    valor = float(correspondencia.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[correspondencia.group(2)]
+    return float('inf') if valor < 0 else valor
+
+
+class ServidorOllamaSimulado:
+    '''
+    Servidor HTTP local que imita a API de streaming do Ollama (/api/generate e /api/chat), para testar os
+    clientes sem depender de um modelo real. O NDJSON é enviado em fragmentos de tamanho aleatório, que quebram e
+    juntam linhas, como pode ocorrer na rede.
+    Opcionalmente, simula os custos que definem o tempo até o primeiro token: a carga do modelo quando ele foi
+    descarregado (após o keep_alive da última requisição) e o prefill proporcional à parte da entrada que não
+    coincide com o início da entrada anterior (prefixo reaproveitado do cache KV).
+    '''
+    def __init__(self,
+                 host: str='127.0.0.1',
+                 porta: int=0,
+                 texto_resposta: str=TEXTO_RESPOSTA_PADRAO,
+                 atraso_primeiro_token: float=0.0,
+                 atraso_token: float=0.001,
+                 tamanho_max_fragmento: int=40,
+                 semente: int=0,
+                 atraso_carga_modelo: float=0.0,
+                 atraso_prefill_por_caractere: float=0.0,
+                 keep_alive_padrao: float=300,
+                 probabilidade_erro: float=0.0):
+        self.texto_resposta = texto_resposta
+        self.atraso_primeiro_token = atraso_primeiro_token
+        self.atraso_token = atraso_token
+        self.tamanho_max_fragmento = tamanho_max_fragmento
+        self.aleatorio = random.Random(semente)
+        self.requisicoes = []
+        self.atraso_carga_modelo = atraso_carga_modelo
+        self.atraso_prefill_por_caractere = atraso_prefill_por_caractere
+        self.keep_alive_padrao = keep_alive_padrao
+        # Fração das requisições respondidas com erro 500, para exercitar novas tentativas dos clientes
+        self.probabilidade_erro = probabilidade_erro
+        # Estado do "modelo": instante em que será descarregado e última entrada processada (cache KV)
+        self.instante_descarga = None
+        self.ultima_entrada = ''
+        self.qtd_cargas_modelo = 0
+        self.trava_modelo = threading.Lock()
+        self.servidor = ThreadingHTTPServer((host, porta), self.criar_manipulador())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, porta = self.servidor.server_address[:2]
+        return f'http://{host}:{porta}'
+
+    @staticmethod
+    def extrair_entrada(caminho: str, payload: dict):
+        if caminho == '/api/chat':
+            return ''.join(f"{mensagem.get('role')}: {mensagem.get('content')}\n" for mensagem in payload.get('messages') or [])
+        # No /api/generate, os tokens do contexto precedem o prompt
+        return ' '.join(map(str, payload.get('context') or [])) + (payload.get('prompt') or '')
+
+    def calcular_atraso_primeiro_token(self, caminho: str, payload: dict):
+        entrada = self.extrair_entrada(caminho, payload)
+        with self.trava_modelo:
+            atraso = self.atraso_primeiro_token
+            instante = time()
+            if self.instante_descarga is None or instante > self.instante_descarga:
+                # Modelo descarregado: carga e cache KV vazio
+                atraso += self.atraso_carga_modelo
+                self.ultima_entrada = ''
+                self.qtd_cargas_modelo += 1
+            prefixo_comum = os.path.commonprefix([self.ultima_entrada, entrada])
+            atraso += (len(entrada) - len(prefixo_comum)) * self.atraso_prefill_por_caractere
+            if entrada: self.ultima_entrada = entrada
+            self.instante_descarga = instante + atraso + interpretar_keep_alive(payload.get('keep_alive'), self.keep_alive_padrao)
+        return atraso
+
+    def gerar_linhas(self, payload: dict, caminho: str='/api/generate'):
+        tokens = [palavra + ' ' for palavra in self.texto_resposta.split(' ')]
+        num_predict = (payload.get('options') or {}).get('num_predict')
+        if num_predict: tokens = tokens[:num_predict]
+        for token in tokens:
+            if caminho == '/api/chat':
+                yield {'model': payload.get('model'), 'message': {'role': 'assistant', 'content': token}, 'done': False}
+            else:
+                yield {'model': payload.get('model'), 'response': token, 'done': False}
+        if caminho == '/api/chat':
+            yield {'model': payload.get('model'), 'message': {'role': 'assistant', 'content': ''}, 'done': True, 'eval_count': len(tokens)}
+            return
+        yield {
+            'model': payload.get('model'),
+            'response': '',
+            'done': True,
+            # O contexto devolvido é longo, como o do Ollama, para exercitar linhas grandes
+            'context': list(payload.get('context') or []) + list(range(1000)),
+            'eval_count': len(tokens)
+        }
+
+    def fragmentar(self, dados: bytes):
+        inicio = 0
+        while inicio < len(dados):
+            fim = inicio + self.aleatorio.randint(1, self.tamanho_max_fragmento)
+            yield dados[inicio:fim]
+            inicio = fim
+
+    def criar_manipulador(self):
+        servidor_simulado = self
+
+        class Manipulador(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def enviar_fragmento(self, dados: bytes):
+                self.wfile.write(f'{len(dados):X}\r\n'.encode() + dados + b'\r\n')
+                self.wfile.flush()
+
+            def do_POST(self):
+                tamanho = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(tamanho) or b'{}')
+                servidor_simulado.requisicoes.append({'caminho': self.path, 'payload': payload, 'instante': time()})
+
+                if self.path not in ['/api/generate', '/api/chat']:
+                    self.send_error(404)
+                    return
+                if servidor_simulado.probabilidade_erro and servidor_simulado.aleatorio.random() < servidor_simulado.probabilidade_erro:
+                    self.send_error(500)
+                    return
+
+                atraso_primeiro_token = servidor_simulado.calcular_atraso_primeiro_token(self.path, payload)
+                if payload.get('stream') is False or not (payload.get('prompt') or payload.get('messages')):
+                    # Requisição sem prompt (apenas carrega o modelo) ou sem streaming: um único JSON
+                    sleep(atraso_primeiro_token)
+                    corpo = json.dumps({'model': payload.get('model'), 'response': '', 'done': True}).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(corpo)))
+                    self.end_headers()
+                    self.wfile.write(corpo)
+                    self.wfile.flush()
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+
+                sleep(atraso_primeiro_token)
+                try:
+                    for linha in servidor_simulado.gerar_linhas(payload, self.path):
+                        dados = json.dumps(linha, ensure_ascii=False).encode('utf-8') + b'\n'
+                        for fragmento in servidor_simulado.fragmentar(dados):
+                            self.enviar_fragmento(fragmento)
+                        sleep(servidor_simulado.atraso_token)
+                    self.wfile.write(b'0\r\n\r\n')
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # Cliente desistiu da requisição (timeout): a transmissão é interrompida, como no Ollama
+                    self.close_connection = True
+
+        return Manipulador
+
+    def iniciar(self):
+        self.thread = threading.Thread(target=self.servidor.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def parar(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+    def __enter__(self):
+        return self.iniciar()
+
+    def __exit__(self, *args):
+        self.parar()
+
+
+async def verificar_cliente_ollama(num_requisicoes: int=20, concorrencia: int=5):
+    # Confere se o ClienteOllama recebe todos os tokens, reaproveitando um único pool de conexões
+    from ..utils.utils import ClienteOllama
+
+    with ServidorOllamaSimulado() as servidor:
+        cliente = ClienteOllama(nome_modelo='simulado', url_llama=servidor.url)
+        semaforo = asyncio.Semaphore(concorrencia)
+
+        async def consultar():
+            async with semaforo:
+                fragmentos = [fragmento async for fragmento in cliente.stream(prompt='teste', contexto=[1, 2, 3])]
+            texto = ''.join(fragmento['response'] for fragmento in fragmentos)
+            assert texto.strip() == servidor.texto_resposta, f'Resposta incompleta: {texto}'
+            assert fragmentos[-1]['done'] and fragmentos[-1]['context'][:3] == [1, 2, 3], 'Fragmento final inválido'
+            return len(fragmentos)
+
+        marcador_tempo_inicio = time()
+        qtd_fragmentos = await asyncio.gather(*[consultar() for _ in range(num_requisicoes)])
+        tempo_total = time() - marcador_tempo_inicio
+        await cliente.fechar()
+
+    print(f'{num_requisicoes} requisições concluídas em {tempo_total:.2f} segundos, '
+          f'{sum(qtd_fragmentos)} objetos NDJSON recebidos sem perdas')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Servidor local que simula a API de streaming do Ollama")
+
+    parser.add_argument('--porta', type=int, default=11435, help="porta em que o servidor simulado escuta")
+    parser.add_argument('--atraso_primeiro_token', type=float, default=0.0, help="atraso (s) antes do primeiro token")
+    parser.add_argument('--atraso_token', type=float, default=0.02, help="atraso (s) entre tokens")
+    parser.add_argument('--probabilidade_erro', type=float, default=0.0, help="fração das requisições respondidas com erro 500")
+    parser.add_argument('--verificar', action='store_true', help="executa a verificação do ClienteOllama contra o servidor simulado e encerra")
+
+    args = parser.parse_args()
+    if args.verificar:
+        asyncio.run(verificar_cliente_ollama())
+    else:
+        servidor = ServidorOllamaSimulado(porta=args.porta, atraso_primeiro_token=args.atraso_primeiro_token, atraso_token=args.atraso_token, probabilidade_erro=args.probabilidade_erro)
+        print(f'Ollama simulado escutando em {servidor.url}')
+        try:
+            servidor.servidor.serve_forever()
+        except KeyboardInterrupt:
+            servidor.parar()
@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import httpx
+import json
+import os
+
+from time import time
+
+from .checkpoint_jsonl import CheckpointJsonl, gerar_chave, obter_url_checkpoint, salvar_json_atomico
+
+URL_LOCAL = os.path.abspath(os.path.join(os.path.dirname(__file__), "./"))
+URL_LLAMA = 'http://localhost:11434'
+MODELO_LLAMA = 'llama3.1'
+
+
+def extrair_json(texto: str, abertura: str, fechamento: str):
+    # O Llama costuma cercar o JSON com comentários ou blocos ```json; considera-se o trecho entre o primeiro
+    # delimitador de abertura e o último de fechamento
+    inicio, fim = texto.find(abertura), texto.rfind(fechamento)
+    if inicio < 0 or fim < inicio: return None
+    try:
+        return json.loads(texto[inicio:fim + 1])
+    except json.JSONDecodeError:
+        return None
+
+
+def interpretar_perguntas(texto: str):
+    perguntas = extrair_json(texto, '[', ']')
+    if not isinstance(perguntas, list): return None
+    return [
+        {'pergunta': str(pergunta['pergunta']), 'resposta': str(pergunta.get('resposta', ''))}
+        for pergunta in perguntas if isinstance(pergunta, dict) and pergunta.get('pergunta')]
+
+
+def interpretar_validacao(texto: str):
+    validacao = extrair_json(texto, '{', '}')
+    if not isinstance(validacao, dict): return None
+    return {'coerente': validacao.get('coerente') is True, 'texto_responde': validacao.get('texto_responde') is True}
+
+
+def registro_concluido(registro):
+    # Respostas que não puderam ser interpretadas são refeitas na próxima execução, inclusive as gravadas por
+    # versões anteriores sob a chave normal (com o texto do Llama)
+    return registro is not None and registro.get('texto_llama') is None
+
+
+class EstatisticasEtapa:
+    # Itens concluídos, falhas e vazão de uma etapa; o tempo ocupado soma o de todos os workers da etapa
+    def __init__(self, nome: str):
+        self.nome = nome
+        self.concluidos = 0
+        self.reaproveitados = 0
+        self.falhas = 0
+        self.tempo_ocupado = 0.0
+        self.instante_inicio = None
+        self.instante_fim = None
+
+    def registrar(self, instante_inicio: float, falha: bool=False):
+        if self.instante_inicio is None: self.instante_inicio = instante_inicio
+        self.instante_fim = time()
+        self.tempo_ocupado += self.instante_fim - instante_inicio
+        if falha: self.falhas += 1
+        else: self.concluidos += 1
+
+    @property
+    def vazao(self):
+        if self.instante_inicio is None: return 0.0
+        return self.concluidos / max(self.instante_fim - self.instante_inicio, 1e-9)
+
+    def resumo(self):
+        return (f'{self.nome:<10} {self.concluidos:>10} {self.reaproveitados:>14} {self.falhas:>7} '
+                f'{self.vazao:>10.2f} {self.tempo_ocupado / max(self.concluidos + self.falhas, 1):>12.2f}')
+
+
+class PipelinePerguntas:
+    '''
+    Gera e valida o conjunto de perguntas sintéticas em uma única execução. Workers de geração pedem ao Llama as
+    perguntas de cada documento e as colocam, já interpretadas, em uma fila limitada, de onde workers de validação
+    as retiram; assim, a validação das primeiras perguntas começa enquanto os demais documentos ainda estão sendo
+    processados, e a fila cheia segura a geração quando a validação fica para trás. Cada resultado vai para um
+    checkpoint JSONL, e uma nova execução retoma de onde a anterior parou. Usa os mesmos prompts de
+    GeradorPerguntas e ValidadorPerguntas.
+    '''
+    def __init__(self,
+                 url_llama: str=URL_LLAMA,
+                 modelo_llama: str=MODELO_LLAMA,
+                 workers_geracao: int=2,
+                 workers_validacao: int=4,
+                 tamanho_fila: int=32,
+                 timeout_requisicao: float=300,
+                 tentativas: int=3):
+        from ..utils.utils import ClienteOllama
+        from .gerador_perguntas import GeradorPerguntas
+        from .validador_perguntas import ValidadorPerguntas
+
+        self.cliente_ollama = ClienteOllama(nome_modelo=modelo_llama, url_llama=url_llama, max_conexoes=workers_geracao + workers_validacao)
+        self.gerador = GeradorPerguntas(modelo_llama=modelo_llama)
+        self.validador = ValidadorPerguntas(modelo_llama=modelo_llama)
+        self.workers_geracao = workers_geracao
+        self.workers_validacao = workers_validacao
+        self.tamanho_fila = tamanho_fila
+        self.timeout_requisicao = timeout_requisicao
+        self.tentativas = tentativas
+
+    async def consultar_llama(self, prompt: str):
+        async def transmitir():
+            texto = ''
+            async for fragmento in self.cliente_ollama.stream(prompt=prompt, contexto=[]):
+                texto += fragmento.get('response', '')
+            return texto
+
+        # O timeout vale para a transmissão inteira; entre as tentativas, espera exponencial (1s, 2s, 4s...)
+        for tentativa in range(self.tentativas):
+            try:
+                return await asyncio.wait_for(transmitir(), timeout=self.timeout_requisicao)
+            except (asyncio.TimeoutError, httpx.HTTPError):
+                if tentativa == self.tentativas - 1: raise
+                await asyncio.sleep(2 ** tentativa)
+
+    async def executar(self, documentos: list, checkpoint: CheckpointJsonl):
+        estatisticas = {'geracao': EstatisticasEtapa('geração'), 'validacao': EstatisticasEtapa('validação')}
+        fila_documentos = asyncio.Queue()
+        for documento in documentos: fila_documentos.put_nowait(documento)
+        fila_perguntas = asyncio.Queue(maxsize=self.tamanho_fila)
+
+        async def gerar():
+            while True:
+                try:
+                    documento = fila_documentos.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                chave = gerar_chave('geracao', documento['id'])
+                if registro_concluido(checkpoint.obter(chave)):
+                    estatisticas['geracao'].reaproveitados += 1
+                else:
+                    instante_inicio = time()
+                    try:
+                        texto = await self.consultar_llama(self.gerador.criar_prompt(documento['page_content']))
+                    except (asyncio.TimeoutError, httpx.HTTPError) as erro:
+                        print(f'\nDocumento {documento["id"]}: geração falhou ({type(erro).__name__})')
+                        estatisticas['geracao'].registrar(instante_inicio, falha=True)
+                        continue
+                    perguntas = interpretar_perguntas(texto)
+                    estatisticas['geracao'].registrar(instante_inicio, falha=perguntas is None)
+                    if perguntas is None:
+                        # Respostas que não são uma lista JSON ficam registradas à parte, para inspeção, e o
+                        # documento é gerado novamente na próxima execução
+                        checkpoint.gravar(gerar_chave('falha_geracao', documento['id']), {'texto_llama': texto})
+                        continue
+                    checkpoint.gravar(chave, {'perguntas': perguntas})
+                documento['perguntas'] = [dict(pergunta) for pergunta in checkpoint.obter(chave)['perguntas']]
+                for pergunta in documento['perguntas']:
+                    # Fila cheia: a geração espera a validação (contrapressão)
+                    await fila_perguntas.put((documento, pergunta))
+
+        async def validar():
+            while True:
+                item = await fila_perguntas.get()
+                if item is None: return
+                documento, pergunta = item
+                chave = gerar_chave('validacao', documento['id'], pergunta['pergunta'])
+                if registro_concluido(checkpoint.obter(chave)):
+                    estatisticas['validacao'].reaproveitados += 1
+                else:
+                    instante_inicio = time()
+                    try:
+                        texto = await self.consultar_llama(self.validador.criar_prompt(documento['page_content'], pergunta['pergunta']))
+                    except (asyncio.TimeoutError, httpx.HTTPError) as erro:
+                        print(f'\nDocumento {documento["id"]}: validação falhou ({type(erro).__name__})')
+                        estatisticas['validacao'].registrar(instante_inicio, falha=True)
+                        continue
+                    validacao = interpretar_validacao(texto)
+                    estatisticas['validacao'].registrar(instante_inicio, falha=validacao is None)
+                    if validacao is None:
+                        # Como na geração: texto guardado à parte e pergunta validada novamente na próxima execução
+                        checkpoint.gravar(gerar_chave('falha_validacao', documento['id'], pergunta['pergunta']), {'texto_llama': texto})
+                        continue
+                    checkpoint.gravar(chave, validacao)
+                pergunta['validacao'] = checkpoint.obter(chave)
+                relatar_progresso()
+
+        def relatar_progresso():
+            geracao, validacao = estatisticas['geracao'], estatisticas['validacao']
+            print(f'\rDocumentos: {geracao.concluidos + geracao.reaproveitados + geracao.falhas} de {len(documentos)} | '
+                  f'perguntas validadas: {validacao.concluidos + validacao.reaproveitados} | '
+                  f'na fila: {fila_perguntas.qsize()}', end='')
+
+        async def gerar_todos():
+            await asyncio.gather(*[gerar() for _ in range(self.workers_geracao)])
+            # Um marcador de fim por worker de validação, depois de todas as perguntas
+            for _ in range(self.workers_validacao): await fila_perguntas.put(None)
+
+        tarefas = [asyncio.create_task(gerar_todos())] + [asyncio.create_task(validar()) for _ in range(self.workers_validacao)]
+        try:
+            await asyncio.gather(*tarefas)
+        finally:
+            # Um erro inesperado em uma etapa não pode deixar a outra esperando a fila indefinidamente
+            for tarefa in tarefas: tarefa.cancel()
+            await self.cliente_ollama.fechar()
+
+        print(f'\n{"etapa":<10} {"concluídos":>10} {"reaproveitados":>14} {"falhas":>7} {"itens/s":>10} {"s por item":>12}')
+        for etapa in estatisticas.values(): print(etapa.resumo())
+        return estatisticas
+
+
+def carregar_documentos(url_documentos: str=None, nome_banco_vetores: str=None, nome_colecao: str=None):
+    # Documentos de um JSON já exportado (lista de {id, page_content, metadata}) ou diretamente da coleção
+    if url_documentos:
+        with open(url_documentos, 'r', encoding='utf-8') as arq:
+            documentos = json.load(arq)
+        return documentos['dados'] if isinstance(documentos, dict) else documentos
+
+    from chromadb import chromadb
+    url_banco_vetores = os.path.join(URL_LOCAL, f"../conteudo/bancos_vetores/{nome_banco_vetores}")
+    client = chromadb.PersistentClient(path=url_banco_vetores)
+    registros = client.get_collection(name=nome_colecao).get()
+    return [{'id': id_documento, 'page_content': texto, 'metadata': metadados}
+            for id_documento, texto, metadados in zip(registros['ids'], registros['documents'], registros['metadatas'])]
+
+
+async def gerar_conjunto_perguntas(url_arquivo_saida, url_documentos=None, nome_banco_vetores=None, nome_colecao=None,
+                                   descartar_invalidas=False, **kwargs):
+    documentos = carregar_documentos(url_documentos, nome_banco_vetores, nome_colecao)
+    documentos = [{'id': documento['id'], 'page_content': documento['page_content'], 'metadata': documento['metadata']} for documento in documentos]
+    print(f'{len(documentos)} documentos')
+
+    url_checkpoint = obter_url_checkpoint(url_arquivo_saida)
+    pipeline = PipelinePerguntas(**kwargs)
+    with CheckpointJsonl(url_checkpoint) as checkpoint:
+        print(f'Checkpoint em {url_checkpoint} ({len(checkpoint)} resultados já registrados)')
+        try:
+            estatisticas = await pipeline.executar(documentos, checkpoint)
+        finally:
+            # Mesmo formato lido por avaliar_recuperacao_documentos e avaliar_recuperacao_lote
+            for documento in documentos:
+                perguntas = documento.get('perguntas', [])
+                if descartar_invalidas:
+                    perguntas = [pergunta for pergunta in perguntas
+                                 if pergunta.get('validacao', {}).get('coerente') and pergunta['validacao'].get('texto_responde')]
+                documento['perguntas'] = perguntas
+            salvar_json_atomico(url_arquivo_saida, {'dados': documentos})
+            print(f'Resultados salvos em {url_arquivo_saida}')
+    return estatisticas
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Gera e valida perguntas sintéticas sobre os documentos em um único pipeline assíncrono")
+
+    parser.add_argument('--url_saida', type=str, required=True, help="arquivo JSON do conjunto de perguntas gerado")
+    parser.add_argument('--url_documentos', type=str, help="JSON com os documentos (lista de {id, page_content, metadata})")
+    parser.add_argument('--nome_banco_vetores', type=str, help="banco de vetores de onde ler os documentos, se --url_documentos não for informado")
+    parser.add_argument('--nome_colecao', type=str, help="coleção do banco de vetores")
+    parser.add_argument('--url_llama', type=str, default=URL_LLAMA, help="URL do Ollama (ou do servidor simulado de api.testes.ollama_simulado)")
+    parser.add_argument('--modelo_llama', type=str, default=MODELO_LLAMA, help="modelo do Ollama")
+    parser.add_argument('--workers_geracao', type=int, default=2, help="requisições simultâneas de geração")
+    parser.add_argument('--workers_validacao', type=int, default=4, help="requisições simultâneas de validação")
+    parser.add_argument('--tamanho_fila', type=int, default=32, help="perguntas aguardando validação antes que a geração espere")
+    parser.add_argument('--timeout', type=float, default=300, help="tempo máximo (s) de cada resposta do Llama")
+    parser.add_argument('--tentativas', type=int, default=3, help="tentativas por requisição em caso de erro ou timeout")
+    parser.add_argument('--descartar_invalidas', action='store_true', help="mantém na saída apenas perguntas coerentes e respondidas pelo texto")
+
+    args = parser.parse_args()
+    if not args.url_documentos and not (args.nome_banco_vetores and args.nome_colecao):
+        parser.error('informe --url_documentos ou --nome_banco_vetores e --nome_colecao')
+    asyncio.run(gerar_conjunto_perguntas(
+        url_arquivo_saida=args.url_saida,
+        url_documentos=args.url_documentos,
+        nome_banco_vetores=args.nome_banco_vetores,
+        nome_colecao=args.nome_colecao,
+        descartar_invalidas=args.descartar_invalidas,
+        url_llama=args.url_llama,
+        modelo_llama=args.modelo_llama,
+        workers_geracao=args.workers_geracao,
+        workers_validacao=args.workers_validacao,
+        tamanho_fila=args.tamanho_fila,
+        timeout_requisicao=args.timeout,
+        tentativas=args.tentativas))
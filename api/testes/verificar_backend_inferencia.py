@@ -0,0 +1,173 @@
+import argparse
+import json
+import numpy as np
+import os
+
+from time import perf_counter
+
+from .avaliar_recuperacao_lote import buscar_chroma, normalizar
+
+URL_LOCAL = os.path.abspath(os.path.join(os.path.dirname(__file__), "./"))
+NOMES_SCORES = ['score', 'score_pipeline', 'score_estimado']
+EMBEDDING_INSTRUCTOR="hkunlp/instructor-xl"
+
+
+def abrir_colecao(nome_banco_vetores, nome_colecao):
+    from chromadb import chromadb
+
+    url_banco_vetores = os.path.join(URL_LOCAL, f"../conteudo/bancos_vetores/{nome_banco_vetores}")
+    return chromadb.PersistentClient(path=url_banco_vetores).get_collection(name=nome_colecao)
+
+
+def carregar_perguntas(url_arquivo_resultados, colecao, num_perguntas=None):
+    # Os resultados de avaliar_recuperacao_documentos guardam só os ids dos documentos; os textos vêm da coleção
+    with open(url_arquivo_resultados, 'r') as arq:
+        perguntas = [pergunta for pergunta in json.load(arq) if pergunta.get('documentos')]
+    if num_perguntas: perguntas = perguntas[:num_perguntas]
+
+    ids = list({documento['id'] for pergunta in perguntas for documento in pergunta['documentos']})
+    registros = colecao.get(ids=ids, include=['documents'])
+    textos = dict(zip(registros['ids'], registros['documents']))
+    for pergunta in perguntas:
+        pergunta['documentos'] = [documento for documento in pergunta['documentos'] if documento['id'] in textos]
+        for documento in pergunta['documentos']:
+            documento['conteudo'] = textos[documento['id']]
+    return perguntas
+
+
+def medir_reranker(reranker, perguntas):
+    scores, latencias = [], []
+    # A primeira chamada (alocações, otimização do grafo no ONNX Runtime) não entra nas latências
+    reranker.calcular_scores(perguntas[0]['pergunta'], [documento['conteudo'] for documento in perguntas[0]['documentos']])
+    for pergunta in perguntas:
+        marcador_tempo_inicio = perf_counter()
+        resultados = reranker.calcular_scores(pergunta['pergunta'], [documento['conteudo'] for documento in pergunta['documentos']])
+        latencias.append(perf_counter() - marcador_tempo_inicio)
+        scores.append(np.array([resultado['score'] for resultado in resultados], dtype=np.float64))
+    return scores, np.array(latencias) * 1000
+
+
+def comparar_scores(scores_referencia, scores):
+    # Diferença absoluta de cada score e concordância do documento mais bem avaliado por cada um deles
+    comparacao = {}
+    for idx, nome in enumerate(NOMES_SCORES):
+        diferencas = np.concatenate([np.abs(referencia[:, idx] - atual[:, idx]) for referencia, atual in zip(scores_referencia, scores)])
+        concordancia_top1 = np.mean([referencia[:, idx].argmax() == atual[:, idx].argmax() for referencia, atual in zip(scores_referencia, scores)])
+        comparacao[nome] = {'dif_max': float(diferencas.max()), 'dif_media': float(diferencas.mean()), 'concordancia_top1': float(concordancia_top1)}
+    return comparacao
+
+
+def verificar_bert(perguntas, backends, nome_modelo, url_modelo_onnx):
+    from ..utils.reranker_bert import RerankerBert
+
+    print(f'{len(perguntas)} perguntas, {sum(len(pergunta["documentos"]) for pergunta in perguntas)} documentos')
+    # Scores registrados na avaliação original (fp32), que servem de referência para todos os backends
+    scores_registrados = [np.array([documento['score_bert'] for documento in pergunta['documentos']], dtype=np.float64) for pergunta in perguntas]
+
+    resultados = {}
+    for backend in backends:
+        print(f'Medindo backend {backend}...')
+        reranker = RerankerBert(nome_modelo, device='cpu', backend=backend, url_modelo_onnx=url_modelo_onnx)
+        scores, latencias = medir_reranker(reranker, perguntas)
+        resultados[backend] = {
+            'latencia_media_ms': float(latencias.mean()),
+            'latencia_p50_ms': float(np.percentile(latencias, 50)),
+            'latencia_p95_ms': float(np.percentile(latencias, 95)),
+            'comparacao': comparar_scores(scores_registrados, scores)
+        }
+        del reranker
+
+    print(f'{"backend":<8} {"média (ms)":>11} {"p50 (ms)":>9} {"p95 (ms)":>9}   {"score":<16} {"dif. máx.":>10} {"dif. média":>11} {"top-1":>7}')
+    for backend, resultado in resultados.items():
+        for idx, nome in enumerate(NOMES_SCORES):
+            comparacao = resultado['comparacao'][nome]
+            tempos = f'{resultado["latencia_media_ms"]:>11.2f} {resultado["latencia_p50_ms"]:>9.2f} {resultado["latencia_p95_ms"]:>9.2f}' if idx == 0 else ' ' * 31
+            print(f'{backend if idx == 0 else "":<8} {tempos}   {nome:<16} {comparacao["dif_max"]:>10.4f} {comparacao["dif_media"]:>11.4f} {comparacao["concordancia_top1"]:>7.1%}')
+    return resultados
+
+
+def medir_embeddings(funcao_de_embeddings, textos):
+    # Uma pergunta por chamada, como nas consultas da API; a primeira chamada não entra nas latências
+    funcao_de_embeddings.gerar_embeddings(textos[:1])
+    embeddings, latencias = [], []
+    for texto in textos:
+        marcador_tempo_inicio = perf_counter()
+        embeddings.append(funcao_de_embeddings.gerar_embeddings([texto])[0])
+        latencias.append(perf_counter() - marcador_tempo_inicio)
+    return np.asarray(embeddings, dtype=np.float32), np.array(latencias) * 1000
+
+
+def comparar_embeddings(embeddings_referencia, embeddings, ids_referencia, ids):
+    # Cosseno entre o embedding de cada pergunta e o de referência (fp32), e fração dos ids recuperados em comum
+    cossenos = np.sum(normalizar(embeddings_referencia) * normalizar(embeddings), axis=1)
+    sobreposicao = np.array([len(set(referencia) & set(atual)) / max(len(referencia), 1) for referencia, atual in zip(ids_referencia, ids)])
+    concordancia_top1 = np.mean([referencia[:1] == atual[:1] for referencia, atual in zip(ids_referencia, ids)])
+    return {'cosseno_min': float(cossenos.min()), 'cosseno_medio': float(cossenos.mean()),
+            'sobreposicao_top_k': float(sobreposicao.mean()), 'concordancia_top1': float(concordancia_top1)}
+
+
+def verificar_embeddings(textos, colecao, backends, instrucao, num_resultados):
+    '''
+    Compara os embeddings das perguntas em cada backend com os do torch em fp32: cosseno com o embedding de
+    referência e sobreposição dos num_resultados ids recuperados da coleção com cada um deles.
+    '''
+    from sentence_transformers import SentenceTransformer
+    from ..utils.utils import FuncaoEmbeddings
+
+    num_resultados = min(num_resultados, colecao.count())
+    resultados, referencia = {}, None
+    # A referência vem primeiro, para que os demais backends sejam comparados a ela
+    for backend in ['torch'] + [backend for backend in backends if backend != 'torch']:
+        print(f'Medindo embeddings no backend {backend}...')
+        funcao_de_embeddings = FuncaoEmbeddings(nome_modelo=EMBEDDING_INSTRUCTOR, tipo_modelo=SentenceTransformer, device='cpu', instrucao=instrucao, backend_inferencia=backend)
+        embeddings, latencias = medir_embeddings(funcao_de_embeddings, textos)
+        ids = buscar_chroma(colecao, embeddings, num_resultados)
+        if referencia is None: referencia = (embeddings, ids)
+        resultados[backend] = {
+            'latencia_media_ms': float(latencias.mean()),
+            'latencia_p50_ms': float(np.percentile(latencias, 50)),
+            'latencia_p95_ms': float(np.percentile(latencias, 95)),
+            'comparacao': comparar_embeddings(referencia[0], embeddings, referencia[1], ids)
+        }
+        del funcao_de_embeddings
+
+    print(f'{"backend":<8} {"média (ms)":>11} {"p50 (ms)":>9} {"p95 (ms)":>9} {"cos. mín.":>10} {"cos. médio":>11} {f"top-{num_resultados}":>8} {"top-1":>7}')
+    for backend, resultado in resultados.items():
+        comparacao = resultado['comparacao']
+        print(f'{backend:<8} {resultado["latencia_media_ms"]:>11.2f} {resultado["latencia_p50_ms"]:>9.2f} {resultado["latencia_p95_ms"]:>9.2f} '
+              f'{comparacao["cosseno_min"]:>10.4f} {comparacao["cosseno_medio"]:>11.4f} {comparacao["sobreposicao_top_k"]:>8.1%} {comparacao["concordancia_top1"]:>7.1%}')
+    return resultados
+
+
+def verificar(url_arquivo_resultados, nome_banco_vetores, nome_colecao, backends, nome_modelo, url_modelo_onnx, num_perguntas=None,
+              modelos=('bert', 'embeddings'), instrucao="Represent the legislative document for retrieval:", num_resultados=5):
+    colecao = abrir_colecao(nome_banco_vetores, nome_colecao)
+    perguntas = carregar_perguntas(url_arquivo_resultados, colecao, num_perguntas)
+    resultados = {}
+    if 'bert' in modelos:
+        resultados['bert'] = verificar_bert(perguntas, backends, nome_modelo, url_modelo_onnx)
+    if 'embeddings' in modelos:
+        print(f'{len(perguntas)} perguntas, {num_resultados} documentos recuperados por pergunta')
+        resultados['embeddings'] = verificar_embeddings([pergunta['pergunta'] for pergunta in perguntas], colecao, backends, instrucao, num_resultados)
+    return resultados
+
+
+if __name__ == '__main__':
+    from ..environment.environment import environment
+
+    parser = argparse.ArgumentParser(description="Compara scores do Bert, embeddings das perguntas e latência nos backends de inferência com o torch em fp32")
+
+    parser.add_argument('--url_resultados', type=str, required=True, help="arquivo *_recup_docs.json gerado por avaliar_recuperacao_documentos")
+    parser.add_argument('--nome_banco_vetores', type=str, required=True, help="nome do banco de vetores usado na avaliação")
+    parser.add_argument('--nome_colecao', type=str, required=True, help="coleção do banco usada na avaliação")
+    parser.add_argument('--backends', type=str, nargs='+', default=['torch', 'int8', 'onnx'], help="backends a serem comparados")
+    parser.add_argument('--nome_modelo', type=str, default=environment.EMBEDDING_SQUAD_PORTUGUESE, help="modelo Bert de perguntas e respostas")
+    parser.add_argument('--url_modelo_onnx', type=str, default=environment.URL_MODELO_BERT_ONNX, help="modelo exportado com api.utils.inferencia_otimizada")
+    parser.add_argument('--num_perguntas', type=int, help="limita a quantidade de perguntas avaliadas")
+    parser.add_argument('--modelos', type=str, nargs='+', choices=['bert', 'embeddings'], default=['bert', 'embeddings'], help="modelos a serem verificados")
+    parser.add_argument('--instrucao', type=str, default="Represent the legislative document for retrieval:", help="instrução da função de embeddings ('' para nenhuma)")
+    parser.add_argument('--num_resultados', type=int, default=5, help="documentos recuperados por pergunta na comparação dos embeddings")
+
+    args = parser.parse_args()
+    verificar(args.url_resultados, args.nome_banco_vetores, args.nome_colecao, args.backends, args.nome_modelo, args.url_modelo_onnx, args.num_perguntas,
+              args.modelos, args.instrucao or None, args.num_resultados)
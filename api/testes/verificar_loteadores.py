@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ..utils.loteador_embeddings import LoteadorEmbeddings
+from ..utils.servidor_modelos import LoteadorScoresBert
+
+
+class FuncaoEmbeddingsSimulada:
+    # O embedding de cada texto é o seu tamanho, o que permite conferir a resposta de cada requisição
+    cache = None
+    nome_modelo = 'simulado'
+    instrucao = None
+
+    def gerar_embeddings(self, textos):
+        return [[float(len(texto))] for texto in textos]
+
+
+class RerankerBertSimulado:
+    def calcular_scores_pares(self, perguntas, textos):
+        return [{'pergunta': pergunta, 'score': float(len(texto))} for pergunta, texto in zip(perguntas, textos)]
+
+
+async def interromper_processamento(*args):
+    raise KeyError('falha simulada no processamento do lote')
+
+
+async def verificar_encerramento(loteador, requisitar, tempo_max_resposta: float=1.0):
+    '''
+    Confere que nenhuma requisição fica sem resposta quando a tarefa de processamento do loteador morre
+    com um erro inesperado ou é cancelada por fechar com requisições ainda na fila.
+    '''
+    # Lote normal
+    resultados = await asyncio.gather(*[requisitar(loteador, 'a' * idx) for idx in range(1, 7)])
+    assert resultados == [requisitar.esperado('a' * idx) for idx in range(1, 7)], f'Resultados inválidos: {resultados}'
+
+    # Tarefa encerrada por um erro inesperado: o lote em andamento e a fila recebem o erro da tarefa
+    processar_lote = loteador.processar_lote
+    loteador.processar_lote = interromper_processamento
+    resultados = await asyncio.gather(
+        *[asyncio.wait_for(requisitar(loteador, f'x{idx}'), tempo_max_resposta) for idx in range(6)], return_exceptions=True)
+    assert all(isinstance(resultado, KeyError) for resultado in resultados), f'Requisições sem o erro da tarefa: {resultados}'
+
+    # A próxima requisição reinicia a tarefa
+    loteador.processar_lote = processar_lote
+    resultado = await asyncio.wait_for(requisitar(loteador, 'abc'), tempo_max_resposta)
+    assert resultado == requisitar.esperado('abc'), f'Resultado inválido após reiniciar: {resultado}'
+
+    # fechar com requisições na fila
+    tarefas = [asyncio.ensure_future(requisitar(loteador, f'y{idx}')) for idx in range(3)]
+    await asyncio.sleep(0)
+    await loteador.fechar()
+    resultados = await asyncio.wait_for(asyncio.gather(*tarefas, return_exceptions=True), tempo_max_resposta)
+    assert all(isinstance(resultado, RuntimeError) for resultado in resultados), f'Requisições sem resposta após fechar: {resultados}'
+
+
+async def requisitar_embedding(loteador, texto):
+    return await loteador.gerar_embedding(texto)
+requisitar_embedding.esperado = lambda texto: [float(len(texto))]
+
+
+async def requisitar_scores(loteador, texto):
+    return await loteador.calcular_scores('pergunta', [texto, texto])
+requisitar_scores.esperado = lambda texto: [{'pergunta': 'pergunta', 'score': float(len(texto))}] * 2
+
+
+async def verificar_loteadores(tamanho_max_lote: int=4, tempo_max_espera_ms: float=5):
+    with ThreadPoolExecutor(2) as executor:
+        loteador_embeddings = LoteadorEmbeddings(FuncaoEmbeddingsSimulada(), executor, tempo_max_espera_ms, tamanho_max_lote)
+        await verificar_encerramento(loteador_embeddings, requisitar_embedding)
+        print(f'LoteadorEmbeddings: {loteador_embeddings.estatisticas()}')
+
+        # Lotes de 4 pares com requisições de 2 pares: a requisição guardada para o próximo lote também é encerrada
+        loteador_scores = LoteadorScoresBert(RerankerBertSimulado(), executor, tempo_max_espera_ms, tamanho_max_lote)
+        await verificar_encerramento(loteador_scores, requisitar_scores)
+        print(f'LoteadorScoresBert: {loteador_scores.estatisticas()}')
+    print('Todas as requisições receberam resultado ou erro')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Verifica que os loteadores de embeddings e de scores do Bert não deixam requisições sem resposta")
+
+    parser.add_argument('--tamanho_max_lote', type=int, default=4, help="tamanho máximo do lote (textos ou pares pergunta/documento)")
+    parser.add_argument('--tempo_max_espera_ms', type=float, default=5, help="janela de espera (ms) para completar um lote")
+
+    args = parser.parse_args()
+    asyncio.run(verificar_loteadores(args.tamanho_max_lote, args.tempo_max_espera_ms))
@@ -0,0 +1,181 @@
+import asyncio
+import math
+
+from collections import deque
+from time import monotonic
+from typing import AsyncIterator
+
+
+class RejeicaoAdmissao(Exception):
+    '''
+    Requisição recusada pelo controle de admissão: 429 quando a fila está cheia, 503 quando o tempo máximo
+    de espera na fila se esgota (ou, na entrada, quando a espera estimada já o excede). Na entrada da requisição
+    (verificar_entrada), vira uma resposta HTTP com esse status e o cabeçalho Retry-After; na vaga pedida antes
+    da geração do Llama (admitir), vira um evento 'erro' do stream. retry_after é a sugestão, em segundos.
+    '''
+    def __init__(self, status_code: int, motivo: str, retry_after: int):
+        super().__init__(motivo)
+        self.status_code = status_code
+        self.motivo = motivo
+        self.retry_after = retry_after
+
+
+class PrazoExcedido(Exception):
+    def __init__(self, etapa: str, prazo: float):
+        super().__init__(f'Prazo de {prazo} segundos excedido na etapa "{etapa}"')
+        self.etapa = etapa
+        self.prazo = prazo
+
+
+class PermissaoAdmissao:
+    '''
+    Vaga concedida pelo ControladorAdmissao. liberar pode ser chamado mais de uma vez (fim do stream,
+    encerramento antecipado), mas a vaga só é devolvida uma vez.
+    '''
+    def __init__(self, controlador: 'ControladorAdmissao'):
+        self.controlador = controlador
+        self.instante_inicio = monotonic()
+        self.liberada = False
+
+    def liberar(self):
+        if self.liberada: return
+        self.liberada = True
+        self.controlador.liberar(monotonic() - self.instante_inicio)
+
+    async def envolver(self, iterador: AsyncIterator):
+        # Devolve a vaga ao fim do iterador, em caso de erro, cancelamento ou quando ele é fechado antes do fim;
+        # o iterador de origem é fechado junto, interrompendo a geração
+        try:
+            async for item in iterador:
+                yield item
+        finally:
+            self.liberar()
+            if hasattr(iterador, 'aclose'): await iterador.aclose()
+
+
+class ControladorAdmissao:
+    '''
+    Limita o número de gerações simultâneas enviadas ao Ollama. Requisições além do limite esperam em uma
+    fila FIFO limitada, por no máximo tempo_max_fila segundos; com a fila cheia, a recusa é imediata. Assim,
+    uma rajada de requisições é descartada de forma controlada, em vez de fazer todas excederem o timeout.
+    '''
+    def __init__(self, max_concorrentes: int=4, tamanho_max_fila: int=16, tempo_max_fila: float=30):
+        self.max_concorrentes = max_concorrentes
+        self.tamanho_max_fila = tamanho_max_fila
+        self.tempo_max_fila = tempo_max_fila
+        self.em_execucao = 0
+        # Futures das requisições em espera, na ordem de chegada
+        self.fila = deque()
+
+        # Métricas
+        self.qtd_admitidas = 0
+        self.qtd_rejeitadas_fila_cheia = 0
+        self.qtd_rejeitadas_tempo_fila = 0
+        self.tempo_total_espera = 0.0
+        self.tempo_max_espera = 0.0
+        self.qtd_concluidas = 0
+        self.tempo_total_execucao = 0.0
+
+    def estimar_espera(self):
+        # Tempo para esvaziar a fila atual, pela duração média das gerações já concluídas
+        duracao_media = self.tempo_total_execucao / self.qtd_concluidas if self.qtd_concluidas else self.tempo_max_fila
+        return duracao_media * (len(self.fila) + 1) / self.max_concorrentes
+
+    def estimar_retry_after(self):
+        return max(1, math.ceil(self.estimar_espera()))
+
+    def verificar_entrada(self):
+        '''
+        Recusa a requisição na chegada, antes de embedding, busca e Bert, quando ela não conseguiria uma vaga de
+        geração: fila cheia (429) ou espera estimada, pela duração média das gerações, acima de tempo_max_fila
+        (503). Não reserva vaga; a requisição aceita ainda pede a sua com admitir, antes da geração do Llama.
+        '''
+        if self.em_execucao < self.max_concorrentes and not self.fila: return
+        if len(self.fila) >= self.tamanho_max_fila:
+            self.qtd_rejeitadas_fila_cheia += 1
+            raise RejeicaoAdmissao(429, 'Fila de atendimento cheia', self.estimar_retry_after())
+        if self.qtd_concluidas and self.estimar_espera() > self.tempo_max_fila:
+            self.qtd_rejeitadas_tempo_fila += 1
+            raise RejeicaoAdmissao(503, 'Tempo estimado de espera na fila excede o máximo', self.estimar_retry_after())
+
+    def registrar_admissao(self, tempo_espera: float):
+        self.qtd_admitidas += 1
+        self.tempo_total_espera += tempo_espera
+        self.tempo_max_espera = max(self.tempo_max_espera, tempo_espera)
+
+    async def admitir(self):
+        if self.em_execucao < self.max_concorrentes and not self.fila:
+            self.em_execucao += 1
+            self.registrar_admissao(0.0)
+            return PermissaoAdmissao(self)
+
+        if len(self.fila) >= self.tamanho_max_fila:
+            self.qtd_rejeitadas_fila_cheia += 1
+            raise RejeicaoAdmissao(429, 'Fila de atendimento cheia', self.estimar_retry_after())
+
+        futuro = asyncio.get_running_loop().create_future()
+        self.fila.append(futuro)
+        instante_chegada = monotonic()
+        try:
+            await asyncio.wait({futuro}, timeout=self.tempo_max_fila)
+        except asyncio.CancelledError:
+            # Cliente desconectado durante a espera: devolve a vaga, se já tiver sido concedida
+            if futuro.done(): self.liberar(None)
+            else: self.fila.remove(futuro)
+            raise
+
+        if not futuro.done():
+            self.fila.remove(futuro)
+            self.qtd_rejeitadas_tempo_fila += 1
+            raise RejeicaoAdmissao(503, 'Tempo máximo de espera na fila excedido', self.estimar_retry_after())
+
+        self.registrar_admissao(monotonic() - instante_chegada)
+        return PermissaoAdmissao(self)
+
+    def liberar(self, duracao: float=None):
+        if duracao is not None:
+            self.qtd_concluidas += 1
+            self.tempo_total_execucao += duracao
+        # A vaga passa diretamente para a próxima requisição da fila, sem alterar em_execucao
+        while self.fila:
+            futuro = self.fila.popleft()
+            if not futuro.done():
+                futuro.set_result(None)
+                return
+        self.em_execucao -= 1
+
+    def estatisticas(self):
+        return {
+            'max_concorrentes': self.max_concorrentes,
+            'em_execucao': self.em_execucao,
+            'tamanho_fila': len(self.fila),
+            'tamanho_max_fila': self.tamanho_max_fila,
+            'admitidas': self.qtd_admitidas,
+            'rejeitadas_fila_cheia': self.qtd_rejeitadas_fila_cheia,
+            'rejeitadas_tempo_fila': self.qtd_rejeitadas_tempo_fila,
+            'tempo_medio_espera_fila': self.tempo_total_espera / self.qtd_admitidas if self.qtd_admitidas else 0.0,
+            'tempo_max_espera_fila': self.tempo_max_espera,
+            'tempo_medio_execucao': self.tempo_total_execucao / self.qtd_concluidas if self.qtd_concluidas else 0.0
+        }
+
+
+async def iterar_com_prazos(iterador: AsyncIterator, prazo_primeiro_item: float=None, prazo_total: float=None):
+    # Repassa os itens do iterador, encerrando-o com PrazoExcedido se o primeiro item ou o conjunto demorarem demais
+    instante_inicio = monotonic()
+    primeiro_item = True
+    while True:
+        prazos = {'total': prazo_total}
+        if primeiro_item: prazos['primeiro_item'] = prazo_primeiro_item
+        prazos = {etapa: prazo for etapa, prazo in prazos.items() if prazo}
+        etapa = min(prazos, key=prazos.get) if prazos else None
+        tempo_restante = prazos[etapa] - (monotonic() - instante_inicio) if etapa else None
+        try:
+            if tempo_restante is not None and tempo_restante <= 0: raise asyncio.TimeoutError()
+            item = await asyncio.wait_for(iterador.__anext__(), tempo_restante)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            await iterador.aclose()
+            raise PrazoExcedido(etapa, prazos[etapa])
+        primeiro_item = False
+        yield item
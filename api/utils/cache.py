@@ -0,0 +1,208 @@
+import hashlib
+import json
+import numpy as np
+import os
+import pickle
+import re
+import threading
+import unicodedata
+
+from collections import OrderedDict
+from time import time
+
+
+class CacheEmbeddings:
+    '''
+    Cache LRU de embeddings de consultas, seguro para uso por várias threads, com expiração por tempo (TTL)
+    e persistência opcional em disco, para que sobreviva a reinicializações da API.
+    '''
+    def __init__(self, tamanho_maximo: int=10000, ttl: float=None, url_arquivo: str=None, fazer_log: bool=True):
+        self.tamanho_maximo = tamanho_maximo
+        self.ttl = ttl
+        self.url_arquivo = url_arquivo
+        # chave -> (instante de inclusão, embedding); a ordem de inserção é a ordem de uso (LRU)
+        self.itens = OrderedDict()
+        self.trava = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+
+        if self.url_arquivo and os.path.exists(self.url_arquivo):
+            self.carregar()
+            if fazer_log: print(f'--- cache de embeddings carregado de {self.url_arquivo} ({len(self.itens)} itens)')
+
+    @staticmethod
+    def normalizar_texto(texto: str):
+        # Variações de espaçamento e de composição Unicode não alteram a consulta
+        return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', texto)).strip()
+
+    def gerar_chave(self, nome_modelo: str, instrucao: str, texto: str):
+        return (nome_modelo, instrucao or '', self.normalizar_texto(texto))
+
+    def expirado(self, instante_inclusao: float):
+        return bool(self.ttl) and time() - instante_inclusao > self.ttl
+
+    def obter(self, chave: tuple):
+        with self.trava:
+            item = self.itens.get(chave)
+            if item is None or self.expirado(item[0]):
+                if item is not None: del self.itens[chave]
+                self.falhas += 1
+                return None
+            self.itens.move_to_end(chave)
+            self.acertos += 1
+            return item[1]
+
+    def incluir(self, chave: tuple, embedding: list):
+        with self.trava:
+            self.itens[chave] = (time(), embedding)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.tamanho_maximo:
+                self.itens.popitem(last=False)
+
+    def limpar(self):
+        with self.trava:
+            self.itens.clear()
+
+    def estatisticas(self):
+        with self.trava:
+            total = self.acertos + self.falhas
+            return {
+                'tamanho': len(self.itens),
+                'tamanho_maximo': self.tamanho_maximo,
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'taxa_acerto': self.acertos / total if total else 0.0
+            }
+
+    def salvar(self, url_arquivo: str=None):
+        url_arquivo = url_arquivo or self.url_arquivo
+        with self.trava:
+            itens = [(chave, item) for chave, item in self.itens.items() if not self.expirado(item[0])]
+        # Escrita em arquivo temporário seguida de substituição, para não corromper o cache existente
+        url_temporaria = f'{url_arquivo}.tmp'
+        with open(url_temporaria, 'wb') as arq:
+            pickle.dump(itens, arq, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(url_temporaria, url_arquivo)
+
+    def carregar(self, url_arquivo: str=None):
+        url_arquivo = url_arquivo or self.url_arquivo
+        with open(url_arquivo, 'rb') as arq:
+            itens = pickle.load(arq)
+        with self.trava:
+            for chave, item in itens:
+                if not self.expirado(item[0]): self.itens[chave] = item
+            while len(self.itens) > self.tamanho_maximo:
+                self.itens.popitem(last=False)
+
+
+class CacheRespostas:
+    '''
+    Cache semântico de respostas completas. Uma pergunta é considerada repetida quando seu embedding tem
+    similaridade de cosseno igual ou superior ao limiar em relação a uma pergunta já respondida, dentro do
+    mesmo contexto de conversa. O cache é esvaziado sempre que a versão da coleção de documentos muda.
+    Os embeddings ficam em uma matriz pré-alocada (uma linha por posição), e as posições liberadas por remoções
+    são reaproveitadas; assim, cada consulta é um único produto matriz-vetor, sem montar a matriz novamente.
+    '''
+    def __init__(self, tamanho_maximo: int=1000, limiar_similaridade: float=0.97, ttl: float=None):
+        self.tamanho_maximo = tamanho_maximo
+        self.limiar_similaridade = limiar_similaridade
+        self.ttl = ttl
+        # id da entrada -> {'chave_contexto', 'posicao', 'instante', 'resposta'}; ordem de uso (LRU)
+        self.entradas = OrderedDict()
+        self.proximo_id = 0
+        self.versao_colecao = None
+        self.trava = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+        self.invalidacoes = 0
+        # A matriz é alocada na primeira inclusão, quando a dimensão dos embeddings é conhecida
+        self.matriz = None
+        self.limpar_posicoes()
+
+    def limpar_posicoes(self):
+        self.entradas.clear()
+        # Por posição da matriz: id da entrada (-1 se livre) e chave de contexto (None se livre)
+        self.ids_por_posicao = np.full(self.tamanho_maximo, -1, dtype=np.int64)
+        self.chaves_por_posicao = np.full(self.tamanho_maximo, None, dtype=object)
+        self.posicoes_livres = list(range(self.tamanho_maximo - 1, -1, -1))
+
+    @staticmethod
+    def gerar_chave_contexto(contexto: list):
+        return hashlib.sha1(json.dumps(contexto or [], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def normalizar_embedding(embedding):
+        vetor = np.asarray(embedding, dtype=np.float32)
+        norma = np.linalg.norm(vetor)
+        return vetor / norma if norma > 0 else vetor
+
+    def verificar_versao_colecao(self, versao_colecao):
+        with self.trava:
+            if versao_colecao != self.versao_colecao:
+                if self.versao_colecao is not None:
+                    self.limpar_posicoes()
+                    self.invalidacoes += 1
+                self.versao_colecao = versao_colecao
+
+    def invalidar(self):
+        with self.trava:
+            self.limpar_posicoes()
+            self.invalidacoes += 1
+
+    def remover_entrada(self, id_entrada: int):
+        entrada = self.entradas.pop(id_entrada)
+        self.ids_por_posicao[entrada['posicao']] = -1
+        self.chaves_por_posicao[entrada['posicao']] = None
+        self.posicoes_livres.append(entrada['posicao'])
+
+    def obter(self, embedding: list, contexto: list):
+        vetor = self.normalizar_embedding(embedding)
+        chave_contexto = self.gerar_chave_contexto(contexto)
+        with self.trava:
+            if self.ttl:
+                expiradas = [id_entrada for id_entrada, entrada in self.entradas.items() if time() - entrada['instante'] > self.ttl]
+                for id_entrada in expiradas: self.remover_entrada(id_entrada)
+
+            candidatas = self.chaves_por_posicao == chave_contexto
+            if self.matriz is not None and candidatas.any():
+                similaridades = np.where(candidatas, self.matriz @ vetor, -np.inf)
+                melhor = int(similaridades.argmax())
+                if similaridades[melhor] >= self.limiar_similaridade:
+                    id_entrada = int(self.ids_por_posicao[melhor])
+                    self.entradas.move_to_end(id_entrada)
+                    self.acertos += 1
+                    return self.entradas[id_entrada]['resposta'], float(similaridades[melhor])
+            self.falhas += 1
+            return None
+
+    def incluir(self, embedding: list, contexto: list, resposta: dict):
+        vetor = self.normalizar_embedding(embedding)
+        with self.trava:
+            if self.matriz is None: self.matriz = np.zeros((self.tamanho_maximo, len(vetor)), dtype=np.float32)
+            # Cache cheio: a entrada menos usada recentemente libera a sua posição
+            if not self.posicoes_livres: self.remover_entrada(next(iter(self.entradas)))
+            posicao = self.posicoes_livres.pop()
+            chave_contexto = self.gerar_chave_contexto(contexto)
+            self.matriz[posicao] = vetor
+            self.ids_por_posicao[posicao] = self.proximo_id
+            self.chaves_por_posicao[posicao] = chave_contexto
+            self.entradas[self.proximo_id] = {
+                'chave_contexto': chave_contexto,
+                'posicao': posicao,
+                'instante': time(),
+                'resposta': resposta
+            }
+            self.proximo_id += 1
+
+    def estatisticas(self):
+        with self.trava:
+            total = self.acertos + self.falhas
+            return {
+                'tamanho': len(self.entradas),
+                'tamanho_maximo': self.tamanho_maximo,
+                'limiar_similaridade': self.limiar_similaridade,
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'invalidacoes': self.invalidacoes,
+                'taxa_acerto': self.acertos / total if total else 0.0
+            }
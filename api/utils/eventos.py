@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+from contextlib import aclosing
+from time import monotonic
+from typing import AsyncIterator
+
+
+async def agrupar_tokens(eventos: AsyncIterator[dict], tamanho_max: int=64, intervalo_max_ms: float=50):
+    '''
+    Agrupa eventos 'token' consecutivos em um só, enviado quando o texto acumulado atinge tamanho_max
+    caracteres ou quando o primeiro fragmento acumulado já espera há intervalo_max_ms, mesmo que o próximo
+    evento ainda não tenha chegado. O primeiro token é enviado imediatamente. Qualquer outro evento envia
+    antes o texto pendente, preservando a ordem.
+    '''
+    iterador = eventos.__aiter__()
+    texto_pendente = []
+    tamanho_pendente = 0
+    instante_primeiro_token = None
+    primeiro_token_enviado = False
+    # Leitura do próximo evento em andamento: quando o prazo do texto pendente vence, o texto é enviado e
+    # a mesma leitura continua sendo aguardada (cancelá-la interromperia o gerador de origem)
+    proxima_leitura = None
+    try:
+        while True:
+            if proxima_leitura is None: proxima_leitura = asyncio.ensure_future(iterador.__anext__())
+            tempo_restante = None
+            if texto_pendente:
+                tempo_restante = max(0, intervalo_max_ms / 1000 - (monotonic() - instante_primeiro_token))
+            concluidas, _ = await asyncio.wait({proxima_leitura}, timeout=tempo_restante)
+            if not concluidas:
+                yield {'tipo': 'token', 'texto': ''.join(texto_pendente)}
+                texto_pendente, tamanho_pendente = [], 0
+                continue
+
+            leitura, proxima_leitura = proxima_leitura, None
+            try:
+                evento = leitura.result()
+            except StopAsyncIteration:
+                break
+
+            if evento['tipo'] == 'token':
+                if not primeiro_token_enviado:
+                    primeiro_token_enviado = True
+                    yield evento
+                    continue
+                if not texto_pendente: instante_primeiro_token = monotonic()
+                texto_pendente.append(evento['texto'])
+                tamanho_pendente += len(evento['texto'])
+                if tamanho_pendente >= tamanho_max:
+                    yield {'tipo': 'token', 'texto': ''.join(texto_pendente)}
+                    texto_pendente, tamanho_pendente = [], 0
+                continue
+
+            if texto_pendente:
+                yield {'tipo': 'token', 'texto': ''.join(texto_pendente)}
+                texto_pendente, tamanho_pendente = [], 0
+            yield evento
+
+        if texto_pendente:
+            yield {'tipo': 'token', 'texto': ''.join(texto_pendente)}
+    finally:
+        # Encerrado antes do fim (cliente desconectado): a leitura pendente é cancelada e a origem, fechada
+        if proxima_leitura is not None:
+            proxima_leitura.cancel()
+            await asyncio.wait({proxima_leitura})
+        if hasattr(iterador, 'aclose'): await iterador.aclose()
+
+
+async def serializar_ndjson(eventos: AsyncIterator[dict]):
+    # Um objeto JSON por linha: quebras de linha no texto são escapadas pelo JSON, então cada linha é um evento completo
+    async with aclosing(eventos):
+        async for evento in eventos:
+            if evento['tipo'] == 'fim':
+                # Os documentos e tempos já foram enviados nos próprios eventos
+                evento = {'tipo': 'fim', 'dados': {chave: valor for chave, valor in evento['dados'].items() if chave != 'documentos'}}
+            yield json.dumps(evento, ensure_ascii=False) + '\n'
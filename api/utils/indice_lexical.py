@@ -0,0 +1,127 @@
+import argparse
+import json
+import math
+import numpy as np
+import os
+import re
+import unicodedata
+
+from typing import List
+
+# Palavras muito frequentes, que não ajudam a distinguir documentos
+STOPWORDS = set('''a o as os um uma uns umas de do da dos das no na nos nas em ao aos à às e ou que se por para pelo pela pelos
+pelas com sem sob sobre é ser são foi como mais menos seu sua seus suas lhe lhes este esta estes estas esse essa esses essas
+isso isto aquele aquela qual quais quando onde qual quem cujo cuja já não sim também até entre após desde'''.split())
+
+
+def remover_acentos(texto: str):
+    return unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii')
+
+STOPWORDS_SEM_ACENTOS = {remover_acentos(palavra) for palavra in STOPWORDS}
+
+
+def obter_url_indice_bm25(url_banco_vetores: str, colecao_de_documentos: str):
+    # O índice lexical fica ao lado do banco de vetores gerado sobre os mesmos fragmentos
+    return os.path.join(url_banco_vetores, 'indice_bm25', f'{colecao_de_documentos}.json')
+
+
+def tokenizar(texto: str):
+    # Marcadores ordinais ("Art. 5º", "Nº 78") são removidos para que o número case com "Art. 5" e "78"
+    texto = remover_acentos(re.sub(r'[º°ª]', ' ', texto.lower()))
+    return [termo for termo in re.findall(r'[a-z0-9]+', texto) if termo not in STOPWORDS_SEM_ACENTOS]
+
+
+def fundir_por_rrf(listas_de_ids: List[List[str]], k: int=60):
+    # Reciprocal-rank fusion: cada lista contribui com 1 / (k + posição) para cada id
+    scores = {}
+    for lista in listas_de_ids:
+        for posicao, id_documento in enumerate(lista, start=1):
+            scores[id_documento] = scores.get(id_documento, 0.0) + 1.0 / (k + posicao)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class IndiceBM25:
+    '''
+    Índice invertido com ranqueamento BM25, gerado sobre os mesmos fragmentos do banco de vetores. Cobre
+    perguntas que citam termos exatos ("Art. 57", "Resolução Nº 78"), em que a busca densa costuma falhar.
+    '''
+    def __init__(self, ids: List[str], documentos: List[str], metadados: List[dict], k1: float=1.5, b: float=0.75):
+        self.ids = ids
+        self.documentos = documentos
+        self.metadados = metadados
+        self.k1 = k1
+        self.b = b
+        self.posicao_por_id = {id_documento: idx for idx, id_documento in enumerate(ids)}
+
+        # termo -> (índices dos documentos, frequências do termo nesses documentos)
+        postagens = {}
+        comprimentos = []
+        for idx, documento in enumerate(documentos):
+            termos = tokenizar(documento)
+            comprimentos.append(len(termos))
+            frequencias = {}
+            for termo in termos: frequencias[termo] = frequencias.get(termo, 0) + 1
+            for termo, frequencia in frequencias.items():
+                postagens.setdefault(termo, ([], []))
+                postagens[termo][0].append(idx)
+                postagens[termo][1].append(frequencia)
+        self.postagens = {termo: (np.array(indices, dtype=np.int32), np.array(frequencias, dtype=np.float32)) for termo, (indices, frequencias) in postagens.items()}
+        self.comprimentos = np.array(comprimentos, dtype=np.float32)
+        self.comprimento_medio = float(self.comprimentos.mean()) if len(comprimentos) else 0.0
+        qtd_documentos = len(documentos)
+        self.idf = {termo: math.log((qtd_documentos - len(indices) + 0.5) / (len(indices) + 0.5) + 1) for termo, (indices, _) in self.postagens.items()}
+
+    def consultar(self, termos_de_consulta: str, num_resultados: int):
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        normalizacao = self.k1 * (1 - self.b + self.b * self.comprimentos / (self.comprimento_medio or 1.0))
+        for termo in set(tokenizar(termos_de_consulta)):
+            if termo not in self.postagens: continue
+            indices, frequencias = self.postagens[termo]
+            scores[indices] += self.idf[termo] * frequencias * (self.k1 + 1) / (frequencias + normalizacao[indices])
+
+        candidatos = np.flatnonzero(scores)
+        if len(candidatos) > num_resultados:
+            candidatos = candidatos[np.argpartition(-scores[candidatos], num_resultados - 1)[:num_resultados]]
+        candidatos = candidatos[np.argsort(-scores[candidatos])]
+        return [(self.ids[idx], float(scores[idx])) for idx in candidatos]
+
+    def obter_documento(self, id_documento: str):
+        idx = self.posicao_por_id[id_documento]
+        return self.documentos[idx], self.metadados[idx]
+
+    def salvar(self, url_arquivo: str):
+        os.makedirs(os.path.dirname(url_arquivo), exist_ok=True)
+        with open(f'{url_arquivo}.tmp', 'w', encoding='utf-8') as arq:
+            json.dump({'ids': self.ids, 'documents': self.documentos, 'metadatas': self.metadados, 'k1': self.k1, 'b': self.b}, arq, ensure_ascii=False)
+        os.replace(f'{url_arquivo}.tmp', url_arquivo)
+
+    @classmethod
+    def carregar(cls, url_arquivo: str):
+        # Somente os fragmentos são persistidos; o índice invertido é reconstruído na carga, em poucos segundos
+        with open(url_arquivo, 'r', encoding='utf-8') as arq:
+            dados = json.load(arq)
+        return cls(dados['ids'], dados['documents'], dados['metadatas'], dados['k1'], dados['b'])
+
+    @classmethod
+    def gerar_de_colecao(cls, colecao, url_arquivo: str):
+        registros = colecao.get(include=['documents', 'metadatas'])
+        indice = cls(registros['ids'], registros['documents'], registros['metadatas'])
+        indice.salvar(url_arquivo)
+        return indice
+
+
+if __name__ == '__main__':
+    from chromadb import chromadb
+
+    parser = argparse.ArgumentParser(description="Gera o índice BM25 de uma coleção existente do ChromaDB")
+
+    parser.add_argument('--nome_banco_vetores', type=str, required=True, help="nome do banco de vetores (pasta em conteudo/bancos_vetores)")
+    parser.add_argument('--nome_colecao', type=str, required=True, help="coleção a ser indexada")
+
+    args = parser.parse_args()
+    url_banco_vetores = os.path.join(os.path.dirname(__file__), '../conteudo/bancos_vetores', args.nome_banco_vetores)
+    client = chromadb.PersistentClient(path=url_banco_vetores)
+    url_indice = obter_url_indice_bm25(url_banco_vetores, args.nome_colecao)
+    indice = IndiceBM25.gerar_de_colecao(client.get_collection(name=args.nome_colecao), url_indice)
+    client._system.stop()
+    print(f'Índice BM25 com {len(indice.ids)} fragmentos salvo em {url_indice}')
@@ -0,0 +1,146 @@
+import argparse
+import json
+import numpy as np
+import os
+
+from typing import List
+
+from api.environment.environment import environment
+
+ARQUIVO_EMBEDDINGS = 'embeddings.npy'
+ARQUIVO_METADADOS = 'metadados.json'
+# Quantidade de linhas convertidas para float32 por vez quando a matriz está em float16
+TAMANHO_BLOCO_FLOAT16 = 8192
+
+
+def obter_url_indice(url_banco_vetores: str, colecao_de_documentos: str):
+    # O índice fica ao lado do banco do ChromaDB de onde foi exportado
+    return os.path.join(url_banco_vetores, 'indice_numpy', colecao_de_documentos)
+
+
+class IndiceVetoresNumpy:
+    '''
+    Índice de vetores em memória mapeada. Os embeddings normalizados ficam em uma matriz .npy (float32 ou
+    float16) e os ids, textos e metadados em um arquivo JSON ao lado. Uma consulta é um único produto
+    matriz-vetor seguido de argpartition; como a matriz é aberta com mmap, as páginas são compartilhadas
+    entre os workers do uvicorn pelo cache de páginas do sistema operacional.
+    '''
+    def __init__(self, url_indice: str):
+        self.url_indice = url_indice
+        self.url_embeddings = os.path.join(url_indice, ARQUIVO_EMBEDDINGS)
+        self.embeddings = np.load(self.url_embeddings, mmap_mode='r')
+        with open(os.path.join(url_indice, ARQUIVO_METADADOS), 'r', encoding='utf-8') as arq:
+            dados = json.load(arq)
+        self.ids = dados['ids']
+        self.documentos = dados['documents']
+        self.metadados = dados['metadatas']
+        self.posicao_por_id = {id_documento: idx for idx, id_documento in enumerate(self.ids)}
+
+    def calcular_similaridades(self, vetor: np.ndarray):
+        if self.embeddings.dtype == np.float32:
+            return self.embeddings @ vetor
+        # Em float16 não há BLAS: a conversão é feita em blocos, para limitar a memória temporária
+        return np.concatenate([
+            self.embeddings[inicio:inicio + TAMANHO_BLOCO_FLOAT16].astype(np.float32) @ vetor
+            for inicio in range(0, len(self.embeddings), TAMANHO_BLOCO_FLOAT16)])
+
+    def consultar(self, embedding_consulta: List[float], num_resultados: int):
+        vetor = np.asarray(embedding_consulta, dtype=np.float32)
+        vetor = vetor / (np.linalg.norm(vetor) or 1.0)
+        similaridades = self.calcular_similaridades(vetor)
+
+        num_resultados = min(num_resultados, len(similaridades))
+        melhores = np.argpartition(-similaridades, num_resultados - 1)[:num_resultados]
+        melhores = melhores[np.argsort(-similaridades[melhores])]
+
+        # Mesmo formato de retorno de collection.query do ChromaDB (distância do cosseno)
+        return {
+            'ids': [[self.ids[idx] for idx in melhores]],
+            'distances': [[float(1 - similaridades[idx]) for idx in melhores]],
+            'documents': [[self.documentos[idx] for idx in melhores]],
+            'metadatas': [[self.metadados[idx] for idx in melhores]]
+        }
+
+    def calcular_distancias(self, ids: List[str], embedding_consulta: List[float]):
+        vetor = np.asarray(embedding_consulta, dtype=np.float32)
+        vetor = vetor / (np.linalg.norm(vetor) or 1.0)
+        linhas = np.asarray(self.embeddings[[self.posicao_por_id[id_documento] for id_documento in ids]], dtype=np.float32)
+        return dict(zip(ids, (1 - linhas @ vetor).tolist()))
+
+    @staticmethod
+    def gerar(url_indice: str, ids: List[str], embeddings, documentos: List[str], metadados: List[dict], tipo_dados: str='float32'):
+        os.makedirs(url_indice, exist_ok=True)
+        matriz = np.asarray(embeddings, dtype=np.float32)
+        normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+        matriz = (matriz / np.where(normas == 0, 1.0, normas)).astype(tipo_dados)
+
+        # Escrita em arquivos temporários seguida de substituição, para que workers em execução não leiam arquivos pela metade
+        url_embeddings = os.path.join(url_indice, ARQUIVO_EMBEDDINGS)
+        url_metadados = os.path.join(url_indice, ARQUIVO_METADADOS)
+        with open(f'{url_embeddings}.tmp', 'wb') as arq:
+            np.save(arq, matriz)
+        with open(f'{url_metadados}.tmp', 'w', encoding='utf-8') as arq:
+            json.dump({'ids': ids, 'documents': documentos, 'metadatas': metadados}, arq, ensure_ascii=False)
+        os.replace(f'{url_metadados}.tmp', url_metadados)
+        os.replace(f'{url_embeddings}.tmp', url_embeddings)
+
+    @classmethod
+    def exportar_de_colecao(cls, colecao, url_indice: str, tipo_dados: str='float32'):
+        registros = colecao.get(include=['embeddings', 'documents', 'metadatas'])
+        cls.gerar(url_indice, registros['ids'], registros['embeddings'], registros['documents'], registros['metadatas'], tipo_dados)
+        return len(registros['ids'])
+
+    @classmethod
+    def exportar_de_chroma(cls, url_banco_vetores: str, colecao_de_documentos: str, url_indice: str=None, tipo_dados: str='float32'):
+        from chromadb import chromadb
+
+        url_indice = url_indice or obter_url_indice(url_banco_vetores, colecao_de_documentos)
+        client = chromadb.PersistentClient(path=url_banco_vetores)
+        qtd_registros = cls.exportar_de_colecao(client.get_collection(name=colecao_de_documentos), url_indice, tipo_dados)
+        client._system.stop()
+        return url_indice, qtd_registros
+
+
+class InterfaceIndiceNumpy:
+    '''
+    Alternativa à InterfaceChroma, com o mesmo contrato de consultar_documentos, usando IndiceVetoresNumpy.
+    '''
+    def __init__(self,
+                 url_banco_vetores=environment.URL_BANCO_VETORES,
+                 colecao_de_documentos=environment.NOME_COLECAO_DE_DOCUMENTOS,
+                 funcao_de_embeddings=None,
+                 fazer_log=True):
+
+        if fazer_log: print('--- interface do índice NumPy em inicialização')
+        self.funcao_de_embeddings = funcao_de_embeddings
+        self.url_banco_vetores = url_banco_vetores
+
+        url_indice = obter_url_indice(url_banco_vetores, colecao_de_documentos)
+        if fazer_log: print(f'--- abrindo índice em memória mapeada (usando "{url_indice}")...')
+        self.indice = IndiceVetoresNumpy(url_indice)
+
+    def consultar_documentos(self, termos_de_consulta: str, num_resultados=environment.NUM_DOCUMENTOS_RETORNADOS, embedding_consulta: List[float]=None):
+        if embedding_consulta is None: embedding_consulta = self.gerar_embedding_consulta(termos_de_consulta)
+        return self.indice.consultar(embedding_consulta, num_resultados)
+
+    def gerar_embedding_consulta(self, termos_de_consulta: str):
+        return self.funcao_de_embeddings([termos_de_consulta])[0]
+
+    def calcular_distancias(self, ids: List[str], embedding_consulta: List[float]):
+        return self.indice.calcular_distancias(ids, embedding_consulta)
+
+    def versao_colecao(self):
+        return os.path.getmtime(self.indice.url_embeddings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Exporta uma coleção do ChromaDB para um índice NumPy em memória mapeada")
+
+    parser.add_argument('--nome_banco_vetores', type=str, required=True, help="nome do banco de vetores (pasta em conteudo/bancos_vetores)")
+    parser.add_argument('--nome_colecao', type=str, required=True, help="coleção a ser exportada")
+    parser.add_argument('--tipo_dados', type=str, default='float32', choices=['float32', 'float16'], help="tipo de dados da matriz de embeddings")
+
+    args = parser.parse_args()
+    url_banco_vetores = os.path.join(os.path.dirname(__file__), '../conteudo/bancos_vetores', args.nome_banco_vetores)
+    url_indice, qtd_registros = IndiceVetoresNumpy.exportar_de_chroma(url_banco_vetores, args.nome_colecao, tipo_dados=args.tipo_dados)
+    print(f'{qtd_registros} registros exportados para {url_indice}')
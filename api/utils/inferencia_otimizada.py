@@ -0,0 +1,91 @@
+import argparse
+import os
+import torch
+
+from types import SimpleNamespace
+
+# Backends de inferência em CPU: 'torch' (fp32, padrão), 'int8' (quantização dinâmica das camadas lineares com
+# torch.quantization.quantize_dynamic) e 'onnx' (grafo exportado executado no ONNX Runtime, opcionalmente em int8)
+BACKENDS_INFERENCIA = ['torch', 'int8', 'onnx']
+NOMES_ENTRADAS_BERT = ['input_ids', 'attention_mask', 'token_type_ids']
+
+
+def quantizar_int8(modelo: torch.nn.Module):
+    # Pesos das camadas lineares em int8; as ativações são quantizadas dinamicamente a cada chamada (somente CPU)
+    return torch.quantization.quantize_dynamic(modelo, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class SaidaLogitsBert(torch.nn.Module):
+    # Envolve o modelo para que a exportação ONNX tenha saídas nomeadas (start_logits, end_logits) em vez de ModelOutput
+    def __init__(self, modelo):
+        super().__init__()
+        self.modelo = modelo
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        saida = self.modelo(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+        return saida.start_logits, saida.end_logits
+
+
+def exportar_bert_onnx(nome_modelo: str, url_destino: str, quantizar: bool=True):
+    '''
+    Exporta o modelo Bert de perguntas e respostas para ONNX, com lote e comprimento dinâmicos. Com quantizar,
+    gera também a versão int8 (quantização dinâmica do ONNX Runtime), salva com o sufixo _int8.
+    Retorna o caminho do modelo a ser usado.
+    '''
+    from transformers import BertForQuestionAnswering, BertTokenizerFast
+
+    modelo = BertForQuestionAnswering.from_pretrained(nome_modelo).eval()
+    tokenizador = BertTokenizerFast.from_pretrained(nome_modelo)
+    exemplo = tokenizador(['Qual é o prazo?'], ['O prazo é de quatro anos.'], return_tensors='pt')
+
+    if os.path.dirname(url_destino): os.makedirs(os.path.dirname(url_destino), exist_ok=True)
+    eixos_dinamicos = {nome: {0: 'lote', 1: 'tokens'} for nome in NOMES_ENTRADAS_BERT + ['start_logits', 'end_logits']}
+    torch.onnx.export(
+        SaidaLogitsBert(modelo),
+        tuple(exemplo[nome] for nome in NOMES_ENTRADAS_BERT),
+        url_destino,
+        input_names=NOMES_ENTRADAS_BERT,
+        output_names=['start_logits', 'end_logits'],
+        dynamic_axes=eixos_dinamicos,
+        opset_version=14,
+        dynamo=False)
+    if not quantizar: return url_destino
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    url_int8 = url_destino.replace('.onnx', '_int8.onnx')
+    quantize_dynamic(url_destino, url_int8, weight_type=QuantType.QInt8)
+    return url_int8
+
+
+class ModeloOnnxBertQA:
+    '''
+    Executa o Bert exportado com exportar_bert_onnx no ONNX Runtime, com a mesma interface de chamada do
+    BertForQuestionAnswering usada pelo RerankerBert (retorna start_logits e end_logits como tensores).
+    '''
+    def __init__(self, url_modelo: str, num_threads: int=None):
+        import onnxruntime
+
+        opcoes = onnxruntime.SessionOptions()
+        opcoes.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads: opcoes.intra_op_num_threads = num_threads
+        self.sessao = onnxruntime.InferenceSession(url_modelo, opcoes, providers=['CPUExecutionProvider'])
+
+    def __call__(self, **entradas):
+        logits_inicio, logits_fim = self.sessao.run(
+            ['start_logits', 'end_logits'],
+            {nome: entradas[nome].cpu().numpy() for nome in NOMES_ENTRADAS_BERT})
+        return SimpleNamespace(start_logits=torch.from_numpy(logits_inicio), end_logits=torch.from_numpy(logits_fim))
+
+
+if __name__ == '__main__':
+    from api.environment.environment import environment
+
+    parser = argparse.ArgumentParser(description="Exporta o modelo Bert de perguntas e respostas para ONNX (fp32 e int8)")
+
+    parser.add_argument('--nome_modelo', type=str, default=environment.EMBEDDING_SQUAD_PORTUGUESE, help="modelo Bert a ser exportado")
+    parser.add_argument('--url_destino', type=str, default=environment.URL_MODELO_BERT_ONNX.replace('_int8.onnx', '.onnx'), help="arquivo .onnx de destino")
+    parser.add_argument('--sem_quantizacao', action='store_true', help="exporta somente a versão fp32")
+
+    args = parser.parse_args()
+    url_modelo = exportar_bert_onnx(args.nome_modelo, args.url_destino, quantizar=not args.sem_quantizacao)
+    print(f'Modelo exportado para {url_modelo}')
@@ -0,0 +1,155 @@
+import asyncio
+
+from concurrent.futures import Executor
+from functools import partial
+from time import time
+
+
+class LoteadorEmbeddings:
+    '''
+    Agrupa as consultas de requisições concorrentes em lotes, para que o modelo de embeddings seja chamado
+    uma vez por lote em vez de uma vez por pergunta. Um lote é enviado quando atinge o tamanho máximo ou
+    quando a consulta mais antiga já esperou o tempo máximo; cada requisição recebe de volta o seu vetor.
+    '''
+    def __init__(self, funcao_de_embeddings, executor: Executor, tempo_max_espera_ms: float=5, tamanho_max_lote: int=32):
+        self.funcao_de_embeddings = funcao_de_embeddings
+        self.executor = executor
+        self.tempo_max_espera = tempo_max_espera_ms / 1000
+        self.tamanho_max_lote = tamanho_max_lote
+        # Fila e tarefa de processamento são criadas sob demanda, pois pertencem ao event loop em execução
+        self.fila = None
+        self.tarefa_processamento = None
+
+        # Métricas
+        self.qtd_lotes = 0
+        self.qtd_textos = 0
+        self.qtd_acertos_cache = 0
+        self.distribuicao_tamanho_lote = {}
+        self.tempo_total_espera = 0.0
+        self.tempo_max_espera_observado = 0.0
+        self.tempo_total_encode = 0.0
+
+    def iniciar(self):
+        if self.tarefa_processamento is None or self.tarefa_processamento.done():
+            # A fila de uma tarefa encerrada é esvaziada antes de ser substituída: as consultas que ficaram nela
+            # recebem o erro da tarefa, em vez de esperar indefinidamente
+            if self.tarefa_processamento is not None: self.esvaziar_fila(self.fila, self.tarefa_processamento)
+            self.fila = asyncio.Queue()
+            self.tarefa_processamento = asyncio.get_running_loop().create_task(self.processar_fila())
+            self.tarefa_processamento.add_done_callback(partial(self.esvaziar_fila, self.fila))
+
+    @staticmethod
+    def obter_erro_encerramento(tarefa: asyncio.Task):
+        if tarefa.cancelled() or tarefa.exception() is None:
+            return RuntimeError('Loteador de embeddings encerrado')
+        return tarefa.exception()
+
+    @staticmethod
+    def falhar_futuros(futuros: list, erro: BaseException):
+        for futuro in futuros:
+            if not futuro.done(): futuro.set_exception(erro)
+
+    def esvaziar_fila(self, fila: asyncio.Queue, tarefa: asyncio.Task):
+        futuros = []
+        while not fila.empty():
+            _, futuro, _ = fila.get_nowait()
+            futuros.append(futuro)
+        self.falhar_futuros(futuros, self.obter_erro_encerramento(tarefa))
+
+    async def fechar(self):
+        if self.tarefa_processamento is not None:
+            self.tarefa_processamento.cancel()
+            try:
+                await self.tarefa_processamento
+            except asyncio.CancelledError:
+                pass
+            self.tarefa_processamento = None
+
+    async def gerar_embedding(self, texto: str):
+        # Consultas já presentes no cache não entram na fila
+        cache = self.funcao_de_embeddings.cache
+        if cache:
+            embedding = cache.obter(cache.gerar_chave(self.funcao_de_embeddings.nome_modelo, self.funcao_de_embeddings.instrucao, texto))
+            if embedding is not None:
+                self.qtd_acertos_cache += 1
+                return embedding
+
+        self.iniciar()
+        futuro = asyncio.get_running_loop().create_future()
+        self.fila.put_nowait((texto, futuro, time()))
+        return await futuro
+
+    def codificar(self, textos: list):
+        # O cache já foi consultado em gerar_embedding: o lote vai direto ao modelo, e o resultado é armazenado
+        embeddings = self.funcao_de_embeddings.gerar_embeddings(textos)
+        cache = self.funcao_de_embeddings.cache
+        if cache:
+            for texto, embedding in zip(textos, embeddings):
+                cache.incluir(cache.gerar_chave(self.funcao_de_embeddings.nome_modelo, self.funcao_de_embeddings.instrucao, texto), embedding)
+        return embeddings
+
+    async def montar_lote(self, lote: list):
+        # Os itens são acrescentados à lista do chamador, que os encerra se a tarefa for interrompida no meio
+        loop = asyncio.get_running_loop()
+        lote.append(await self.fila.get())
+        prazo = loop.time() + self.tempo_max_espera
+        while len(lote) < self.tamanho_max_lote:
+            tempo_restante = prazo - loop.time()
+            if tempo_restante <= 0: break
+            try:
+                lote.append(await asyncio.wait_for(self.fila.get(), tempo_restante))
+            except asyncio.TimeoutError:
+                break
+
+    async def processar_fila(self):
+        while True:
+            lote = []
+            try:
+                await self.montar_lote(lote)
+                await self.processar_lote(lote)
+            except BaseException as erro:
+                # Erro inesperado ou cancelamento (fechar): as consultas do lote em andamento não ficam sem resposta
+                self.falhar_futuros([futuro for _, futuro, _ in lote], erro if isinstance(erro, Exception) else RuntimeError('Loteador de embeddings encerrado'))
+                raise
+
+    async def processar_lote(self, lote: list):
+        loop = asyncio.get_running_loop()
+        # Requisições canceladas enquanto esperavam não precisam de embedding
+        lote = [item for item in lote if not item[1].done()]
+        if not lote: return
+
+        marcador_tempo_inicio = time()
+        for _, _, instante_inclusao in lote:
+            tempo_espera = marcador_tempo_inicio - instante_inclusao
+            self.tempo_total_espera += tempo_espera
+            self.tempo_max_espera_observado = max(self.tempo_max_espera_observado, tempo_espera)
+
+        # Perguntas repetidas dentro do mesmo lote são codificadas uma única vez
+        textos = list(dict.fromkeys(texto for texto, _, _ in lote))
+        try:
+            embeddings = await loop.run_in_executor(self.executor, self.codificar, textos)
+        except Exception as erro:
+            self.falhar_futuros([futuro for _, futuro, _ in lote], erro)
+            return
+        self.tempo_total_encode += time() - marcador_tempo_inicio
+
+        embedding_por_texto = dict(zip(textos, embeddings))
+        for texto, futuro, _ in lote:
+            if not futuro.done(): futuro.set_result(embedding_por_texto[texto])
+
+        self.qtd_lotes += 1
+        self.qtd_textos += len(lote)
+        self.distribuicao_tamanho_lote[len(textos)] = self.distribuicao_tamanho_lote.get(len(textos), 0) + 1
+
+    def estatisticas(self):
+        return {
+            'lotes': self.qtd_lotes,
+            'textos': self.qtd_textos,
+            'acertos_cache': self.qtd_acertos_cache,
+            'tamanho_medio_lote': self.qtd_textos / self.qtd_lotes if self.qtd_lotes else 0.0,
+            'distribuicao_tamanho_lote': dict(sorted(self.distribuicao_tamanho_lote.items())),
+            'tempo_medio_espera_fila': self.tempo_total_espera / self.qtd_textos if self.qtd_textos else 0.0,
+            'tempo_max_espera_fila': self.tempo_max_espera_observado,
+            'tempo_medio_encode_lote': self.tempo_total_encode / self.qtd_lotes if self.qtd_lotes else 0.0,
+            'tamanho_fila': self.fila.qsize() if self.fila else 0
+        }
@@ -0,0 +1,138 @@
+import math
+import threading
+
+from typing import Callable, Dict, List, Tuple
+
+# Limites dos buckets (em segundos) para etapas rápidas (embedding, busca, rerank) e para a geração do Llama
+BUCKETS_ETAPAS_RAPIDAS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_GERACAO = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def formatar_valor(valor: float):
+    if valor == math.inf: return '+Inf'
+    return repr(float(valor))
+
+
+def formatar_rotulos(nomes_rotulos: Tuple[str, ...], valores_rotulos: Tuple[str, ...]):
+    pares = [f'{nome}="{valor}"' for nome, valor in zip(nomes_rotulos, valores_rotulos)]
+    return '{' + ','.join(pares) + '}' if pares else ''
+
+
+class Metrica:
+    def __init__(self, nome: str, descricao: str, tipo: str, rotulos: Tuple[str, ...]=()):
+        self.nome = nome
+        self.descricao = descricao
+        self.tipo = tipo
+        self.rotulos = tuple(rotulos)
+        self.trava = threading.Lock()
+
+    def cabecalho(self):
+        return [f'# HELP {self.nome} {self.descricao}', f'# TYPE {self.nome} {self.tipo}']
+
+
+class Contador(Metrica):
+    def __init__(self, nome: str, descricao: str, rotulos: Tuple[str, ...]=()):
+        super().__init__(nome, descricao, 'counter', rotulos)
+        self.valores: Dict[tuple, float] = {}
+
+    def incrementar(self, *valores_rotulos: str, valor: float=1):
+        with self.trava:
+            self.valores[valores_rotulos] = self.valores.get(valores_rotulos, 0.0) + valor
+
+    def gerar_linhas(self):
+        with self.trava:
+            valores = list(self.valores.items())
+        return [f'{self.nome}{formatar_rotulos(self.rotulos, rotulos)} {formatar_valor(valor)}' for rotulos, valor in valores]
+
+
+class Medidor(Metrica):
+    '''
+    Gauge. O valor pode ser ajustado diretamente (incrementar/decrementar) ou, se funcao for informada,
+    lido dela no momento da coleta (tamanho de filas, por exemplo).
+    '''
+    def __init__(self, nome: str, descricao: str, funcao: Callable[[], float]=None, tipo: str='gauge'):
+        super().__init__(nome, descricao, tipo)
+        self.funcao = funcao
+        self.valor = 0.0
+
+    def incrementar(self, valor: float=1):
+        with self.trava:
+            self.valor += valor
+
+    def decrementar(self, valor: float=1):
+        self.incrementar(-valor)
+
+    def gerar_linhas(self):
+        valor = self.funcao() if self.funcao else self.valor
+        return [f'{self.nome} {formatar_valor(valor)}']
+
+
+class Histograma(Metrica):
+    def __init__(self, nome: str, descricao: str, buckets: Tuple[float, ...]=BUCKETS_ETAPAS_RAPIDAS):
+        super().__init__(nome, descricao, 'histogram')
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.contagens = [0] * len(self.buckets)
+        self.soma = 0.0
+        self.quantidade = 0
+
+    def observar(self, valor: float):
+        with self.trava:
+            for idx, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    self.contagens[idx] += 1
+                    break
+            self.soma += valor
+            self.quantidade += 1
+
+    def gerar_linhas(self):
+        with self.trava:
+            contagens, soma, quantidade = list(self.contagens), self.soma, self.quantidade
+        linhas = []
+        acumulado = 0
+        # Os buckets do Prometheus são cumulativos
+        for limite, contagem in zip(self.buckets, contagens):
+            acumulado += contagem
+            linhas.append(f'{self.nome}_bucket{{le="{formatar_valor(limite)}"}} {acumulado}')
+        linhas.append(f'{self.nome}_sum {formatar_valor(soma)}')
+        linhas.append(f'{self.nome}_count {quantidade}')
+        return linhas
+
+
+class MetricasRAG:
+    '''
+    Métricas da API no formato de texto do Prometheus, servidas em /metrics. Latências por etapa da
+    consulta, contadores de requisições, erros, acertos de cache e tokens transmitidos, e medidores de
+    requisições em andamento e tamanho das filas (estes registrados pela API com registrar_medidor).
+    '''
+    def __init__(self):
+        self.tempo_embedding = Histograma('rag_embedding_segundos', 'Tempo para gerar o embedding da pergunta')
+        self.tempo_busca_vetores = Histograma('rag_busca_vetores_segundos', 'Tempo da busca de documentos no banco de vetores')
+        self.tempo_rerank = Histograma('rag_rerank_segundos', 'Tempo de cálculo dos scores do Bert')
+        self.tempo_primeiro_token = Histograma('rag_primeiro_token_segundos', 'Tempo até o primeiro token do Llama (TTFT)', BUCKETS_GERACAO)
+        self.tempo_geracao = Histograma('rag_geracao_llama_segundos', 'Tempo total de geração da resposta pelo Llama', BUCKETS_GERACAO)
+        self.tempo_consulta_total = Histograma('rag_consulta_total_segundos', 'Tempo total da consulta, da pergunta ao JSON final', BUCKETS_GERACAO)
+
+        self.requisicoes = Contador('rag_requisicoes_total', 'Requisições de perguntas recebidas', ('endpoint',))
+        self.erros = Contador('rag_erros_total', 'Consultas encerradas com erro', ('etapa',))
+        self.rejeicoes = Contador('rag_rejeicoes_admissao_total', 'Requisições recusadas pelo controle de admissão', ('status',))
+        self.acertos_cache_respostas = Contador('rag_cache_respostas_acertos_total', 'Respostas servidas pelo cache semântico')
+        self.tokens_transmitidos = Contador('rag_tokens_transmitidos_total', 'Fragmentos de resposta do Llama transmitidos aos clientes')
+        self.requisicoes_em_andamento = Medidor('rag_requisicoes_em_andamento', 'Requisições de perguntas em andamento')
+
+        self.metricas: List[Metrica] = [
+            self.tempo_embedding, self.tempo_busca_vetores, self.tempo_rerank, self.tempo_primeiro_token,
+            self.tempo_geracao, self.tempo_consulta_total, self.requisicoes, self.erros, self.rejeicoes,
+            self.acertos_cache_respostas, self.tokens_transmitidos, self.requisicoes_em_andamento]
+
+    def registrar_medidor(self, nome: str, descricao: str, funcao: Callable[[], float], tipo: str='gauge'):
+        self.metricas.append(Medidor(nome, descricao, funcao, tipo))
+
+    def gerar_texto(self):
+        linhas = []
+        for metrica in self.metricas:
+            linhas.extend(metrica.cabecalho())
+            linhas.extend(metrica.gerar_linhas())
+        return '\n'.join(linhas) + '\n'
+
+
+metricas = MetricasRAG()
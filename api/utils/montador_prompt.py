@@ -0,0 +1,97 @@
+import math
+
+from typing import Callable, List
+
+
+class MontadorPrompt:
+    '''
+    Seleciona os documentos que entram no prompt do Llama. Cada documento recebe uma relevância que combina
+    score_distancia e o score do Bert (equivalente ao do pipeline, entre 0 e 1); os abaixo do limiar são
+    descartados, e os demais entram por ordem de relevância enquanto couberem no orçamento de tokens. O orçamento
+    é o menor entre orcamento_tokens e o que resta da janela de contexto do modelo depois do prompt fixo, do
+    contexto da conversa e da reserva para a resposta.
+    '''
+    def __init__(self,
+                 orcamento_tokens: int=2048,
+                 janela_contexto: int=8192,
+                 reserva_tokens_resposta: int=1024,
+                 limiar_relevancia: float=0.0,
+                 peso_bert: float=0.5,
+                 min_documentos: int=1,
+                 caracteres_por_token: float=3.5,
+                 contar_tokens: Callable[[str], int]=None):
+        self.orcamento_tokens = orcamento_tokens
+        self.janela_contexto = janela_contexto
+        self.reserva_tokens_resposta = reserva_tokens_resposta
+        self.limiar_relevancia = limiar_relevancia
+        self.peso_bert = peso_bert
+        self.min_documentos = min_documentos
+        self.caracteres_por_token = caracteres_por_token
+        # Sem tokenizador, o número de tokens é estimado pela quantidade de caracteres
+        self.contar_tokens = contar_tokens or self.estimar_tokens
+
+    @classmethod
+    def com_tokenizador(cls, nome_tokenizador: str, **kwargs):
+        from transformers import AutoTokenizer
+
+        tokenizador = AutoTokenizer.from_pretrained(nome_tokenizador)
+        return cls(contar_tokens=lambda texto: len(tokenizador.encode(texto, add_special_tokens=False)), **kwargs)
+
+    @property
+    def usa_scores_bert(self):
+        return self.peso_bert > 0
+
+    def estimar_tokens(self, texto: str):
+        return math.ceil(len(texto) / self.caracteres_por_token)
+
+    def calcular_relevancia(self, documento: dict):
+        score_bert = documento['score_bert'][1] if 'score_bert' in documento else 0.0
+        return (1 - self.peso_bert) * documento['score_distancia'] + self.peso_bert * score_bert
+
+    def contar_tokens_contexto(self, contexto: list=None):
+        # No modo generate, o contexto do Ollama é a própria lista de tokens da conversa, então o seu tamanho é
+        # exato; no modo chat, é a lista de mensagens anteriores
+        if not contexto: return 0
+        if isinstance(contexto[0], dict): return sum(self.contar_tokens(mensagem['content']) for mensagem in contexto)
+        return len(contexto)
+
+    def calcular_orcamento(self, prompt_base: str, contexto: list=None):
+        orcamento = self.orcamento_tokens if self.orcamento_tokens > 0 else math.inf
+        if self.janela_contexto > 0:
+            tokens_ocupados = self.contar_tokens(prompt_base) + self.contar_tokens_contexto(contexto) + self.reserva_tokens_resposta
+            orcamento = min(orcamento, self.janela_contexto - tokens_ocupados)
+        return max(0, orcamento) if orcamento != math.inf else None
+
+    def selecionar(self, documentos: List[dict], textos_prompt: List[str], prompt_base: str, contexto: list=None):
+        '''
+        Recebe os documentos (com score_distancia e, se já calculado, score_bert) e o texto de cada um no prompt.
+        Retorna os textos selecionados, em ordem de relevância, e o relatório da seleção para o JSON final.
+        '''
+        orcamento = self.calcular_orcamento(prompt_base, contexto)
+        candidatos = sorted(
+            [(self.calcular_relevancia(documento), idx) for idx, documento in enumerate(documentos)],
+            key=lambda candidato: candidato[0],
+            reverse=True)
+
+        selecionados, incluidos, descartados = [], [], []
+        tokens_utilizados = 0
+        for relevancia, idx in candidatos:
+            tokens_documento = self.contar_tokens(textos_prompt[idx]) + 1
+            item = {'id': documentos[idx]['id'], 'relevancia': relevancia, 'tokens': tokens_documento}
+            # Os min_documentos mais relevantes entram mesmo abaixo do limiar, desde que caibam no orçamento
+            if relevancia < self.limiar_relevancia and len(incluidos) >= self.min_documentos:
+                descartados.append({**item, 'motivo': 'limiar'})
+            elif orcamento is not None and tokens_utilizados + tokens_documento > orcamento:
+                descartados.append({**item, 'motivo': 'orcamento'})
+            else:
+                selecionados.append(textos_prompt[idx])
+                incluidos.append(item)
+                tokens_utilizados += tokens_documento
+
+        relatorio = {
+            'documentos_incluidos': incluidos,
+            'documentos_descartados': descartados,
+            'tokens_documentos': tokens_utilizados,
+            'orcamento_tokens': orcamento
+        }
+        return selecionados, relatorio
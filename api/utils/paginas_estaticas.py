@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import os
+import re
+
+from email.utils import formatdate, parsedate_to_datetime
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Um ano: os arquivos estáticos são referenciados com ?v=<hash do conteúdo>, então uma URL nunca muda de conteúdo
+CACHE_CONTROL_IMUTAVEL = 'public, max-age=31536000, immutable'
+
+
+def calcular_versao_arquivo(url_arquivo: str):
+    with open(url_arquivo, 'rb') as arq:
+        return hashlib.sha1(arq.read()).hexdigest()[:12]
+
+
+class ArquivosEstaticosImutaveis(StaticFiles):
+    '''
+    StaticFiles com cache de longa duração (immutable) para requisições versionadas (?v=...). Sem versão,
+    vale o comportamento padrão (revalidação por ETag/Last-Modified).
+    '''
+    def file_response(self, full_path, stat_result, scope, status_code: int=200):
+        resposta = super().file_response(full_path, stat_result, scope, status_code)
+        if b'v=' in scope.get('query_string', b''):
+            resposta.headers['Cache-Control'] = CACHE_CONTROL_IMUTAVEL
+        return resposta
+
+
+class PaginaPreRenderizada:
+    '''
+    Página HTML com as tags de substituição aplicadas uma única vez, na inicialização, e novamente só quando
+    o arquivo ou um dos arquivos estáticos referenciados é alterado (mtime). As URLs de arquivos estáticos recebem ?v=<hash do conteúdo>, e as variantes
+    gzip (e brotli, se instalado) são comprimidas com antecedência. Responde 304 a requisições condicionais.
+    '''
+    def __init__(self, url_html: str, tags_substituicao: dict, url_dir_estaticos: str='web/img', prefixo_estaticos: str='/web/img'):
+        self.url_html = url_html
+        self.tags_substituicao = tags_substituicao
+        self.url_dir_estaticos = url_dir_estaticos
+        self.padrao_estaticos = re.compile(re.escape(prefixo_estaticos) + r'/([^"\'\s?#)]+)')
+        self.mtime = None
+        # mtime de cada arquivo estático versionado na última renderização (None se o arquivo não existia)
+        self.mtimes_estaticos = {}
+        self.renderizar()
+
+    @staticmethod
+    def obter_mtime(url_arquivo: str):
+        try:
+            return os.stat(url_arquivo).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def versionar_estatico(self, correspondencia: re.Match):
+        url_arquivo = os.path.join(self.url_dir_estaticos, correspondencia.group(1))
+        self.mtimes_estaticos[url_arquivo] = self.obter_mtime(url_arquivo)
+        if not os.path.isfile(url_arquivo): return correspondencia.group(0)
+        return f'{correspondencia.group(0)}?v={calcular_versao_arquivo(url_arquivo)}'
+
+    def renderizar(self):
+        mtime = os.stat(self.url_html).st_mtime
+        with open(self.url_html, 'r', encoding='utf-8') as arquivo: conteudo_html = arquivo.read()
+        # substituindo as tags dentro do HTML, para maior controle
+        for tag, valor in self.tags_substituicao.items():
+            conteudo_html = conteudo_html.replace(tag, valor)
+        self.mtimes_estaticos = {}
+        conteudo_html = self.padrao_estaticos.sub(self.versionar_estatico, conteudo_html)
+
+        conteudo = conteudo_html.encode('utf-8')
+        self.etag = hashlib.sha1(conteudo).hexdigest()[:16]
+        # Um arquivo estático alterado muda o ?v= da página, e portanto também a data de modificação dela
+        self.last_modified = formatdate(max([mtime] + [valor for valor in self.mtimes_estaticos.values() if valor]), usegmt=True)
+        self.variantes = {'identity': conteudo, 'gzip': gzip.compress(conteudo, compresslevel=9)}
+        if brotli: self.variantes['br'] = brotli.compress(conteudo, quality=11)
+        self.mtime = mtime
+
+    def atualizar_se_alterada(self):
+        # Sem a verificação dos arquivos estáticos, um arquivo alterado continuaria com o ?v= antigo, que o
+        # navegador mantém em cache como imutável
+        try:
+            alterada = os.stat(self.url_html).st_mtime != self.mtime or any(
+                self.obter_mtime(url_arquivo) != mtime for url_arquivo, mtime in self.mtimes_estaticos.items())
+            if alterada: self.renderizar()
+        except FileNotFoundError:
+            # Arquivo em substituição (deploy): continua servindo a última versão renderizada
+            pass
+
+    def escolher_codificacao(self, accept_encoding: str):
+        aceitas = {}
+        for item in accept_encoding.split(','):
+            partes = item.strip().split(';')
+            qualidade = 1.0
+            for parametro in partes[1:]:
+                nome, _, valor = parametro.strip().partition('=')
+                if nome == 'q':
+                    try: qualidade = float(valor)
+                    except ValueError: qualidade = 0.0
+            aceitas[partes[0].strip().lower()] = qualidade
+        for codificacao in ['br', 'gzip']:
+            if codificacao in self.variantes and aceitas.get(codificacao, aceitas.get('*', 0)) > 0: return codificacao
+        return 'identity'
+
+    def nao_modificada(self, request: Request, etag: str):
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            etags = [valor.strip().removeprefix('W/') for valor in if_none_match.split(',')]
+            return '*' in etags or etag in etags
+        if_modified_since = request.headers.get('if-modified-since')
+        if if_modified_since:
+            try: return parsedate_to_datetime(self.last_modified) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError): return False
+        return False
+
+    def responder(self, request: Request):
+        self.atualizar_se_alterada()
+        codificacao = self.escolher_codificacao(request.headers.get('accept-encoding', ''))
+        # Cada variante comprimida é uma representação diferente, com ETag própria
+        etag = f'"{self.etag}"' if codificacao == 'identity' else f'"{self.etag}-{codificacao}"'
+        cabecalhos = {
+            'ETag': etag,
+            'Last-Modified': self.last_modified,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+        if self.nao_modificada(request, etag):
+            return Response(status_code=304, headers=cabecalhos)
+        if codificacao != 'identity': cabecalhos['Content-Encoding'] = codificacao
+        return Response(content=self.variantes[codificacao], media_type='text/html; charset=utf-8', headers=cabecalhos)
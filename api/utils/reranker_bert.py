@@ -0,0 +1,134 @@
+import torch
+
+from transformers import BertForQuestionAnswering, BertTokenizerFast
+from typing import List
+
+from api.utils.inferencia_otimizada import ModeloOnnxBertQA, quantizar_int8
+
+
+class RerankerBert:
+    '''
+    Avalia documentos recuperados com um modelo Bert de perguntas e respostas (SQuAD). Uma única instância do
+    modelo e um tokenizador rápido (Rust) atendem a todos os scores: os logits de um só forward pass geram
+    tanto os scores próprios (score, score_estimado, score_ponderado) quanto a resposta e o score equivalentes
+    aos do pipeline("question-answering") do transformers, que assim não precisa ser carregado.
+    Em CPU, o modelo pode ser executado em int8 ou no ONNX Runtime (ver api.utils.inferencia_otimizada).
+    '''
+    def __init__(self, nome_modelo: str, device: str=None, tamanho_max_resposta: int=15, backend: str='torch', url_modelo_onnx: str=None):
+        self.device = device
+        self.backend = backend
+        # Mesmo limite de tokens da resposta usado por padrão no pipeline
+        self.tamanho_max_resposta = tamanho_max_resposta
+        self.tokenizador = BertTokenizerFast.from_pretrained(nome_modelo)
+        if backend == 'onnx':
+            self.device = 'cpu'
+            self.modelo = ModeloOnnxBertQA(url_modelo_onnx)
+        elif backend == 'int8':
+            self.device = 'cpu'
+            self.modelo = quantizar_int8(BertForQuestionAnswering.from_pretrained(nome_modelo).eval())
+        else:
+            self.modelo = BertForQuestionAnswering.from_pretrained(nome_modelo).to(self.device).eval()
+
+    def extrair_respostas_pipeline(self, inputs, textos_documentos: List[str], logits_inicio: torch.Tensor, logits_fim: torch.Tensor):
+        # Reproduz o pós-processamento do pipeline: softmax restrito aos tokens do documento (e ao [CLS], depois
+        # zerado), melhor par início/fim com fim >= início e no máximo tamanho_max_resposta tokens
+        num_documentos, num_tokens = logits_inicio.shape
+        permitidos = torch.tensor(
+            [[id_sequencia == 1 for id_sequencia in inputs.sequence_ids(idx)] for idx in range(num_documentos)],
+            device=logits_inicio.device)
+        permitidos[:, 0] = True
+        permitidos &= inputs['attention_mask'].to(logits_inicio.device).bool()
+
+        probabilidades_inicio = logits_inicio.masked_fill(~permitidos, -10000.0).softmax(dim=-1)
+        probabilidades_fim = logits_fim.masked_fill(~permitidos, -10000.0).softmax(dim=-1)
+        probabilidades_inicio[:, 0] = probabilidades_fim[:, 0] = 0.0
+
+        candidatos = probabilidades_inicio.unsqueeze(-1) * probabilidades_fim.unsqueeze(1)
+        candidatos = torch.tril(torch.triu(candidatos), diagonal=self.tamanho_max_resposta - 1)
+        scores, melhores = candidatos.flatten(1).max(dim=-1)
+        indices_inicio = (melhores // num_tokens).tolist()
+        indices_fim = (melhores % num_tokens).tolist()
+
+        respostas = []
+        for idx, texto in enumerate(textos_documentos):
+            codificacao = inputs.encodings[idx]
+            # Como no pipeline, a resposta é alinhada às palavras inteiras do documento
+            try:
+                inicio = codificacao.word_to_chars(codificacao.token_to_word(indices_inicio[idx]), sequence_index=1)[0]
+                fim = codificacao.word_to_chars(codificacao.token_to_word(indices_fim[idx]), sequence_index=1)[1]
+            except Exception:
+                inicio = codificacao.offsets[indices_inicio[idx]][0]
+                fim = codificacao.offsets[indices_fim[idx]][1]
+            respostas.append(texto[inicio:fim])
+        return respostas, scores.tolist()
+
+    def calcular_scores(self, pergunta: str, textos_documentos: List[str]):
+        return self.calcular_scores_pares([pergunta] * len(textos_documentos), textos_documentos)
+
+    def calcular_scores_pares(self, perguntas: List[str], textos_documentos: List[str]):
+        # Tokeniza os pares pergunta/documento de uma vez, para um único forward pass com padding
+        # (pares de perguntas diferentes permitem agrupar requisições distintas no mesmo lote)
+        inputs = self.tokenizador(
+            perguntas,
+            textos_documentos,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=512
+        )
+
+        entradas_modelo = {key: value.to(self.device) for key, value in inputs.items()}
+
+        with torch.no_grad():
+            outputs = self.modelo(**entradas_modelo)
+
+        # Posições de padding não podem participar de argmax, médias nem softmax
+        mascara = entradas_modelo['attention_mask'].bool()
+
+        # AFAZER: Avaliar se score ponderado faz sentido
+        # Extraindo os logits como tensores (num_documentos x num_tokens)
+        logits_inicio = outputs.start_logits.masked_fill(~mascara, float('-inf'))
+        logits_fim = outputs.end_logits.masked_fill(~mascara, float('-inf'))
+
+        # Média dos logits positivos de cada documento (0 quando não há logits positivos)
+        positivos_inicio = logits_inicio > 0
+        positivos_fim = logits_fim > 0
+        media_logits_inicio_positivos = torch.where(positivos_inicio, logits_inicio, 0).sum(dim=-1) / positivos_inicio.sum(dim=-1).clamp(min=1)
+        media_logits_fim_positivos = torch.where(positivos_fim, logits_fim, 0).sum(dim=-1) / positivos_fim.sum(dim=-1).clamp(min=1)
+        media_logits_positivos = (media_logits_inicio_positivos + media_logits_fim_positivos) / 2
+
+        # Obtendo os índices e valores dos melhores logits
+        melhores_logits_inicio, indices_melhor_logit_inicio = logits_inicio.max(dim=-1)
+        melhores_logits_fim, indices_melhor_logit_fim = logits_fim.max(dim=-1)
+
+        scores = melhores_logits_inicio + melhores_logits_fim
+        scores_ponderados = scores * media_logits_positivos
+
+        # calculando score estimado
+        scores_estimados = torch.softmax(logits_inicio, dim=-1).max(dim=-1).values * torch.softmax(logits_fim, dim=-1).max(dim=-1).values
+
+        # score: soma do melhor Logit inicial com o melhor logit final
+        # score_estimado: multiplicação do softmax dos logits de inicio pelo dos logits de fim
+        # score_ponderado: score ponderado pela média dos logits de inicio e fim, só quando positivos
+        # -- (quanto mais logits positivos, mais o documento tem melhor avaliação)
+        # score do pipeline: calculado a partir dos mesmos logits, restritos aos tokens do documento
+        respostas_pipeline, scores_pipeline = self.extrair_respostas_pipeline(inputs, textos_documentos, outputs.start_logits, outputs.end_logits)
+
+        # valores em formato python (float/int) para serialização com JSON
+        ids_tokens = inputs['input_ids'].tolist()
+        indices_inicio = indices_melhor_logit_inicio.tolist()
+        indices_fim = indices_melhor_logit_fim.tolist()
+        scores = scores.tolist()
+        scores_ponderados = scores_ponderados.tolist()
+        scores_estimados = scores_estimados.tolist()
+
+        resultados = []
+        for idx in range(len(textos_documentos)):
+            tokens_resposta = ids_tokens[idx][indices_inicio[idx]:indices_fim[idx] + 1]
+            resposta = self.tokenizador.decode(tokens_resposta, skip_special_tokens=True)
+            resultados.append({
+                'resposta': (resposta, respostas_pipeline[idx]),
+                'score': (scores[idx], scores_pipeline[idx], scores_estimados[idx]),
+                'score_ponderado': scores_ponderados[idx]
+            })
+        return resultados
@@ -0,0 +1,375 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from time import time
+from typing import List
+
+from api.utils.loteador_embeddings import LoteadorEmbeddings
+from api.utils.utils import FuncaoEmbeddings
+
+# Protocolo: cada mensagem é um objeto JSON precedido do seu tamanho em bytes (4 bytes, big-endian)
+CABECALHO_MENSAGEM = struct.Struct('>I')
+
+
+def interpretar_endereco(endereco: str):
+    # 'host:porta' é TCP; qualquer outro valor é o caminho de um socket Unix
+    host, separador, porta = endereco.rpartition(':')
+    if separador and porta.isdigit() and '/' not in host: return (host or '127.0.0.1', int(porta))
+    return endereco
+
+
+def codificar_mensagem(mensagem: dict):
+    conteudo = json.dumps(mensagem, ensure_ascii=False).encode('utf-8')
+    return CABECALHO_MENSAGEM.pack(len(conteudo)) + conteudo
+
+
+async def ler_mensagem(reader: asyncio.StreamReader):
+    tamanho, = CABECALHO_MENSAGEM.unpack(await reader.readexactly(CABECALHO_MENSAGEM.size))
+    return json.loads(await reader.readexactly(tamanho))
+
+
+class ErroServidorModelos(Exception):
+    pass
+
+
+class LoteadorScoresBert:
+    '''
+    Agrupa as requisições de scores do Bert que chegam dentro da janela de espera em um único forward pass,
+    limitado a tamanho_max_lote pares pergunta/documento. Cada requisição recebe de volta os seus resultados.
+    '''
+    def __init__(self, reranker_bert, executor: Executor, tempo_max_espera_ms: float=5, tamanho_max_lote: int=64):
+        self.reranker_bert = reranker_bert
+        self.executor = executor
+        self.tempo_max_espera = tempo_max_espera_ms / 1000
+        self.tamanho_max_lote = tamanho_max_lote
+        self.fila = None
+        self.tarefa_processamento = None
+        self.proxima_requisicao = None
+
+        # Métricas
+        self.qtd_lotes = 0
+        self.qtd_requisicoes = 0
+        self.qtd_pares = 0
+
+    def iniciar(self):
+        if self.tarefa_processamento is None or self.tarefa_processamento.done():
+            # Como no LoteadorEmbeddings, as requisições deixadas na fila de uma tarefa encerrada recebem o erro dela
+            if self.tarefa_processamento is not None: self.esvaziar_fila(self.fila, self.tarefa_processamento)
+            self.fila = asyncio.Queue()
+            self.tarefa_processamento = asyncio.get_running_loop().create_task(self.processar_fila())
+            self.tarefa_processamento.add_done_callback(partial(self.esvaziar_fila, self.fila))
+
+    @staticmethod
+    def obter_erro_encerramento(tarefa: asyncio.Task):
+        if tarefa.cancelled() or tarefa.exception() is None:
+            return RuntimeError('Loteador de scores do Bert encerrado')
+        return tarefa.exception()
+
+    def esvaziar_fila(self, fila: asyncio.Queue, tarefa: asyncio.Task):
+        futuros = []
+        while not fila.empty():
+            _, _, futuro = fila.get_nowait()
+            futuros.append(futuro)
+        LoteadorEmbeddings.falhar_futuros(futuros, self.obter_erro_encerramento(tarefa))
+
+    async def fechar(self):
+        if self.tarefa_processamento is not None:
+            self.tarefa_processamento.cancel()
+            try:
+                await self.tarefa_processamento
+            except asyncio.CancelledError:
+                pass
+            self.tarefa_processamento = None
+
+    async def calcular_scores(self, pergunta: str, textos_documentos: List[str]):
+        if not textos_documentos: return []
+        self.iniciar()
+        futuro = asyncio.get_running_loop().create_future()
+        self.fila.put_nowait((pergunta, textos_documentos, futuro))
+        return await futuro
+
+    async def montar_lote(self, lote: list):
+        # Os itens são acrescentados à lista do chamador, que os encerra se a tarefa for interrompida no meio
+        loop = asyncio.get_running_loop()
+        # Uma requisição que não coube no lote anterior abre o próximo
+        if self.proxima_requisicao:
+            lote.append(self.proxima_requisicao)
+            self.proxima_requisicao = None
+        else:
+            lote.append(await self.fila.get())
+        qtd_pares = len(lote[0][1])
+        prazo = loop.time() + self.tempo_max_espera
+        while qtd_pares < self.tamanho_max_lote:
+            tempo_restante = prazo - loop.time()
+            if tempo_restante <= 0: break
+            try:
+                requisicao = await asyncio.wait_for(self.fila.get(), tempo_restante)
+            except asyncio.TimeoutError:
+                break
+            if qtd_pares + len(requisicao[1]) > self.tamanho_max_lote:
+                self.proxima_requisicao = requisicao
+                break
+            lote.append(requisicao)
+            qtd_pares += len(requisicao[1])
+
+    async def processar_fila(self):
+        while True:
+            lote = []
+            try:
+                await self.montar_lote(lote)
+                await self.processar_lote(lote)
+            except BaseException as erro:
+                # Erro inesperado ou cancelamento (fechar): o lote em andamento e a requisição guardada para o
+                # próximo lote não ficam sem resposta
+                if self.proxima_requisicao:
+                    lote.append(self.proxima_requisicao)
+                    self.proxima_requisicao = None
+                LoteadorEmbeddings.falhar_futuros([futuro for _, _, futuro in lote], erro if isinstance(erro, Exception) else RuntimeError('Loteador de scores do Bert encerrado'))
+                raise
+
+    async def processar_lote(self, lote: list):
+        loop = asyncio.get_running_loop()
+        # Requisições canceladas enquanto esperavam não precisam de scores
+        lote = [requisicao for requisicao in lote if not requisicao[2].done()]
+        if not lote: return
+
+        perguntas = [pergunta for pergunta, textos, _ in lote for _ in textos]
+        textos = [texto for _, textos_requisicao, _ in lote for texto in textos_requisicao]
+        try:
+            resultados = await loop.run_in_executor(self.executor, self.reranker_bert.calcular_scores_pares, perguntas, textos)
+        except Exception as erro:
+            LoteadorEmbeddings.falhar_futuros([futuro for _, _, futuro in lote], erro)
+            return
+
+        inicio = 0
+        for _, textos_requisicao, futuro in lote:
+            if not futuro.done(): futuro.set_result(resultados[inicio:inicio + len(textos_requisicao)])
+            inicio += len(textos_requisicao)
+
+        self.qtd_lotes += 1
+        self.qtd_requisicoes += len(lote)
+        self.qtd_pares += len(textos)
+
+    def estatisticas(self):
+        return {
+            'lotes': self.qtd_lotes,
+            'requisicoes': self.qtd_requisicoes,
+            'pares': self.qtd_pares,
+            'requisicoes_por_lote': self.qtd_requisicoes / self.qtd_lotes if self.qtd_lotes else 0.0,
+            'pares_por_lote': self.qtd_pares / self.qtd_lotes if self.qtd_lotes else 0.0,
+            'tamanho_fila': self.fila.qsize() if self.fila else 0
+        }
+
+
+class ServidorModelos:
+    '''
+    Processo que hospeda o modelo de embeddings e o Bert para todos os workers da API, que passam a carregar
+    apenas os clientes (FuncaoEmbeddingsRemota e RerankerBertRemoto). Requisições concorrentes, de qualquer
+    worker, são agrupadas em lotes antes de chegar aos modelos.
+    '''
+    def __init__(self, funcao_de_embeddings: FuncaoEmbeddings, reranker_bert, tempo_max_espera_ms: float=5, tamanho_max_lote_embeddings: int=32, tamanho_max_lote_bert: int=64):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.loteador_embeddings = LoteadorEmbeddings(funcao_de_embeddings, self.executor, tempo_max_espera_ms, tamanho_max_lote_embeddings)
+        self.loteador_scores_bert = LoteadorScoresBert(reranker_bert, self.executor, tempo_max_espera_ms, tamanho_max_lote_bert)
+        self.qtd_conexoes = 0
+
+    async def processar_requisicao(self, requisicao: dict):
+        operacao = requisicao.get('operacao')
+        if operacao == 'embeddings':
+            return await asyncio.gather(*(self.loteador_embeddings.gerar_embedding(texto) for texto in requisicao['textos']))
+        if operacao == 'scores_bert':
+            return await self.loteador_scores_bert.calcular_scores(requisicao['pergunta'], requisicao['textos'])
+        if operacao == 'estatisticas':
+            return self.estatisticas()
+        raise ValueError(f'Operação desconhecida: {operacao}')
+
+    async def responder(self, requisicao: dict, writer: asyncio.StreamWriter, trava_escrita: asyncio.Lock):
+        try:
+            resposta = {'id': requisicao.get('id'), 'resultado': await self.processar_requisicao(requisicao)}
+        except Exception as erro:
+            resposta = {'id': requisicao.get('id'), 'erro': f'{type(erro).__name__}: {erro}'}
+        async with trava_escrita:
+            writer.write(codificar_mensagem(resposta))
+            await writer.drain()
+
+    async def atender_conexao(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.qtd_conexoes += 1
+        trava_escrita = asyncio.Lock()
+        tarefas = set()
+        try:
+            while True:
+                try:
+                    requisicao = await ler_mensagem(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                # Cada requisição é atendida em uma tarefa própria, para que entre no lote junto com as de outras conexões
+                tarefa = asyncio.create_task(self.responder(requisicao, writer, trava_escrita))
+                tarefas.add(tarefa)
+                tarefa.add_done_callback(tarefas.discard)
+        finally:
+            for tarefa in tarefas: tarefa.cancel()
+            self.qtd_conexoes -= 1
+            writer.close()
+
+    async def executar(self, endereco: str):
+        endereco = interpretar_endereco(endereco)
+        if isinstance(endereco, tuple):
+            servidor = await asyncio.start_server(self.atender_conexao, *endereco)
+        else:
+            # Socket de uma execução anterior encerrada sem limpeza
+            if os.path.exists(endereco): os.remove(endereco)
+            servidor = await asyncio.start_unix_server(self.atender_conexao, endereco)
+        print(f'Servidor de modelos aguardando conexões em {endereco}')
+        try:
+            async with servidor:
+                await servidor.serve_forever()
+        finally:
+            await self.loteador_embeddings.fechar()
+            await self.loteador_scores_bert.fechar()
+            self.executor.shutdown(wait=False)
+
+    def estatisticas(self):
+        return {
+            'conexoes': self.qtd_conexoes,
+            'embeddings': self.loteador_embeddings.estatisticas(),
+            'scores_bert': self.loteador_scores_bert.estatisticas()
+        }
+
+
+class ClienteServidorModelos:
+    '''
+    Cliente síncrono do ServidorModelos, para uso nas threads do executor da API. Cada thread mantém a sua
+    própria conexão, reaberta automaticamente se o servidor for reiniciado.
+    '''
+    def __init__(self, endereco: str, timeout: float=60):
+        self.endereco = interpretar_endereco(endereco)
+        self.timeout = timeout
+        self.local = threading.local()
+        self.conexoes = []
+        self.trava = threading.Lock()
+        self.contador_ids = 0
+
+    def conectar(self):
+        familia = socket.AF_INET if isinstance(self.endereco, tuple) else socket.AF_UNIX
+        conexao = socket.socket(familia, socket.SOCK_STREAM)
+        conexao.settimeout(self.timeout)
+        conexao.connect(self.endereco)
+        if familia == socket.AF_INET: conexao.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.trava: self.conexoes.append(conexao)
+        return conexao
+
+    def descartar_conexao(self):
+        conexao = getattr(self.local, 'conexao', None)
+        self.local.conexao = None
+        if conexao is None: return
+        with self.trava:
+            if conexao in self.conexoes: self.conexoes.remove(conexao)
+        conexao.close()
+
+    def receber_exatamente(self, conexao: socket.socket, tamanho: int):
+        dados = bytearray()
+        while len(dados) < tamanho:
+            fragmento = conexao.recv(tamanho - len(dados))
+            if not fragmento: raise ConnectionError('Conexão encerrada pelo servidor de modelos')
+            dados += fragmento
+        return bytes(dados)
+
+    def requisitar(self, operacao: str, **dados):
+        with self.trava:
+            self.contador_ids += 1
+            id_requisicao = self.contador_ids
+        mensagem = codificar_mensagem({'id': id_requisicao, 'operacao': operacao, **dados})
+        # Uma nova tentativa, com nova conexão, cobre conexões recusadas ou encerradas por reinicialização do servidor
+        for tentativa in range(2):
+            try:
+                conexao = getattr(self.local, 'conexao', None) or self.conectar()
+                self.local.conexao = conexao
+                conexao.sendall(mensagem)
+                tamanho, = CABECALHO_MENSAGEM.unpack(self.receber_exatamente(conexao, CABECALHO_MENSAGEM.size))
+                resposta = json.loads(self.receber_exatamente(conexao, tamanho))
+                break
+            except socket.timeout:
+                # Sem nova tentativa: o servidor pode estar apenas demorando (um lote grande), e a requisição seria
+                # executada duas vezes. A conexão é descartada, pois a resposta atrasada ainda chegaria por ela
+                self.descartar_conexao()
+                raise
+            except OSError:
+                self.descartar_conexao()
+                if tentativa == 1: raise
+        if 'erro' in resposta: raise ErroServidorModelos(resposta['erro'])
+        return resposta['resultado']
+
+    def fechar(self):
+        with self.trava:
+            conexoes, self.conexoes = self.conexoes, []
+        for conexao in conexoes: conexao.close()
+
+
+class FuncaoEmbeddingsRemota(FuncaoEmbeddings):
+    '''
+    FuncaoEmbeddings cujos embeddings são gerados pelo servidor de modelos. O cache local continua valendo,
+    e nome_modelo e instrucao (que compõem as chaves do cache) devem ser os mesmos usados pelo servidor.
+    '''
+    def __init__(self, cliente: ClienteServidorModelos, nome_modelo: str, instrucao: str="Represent the legislative document for retrieval:", cache=None):
+        self.cliente = cliente
+        self.nome_modelo = nome_modelo
+        self.instrucao = instrucao
+        self.cache = cache
+        self.device = None
+
+    def gerar_embeddings(self, input):
+        return self.cliente.requisitar('embeddings', textos=list(input))
+
+
+class RerankerBertRemoto:
+    # Mesma interface do RerankerBert, com os scores calculados pelo servidor de modelos
+    def __init__(self, cliente: ClienteServidorModelos):
+        self.cliente = cliente
+
+    def calcular_scores(self, pergunta: str, textos_documentos: List[str]):
+        return self.cliente.requisitar('scores_bert', pergunta=pergunta, textos=list(textos_documentos))
+
+
+if __name__ == '__main__':
+    from sentence_transformers import SentenceTransformer
+    from api.environment.environment import environment
+    from api.utils.reranker_bert import RerankerBert
+
+    parser = argparse.ArgumentParser(description="Servidor dos modelos de embeddings e do Bert, compartilhado pelos workers da API")
+
+    parser.add_argument('--endereco', type=str, default=environment.URL_SERVIDOR_MODELOS, help="caminho do socket Unix ou host:porta")
+    parser.add_argument('--tempo_max_espera_ms', type=float, default=environment.LOTEADOR_TEMPO_MAX_ESPERA_MS, help="janela de agrupamento das requisições em lotes")
+    parser.add_argument('--tamanho_max_lote_embeddings', type=int, default=environment.LOTEADOR_TAMANHO_MAX_LOTE, help="perguntas por lote de embeddings")
+    parser.add_argument('--tamanho_max_lote_bert', type=int, default=64, help="pares pergunta/documento por lote do Bert")
+
+    args = parser.parse_args()
+    if not args.endereco: parser.error('informe --endereco ou defina URL_SERVIDOR_MODELOS no .env')
+
+    marcador_tempo_inicio = time()
+    print(f'Carregando {environment.MODELO_DE_EMBEDDINGS} e {environment.EMBEDDING_SQUAD_PORTUGUESE} (device={environment.DEVICE})...')
+    funcao_de_embeddings = FuncaoEmbeddings(
+        nome_modelo=environment.MODELO_DE_EMBEDDINGS,
+        tipo_modelo=SentenceTransformer,
+        device=environment.DEVICE,
+        backend_inferencia=environment.BACKEND_INFERENCIA_EMBEDDINGS)
+    reranker_bert = RerankerBert(
+        environment.EMBEDDING_SQUAD_PORTUGUESE,
+        device=environment.DEVICE,
+        backend=environment.BACKEND_INFERENCIA_BERT,
+        url_modelo_onnx=environment.URL_MODELO_BERT_ONNX)
+    print(f'Modelos carregados ({time() - marcador_tempo_inicio:.1f} segundos)')
+
+    servidor = ServidorModelos(
+        funcao_de_embeddings,
+        reranker_bert,
+        tempo_max_espera_ms=args.tempo_max_espera_ms,
+        tamanho_max_lote_embeddings=args.tamanho_max_lote_embeddings,
+        tamanho_max_lote_bert=args.tamanho_max_lote_bert)
+    asyncio.run(servidor.executar(args.endereco))
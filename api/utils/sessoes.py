@@ -0,0 +1,115 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+
+from array import array
+from collections import OrderedDict
+from time import time
+
+
+class RepositorioSessoes:
+    '''
+    Armazena no servidor o contexto do Ollama (lista de ids de tokens ou, no modo chat, de mensagens) de cada
+    conversa, indexado por um id de sessão. O cliente envia somente o id, de modo que o tamanho da requisição não cresce com a conversa.
+    As sessões são mantidas em memória, em um LRU com expiração por tempo (TTL), ou, opcionalmente, em um banco
+    SQLite local (limitado apenas pelo TTL), que sobrevive a reinicializações e é compartilhado entre os workers.
+    '''
+    def __init__(self, tamanho_maximo: int=10000, ttl: float=None, url_sqlite: str=None, fazer_log: bool=True):
+        self.tamanho_maximo = tamanho_maximo
+        self.ttl = ttl
+        self.url_sqlite = url_sqlite
+        # id da sessão -> (instante da última atualização, contexto como array de inteiros de 32 bits ou JSON)
+        self.sessoes = OrderedDict()
+        self.trava = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+        self.qtd_gravacoes = 0
+
+        self.conexao = None
+        if self.url_sqlite:
+            if os.path.dirname(self.url_sqlite): os.makedirs(os.path.dirname(self.url_sqlite), exist_ok=True)
+            self.conexao = sqlite3.connect(self.url_sqlite, check_same_thread=False)
+            self.conexao.execute('PRAGMA journal_mode=WAL')
+            self.conexao.execute('CREATE TABLE IF NOT EXISTS sessoes (id TEXT PRIMARY KEY, contexto BLOB, instante REAL)')
+            self.conexao.commit()
+            if fazer_log: print(f'--- sessões persistidas em {self.url_sqlite}')
+
+    @staticmethod
+    def criar_id_sessao():
+        return uuid.uuid4().hex
+
+    def expirado(self, instante: float):
+        return bool(self.ttl) and time() - instante > self.ttl
+
+    def obter_contexto(self, id_sessao: str):
+        with self.trava:
+            if self.conexao:
+                # Com SQLite, o banco é a fonte de verdade: a sessão pode ter sido atualizada por outro worker
+                linha = self.conexao.execute('SELECT instante, contexto FROM sessoes WHERE id = ?', (id_sessao,)).fetchone()
+                item = (linha[0], self.decodificar_contexto(linha[1])) if linha else None
+            else:
+                item = self.sessoes.get(id_sessao)
+            if item is None or self.expirado(item[0]):
+                if item is not None: self.remover_sem_trava(id_sessao)
+                self.falhas += 1
+                return None
+            if not self.conexao: self.sessoes.move_to_end(id_sessao)
+            self.acertos += 1
+            return item[1].tolist() if isinstance(item[1], array) else json.loads(item[1])
+
+    @staticmethod
+    def codificar_contexto(contexto: list):
+        # Tokens (modo generate) ficam compactos em um array; mensagens (modo chat), em JSON
+        if contexto and not isinstance(contexto[0], int): return json.dumps(contexto, ensure_ascii=False)
+        return array('i', contexto or [])
+
+    @staticmethod
+    def decodificar_contexto(valor):
+        return valor if isinstance(valor, str) else array('i', valor)
+
+    def salvar_contexto(self, id_sessao: str, contexto: list):
+        item = (time(), self.codificar_contexto(contexto))
+        with self.trava:
+            if not self.conexao:
+                self.sessoes[id_sessao] = item
+                self.sessoes.move_to_end(id_sessao)
+                while len(self.sessoes) > self.tamanho_maximo:
+                    self.sessoes.popitem(last=False)
+            else:
+                self.conexao.execute('INSERT OR REPLACE INTO sessoes (id, contexto, instante) VALUES (?, ?, ?)', (id_sessao, item[1].tobytes() if isinstance(item[1], array) else item[1], item[0]))
+                self.qtd_gravacoes += 1
+                # Limpeza periódica das sessões expiradas no disco
+                if self.ttl and self.qtd_gravacoes % 100 == 0:
+                    self.conexao.execute('DELETE FROM sessoes WHERE instante < ?', (time() - self.ttl,))
+                self.conexao.commit()
+
+    def remover_sem_trava(self, id_sessao: str):
+        self.sessoes.pop(id_sessao, None)
+        if self.conexao:
+            self.conexao.execute('DELETE FROM sessoes WHERE id = ?', (id_sessao,))
+            self.conexao.commit()
+
+    def remover(self, id_sessao: str):
+        with self.trava:
+            self.remover_sem_trava(id_sessao)
+
+    def fechar(self):
+        if self.conexao:
+            with self.trava:
+                self.conexao.close()
+                self.conexao = None
+
+    def estatisticas(self):
+        with self.trava:
+            total = self.acertos + self.falhas
+            tamanho = self.conexao.execute('SELECT COUNT(*) FROM sessoes').fetchone()[0] if self.conexao else len(self.sessoes)
+            return {
+                'tamanho': tamanho,
+                'tamanho_maximo': self.tamanho_maximo,
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'taxa_acerto': self.acertos / total if total else 0.0,
+                'persistencia': self.url_sqlite
+            }
@@ -5,45 +5,147 @@ from torch import cuda
 
 import httpx
 import json
+import numpy as np
+import os
 from api.environment.environment import environment
-from typing import List
+from api.utils.cache import CacheEmbeddings
+from api.utils.inferencia_otimizada import quantizar_int8
+from typing import List, Optional
 
 
 class DadosChat(BaseModel):
     pergunta: str
-    contexto: list
+    # Clientes antigos enviam o contexto do Ollama a cada pergunta; com sessões, basta o id da sessão
+    contexto: Optional[list] = None
+    id_sessao: Optional[str] = None
 
 class FuncaoEmbeddings(EmbeddingFunction):
     # A instrução oferecida tem melhor resultado em inglês e no formato proposto no artigo do instructor. (Represent the legislative document question for retrieving supporting documents)
-    def __init__(self, nome_modelo: str, tipo_modelo=SentenceTransformer, device: str=None, instrucao: str="Represent the legislative document for retrieval:"):
+    def __init__(self, nome_modelo: str, tipo_modelo=SentenceTransformer, device: str=None, instrucao: str="Represent the legislative document for retrieval:", cache: CacheEmbeddings=None, tamanho_lote: int=32, backend_inferencia: str='torch'):
         if device:
             self.device = device
         else:
             self.device = 'cuda' if cuda.is_available() else 'cpu'
 
         # Carrega o modelo pre-treinado a partir do tipo de modelo escolhido
-        self.model = tipo_modelo(nome_modelo, device=self.device)
-        self.model.to(self.device)
+        # backend_inferencia: 'torch' (fp32), 'int8' (quantização dinâmica, CPU) ou 'onnx' (ONNX Runtime via sentence-transformers)
+        if backend_inferencia == 'onnx':
+            self.device = 'cpu'
+            self.model = tipo_modelo(nome_modelo, device=self.device, backend='onnx')
+        else:
+            self.model = tipo_modelo(nome_modelo, device=self.device)
+            self.model.to(self.device)
+            if backend_inferencia == 'int8':
+                self.device = 'cpu'
+                self.model = quantizar_int8(self.model.to('cpu'))
+        self.nome_modelo = nome_modelo
         self.instrucao = instrucao
+        self.cache = cache
+        # Quantidade de textos por forward pass do modelo
+        self.tamanho_lote = tamanho_lote
 
     def __call__(self, input: Documents) -> Embeddings:
+        if not self.cache: return self.gerar_embeddings(input)
+
+        # Somente os textos ausentes do cache passam pelo modelo
+        chaves = [self.cache.gerar_chave(self.nome_modelo, self.instrucao, texto) for texto in input]
+        embeddings = [self.cache.obter(chave) for chave in chaves]
+        pendentes = [idx for idx in range(len(embeddings)) if embeddings[idx] is None]
+        if pendentes:
+            novos_embeddings = self.gerar_embeddings([chaves[idx][2] for idx in pendentes])
+            for idx, embedding in zip(pendentes, novos_embeddings):
+                embeddings[idx] = embedding
+                self.cache.incluir(chaves[idx], embedding)
+        return embeddings
+
+    def gerar_embeddings(self, input: Documents) -> Embeddings:
         # obtém os embeddings do texto
         if self.instrucao:
             input_instrucao = [(self.instrucao, doc) for doc in input]
-            embeddings = self.model.encode(input_instrucao, convert_to_numpy=True, device=self.device)
+            embeddings = self.model.encode(input_instrucao, batch_size=self.tamanho_lote, convert_to_numpy=True, device=self.device)
         else:
-            embeddings = self.model.encode(input, convert_to_numpy=True, device=self.device)
+            embeddings = self.model.encode(input, batch_size=self.tamanho_lote, convert_to_numpy=True, device=self.device)
         return embeddings.tolist()
     
+class DecodificadorNdjson:
+    '''
+    Decodificador incremental de NDJSON. Os bytes recebidos são acumulados e somente linhas completas são
+    decodificadas, de modo que fragmentos de rede que quebrem ou juntem linhas não causem perda de dados.
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+        # Posição a partir da qual procurar a próxima quebra de linha (evita varrer o buffer novamente)
+        self.posicao_busca = 0
+
+    def decodificar_linha(self, linha: bytes):
+        try:
+            return json.loads(linha)
+        except json.JSONDecodeError:
+            print('ERRO: falha na serialização da linha\n' + linha.decode(errors='replace'))
+            return None
+
+    def alimentar(self, dados: bytes):
+        self.buffer += dados
+        objetos = []
+        while True:
+            fim_linha = self.buffer.find(b'\n', self.posicao_busca)
+            if fim_linha == -1:
+                self.posicao_busca = len(self.buffer)
+                return objetos
+            linha = bytes(self.buffer[:fim_linha]).strip()
+            del self.buffer[:fim_linha + 1]
+            self.posicao_busca = 0
+            if linha:
+                objeto = self.decodificar_linha(linha)
+                if objeto is not None: objetos.append(objeto)
+
+    def finalizar(self):
+        # A última linha pode chegar sem a quebra de linha final
+        linha = bytes(self.buffer).strip()
+        self.buffer = bytearray()
+        self.posicao_busca = 0
+        if not linha: return []
+        objeto = self.decodificar_linha(linha)
+        return [objeto] if objeto is not None else []
+
 class ClienteOllama:
-    def __init__(self, nome_modelo: str, url_llama: str, temperature: float=0):
+    def __init__(self,
+                 nome_modelo: str,
+                 url_llama: str,
+                 temperature: float=0,
+                 max_conexoes: int=environment.OLLAMA_MAX_CONEXOES,
+                 max_conexoes_keepalive: int=environment.OLLAMA_MAX_CONEXOES_KEEPALIVE,
+                 tempo_keepalive: float=environment.OLLAMA_TEMPO_KEEPALIVE,
+                 timeout_conexao: float=environment.OLLAMA_TIMEOUT_CONEXAO,
+                 timeout_leitura: float=environment.OLLAMA_TIMEOUT_LEITURA,
+                 keep_alive=None):
         self.modelo = nome_modelo
         self.url_llama = url_llama
         self.temperature = temperature
+        # Tempo que o Ollama mantém o modelo carregado após cada requisição (negativo: indefinidamente;
+        # None usa o padrão do próprio Ollama)
+        self.keep_alive = keep_alive
+
+        self.limites = httpx.Limits(
+            max_connections=max_conexoes,
+            max_keepalive_connections=max_conexoes_keepalive,
+            keepalive_expiry=tempo_keepalive)
+        self.timeout = httpx.Timeout(timeout_leitura, connect=timeout_conexao, pool=timeout_conexao)
+        # Cliente HTTP de longa duração, reaproveitando conexões entre requisições.
+        # É criado sob demanda, pois precisa pertencer ao event loop em que será usado
+        self.cliente_http = None
+
+    def obter_cliente_http(self):
+        if self.cliente_http is None or self.cliente_http.is_closed:
+            self.cliente_http = httpx.AsyncClient(base_url=self.url_llama, limits=self.limites, timeout=self.timeout)
+        return self.cliente_http
+
+    async def fechar(self):
+        if self.cliente_http is not None:
+            await self.cliente_http.aclose()
+            self.cliente_http = None
 
     async def stream(self, prompt: str, contexto=[]):
-        url = f"{self.url_llama}/api/generate"
-        
         payload = {
             "model": self.modelo,
             "prompt": prompt,
@@ -52,23 +154,52 @@ class ClienteOllama:
             "stream": True,
             "max_new_tokens": 4096
         }
-        
-        # Using httpx in synchronous mode
-        async with httpx.AsyncClient() as client:
-            async with client.stream("POST", url, json=payload, timeout=120) as resposta:
-                resposta.raise_for_status()
-
-                async for fragmento in resposta.aiter_bytes():
-                    if fragmento:
-                        try:
-                            yield json.loads(fragmento.decode())
-                        except:
-                            print('ERRO: falha na serialização do fragmento\n' + fragmento.decode())
+        if self.keep_alive is not None: payload['keep_alive'] = self.keep_alive
+        async for objeto in self.transmitir("/api/generate", payload):
+            yield objeto
+
+    async def stream_chat(self, mensagens: List[dict], opcoes: dict=None):
+        payload = {
+            "model": self.modelo,
+            "messages": mensagens,
+            "stream": True,
+            "options": {"temperature": self.temperature, **(opcoes or {})}
+        }
+        if self.keep_alive is not None: payload['keep_alive'] = self.keep_alive
+        async for objeto in self.transmitir("/api/chat", payload):
+            yield objeto
+
+    async def carregar_modelo(self):
+        # Requisição sem prompt: o Ollama apenas carrega o modelo (e renova o keep_alive)
+        payload = {"model": self.modelo}
+        if self.keep_alive is not None: payload['keep_alive'] = self.keep_alive
+        resposta = await self.obter_cliente_http().post("/api/generate", json={**payload, "stream": False})
+        resposta.raise_for_status()
+
+    async def transmitir(self, caminho: str, payload: dict):
+        async with self.obter_cliente_http().stream("POST", caminho, json=payload) as resposta:
+            resposta.raise_for_status()
+
+            decodificador = DecodificadorNdjson()
+            async for fragmento in resposta.aiter_bytes():
+                for objeto in decodificador.alimentar(fragmento):
+                    yield objeto
+            for objeto in decodificador.finalizar():
+                yield objeto
 
 class InterfaceOllama:
-    def __init__(self, nome_modelo: str, url_llama: str, temperature: float=0):
+    '''
+    Monta os prompts e transmite as respostas do Llama. No modo 'generate', o prompt é uma string no formato
+    [INST]<<SYS>> enviada a /api/generate, com o contexto de tokens do Ollama. No modo 'chat', usa /api/chat e o
+    template do próprio modelo: a mensagem de sistema, idêntica em todas as requisições, vem primeiro (prefixo
+    reaproveitável no cache KV do Ollama), seguida do histórico da conversa e, por fim, dos documentos e da
+    pergunta. Nesse modo, o contexto da conversa é a lista de mensagens anteriores (sem os documentos).
+    '''
+    def __init__(self, nome_modelo: str, url_llama: str, temperature: float=0, modo: str=environment.MODO_OLLAMA, max_mensagens_historico: int=environment.MAX_MENSAGENS_HISTORICO, keep_alive=None):
 
-        self.cliente_ollama = ClienteOllama(url_llama= url_llama, nome_modelo=nome_modelo, temperature=temperature)
+        self.cliente_ollama = ClienteOllama(url_llama= url_llama, nome_modelo=nome_modelo, temperature=temperature, keep_alive=keep_alive)
+        self.modo = modo
+        self.max_mensagens_historico = max_mensagens_historico
 
         self.papel_do_LLM = '''ALERN e ALRN significam Assembleia Legislativa do Estado do Rio Grande do Norte.
 Você é um assistente que responde a dúvidas de servidores da ALERN sobre o regimento interno da ALRN, o regime jurídico dos servidores estaduais do RN, bem como resoluções da ALRN.
@@ -82,16 +213,63 @@ Se você não souber a resposta, assuma um tom gentil e diga que não tem inform
     def formatar_prompt_usuario(self, pergunta: str, documentos: List[str]):
         return 'DOCUMENTOS:\n{}\nPERGUNTA: {}'.format('\n'.join(documentos), pergunta)
 
+    @property
+    def definicoes_sistema(self):
+        return f'''{self.papel_do_LLM} DIRETRIZES PARA AS RESPOSTAS: {self.diretrizes}'''
+
     def criar_prompt_llama(self, prompt_usuario: str):
-        definicoes_sistema = f'''{self.papel_do_LLM} DIRETRIZES PARA AS RESPOSTAS: {self.diretrizes}'''
-        return f'<s>[INST]<<SYS>>\n{definicoes_sistema}\n<</SYS>>\n{prompt_usuario}[/INST]'
-    
+        return f'<s>[INST]<<SYS>>\n{self.definicoes_sistema}\n<</SYS>>\n{prompt_usuario}[/INST]'
+
+    def criar_mensagens_chat(self, prompt_usuario: str, historico: List[dict]=[]):
+        return [{'role': 'system', 'content': self.definicoes_sistema}, *historico, {'role': 'user', 'content': prompt_usuario}]
+
+    async def fechar(self):
+        await self.cliente_ollama.fechar()
+
+    async def aquecer(self):
+        # Carrega o modelo antes da primeira pergunta; no modo chat, já processa o prefixo de sistema
+        if self.modo == 'chat':
+            async for _ in self.cliente_ollama.stream_chat([{'role': 'system', 'content': self.definicoes_sistema}], opcoes={'num_predict': 1}):
+                pass
+        else:
+            await self.cliente_ollama.carregar_modelo()
+
     async def gerar_resposta_llama(self, pergunta: str, documentos: List[str], contexto:List[int]=environment.CONTEXTO_BASE):
         prompt_usuario = self.formatar_prompt_usuario(pergunta, documentos)
+        if self.modo == 'chat':
+            async for fragmento_resposta in self.gerar_resposta_chat(pergunta, prompt_usuario, contexto):
+                yield fragmento_resposta
+            return
         prompt = self.criar_prompt_llama(prompt_usuario=prompt_usuario)
         async for fragmento_resposta in self.cliente_ollama.stream(prompt=prompt, contexto=contexto):
             yield fragmento_resposta
 
+    async def gerar_resposta_chat(self, pergunta: str, prompt_usuario: str, contexto: list):
+        # Contextos de tokens (modo generate) não se aplicam ao chat e são ignorados
+        historico = [mensagem for mensagem in contexto or [] if isinstance(mensagem, dict)]
+        texto_resposta = ''
+        async for fragmento_resposta in self.cliente_ollama.stream_chat(self.criar_mensagens_chat(prompt_usuario, historico)):
+            # Mesmo formato do /api/generate: o texto em 'response' e, no último fragmento, o contexto em 'context'
+            fragmento_resposta['response'] = fragmento_resposta.get('message', {}).get('content', '')
+            texto_resposta += fragmento_resposta['response']
+            if fragmento_resposta.get('done'):
+                fragmento_resposta['context'] = self.acrescentar_ao_historico(historico, pergunta, texto_resposta)
+            yield fragmento_resposta
+
+    def acrescentar_ao_historico(self, historico: list, pergunta: str, texto_resposta: str):
+        historico = [mensagem for mensagem in historico or [] if isinstance(mensagem, dict)]
+        historico = historico + [{'role': 'user', 'content': pergunta}, {'role': 'assistant', 'content': texto_resposta}]
+        return historico[-self.max_mensagens_historico:] if self.max_mensagens_historico > 0 else historico
+
+    def derivar_contexto(self, contexto: list, pergunta: str, texto_resposta: str):
+        '''
+        Contexto da conversa após uma resposta que não passou pelo modelo (resposta do cache). No modo chat, é o
+        histórico de quem perguntou acrescido da sua pergunta e da resposta; no modo generate, os tokens do Ollama
+        não podem ser obtidos sem o modelo, e a conversa continua do contexto anterior de quem perguntou.
+        '''
+        if self.modo == 'chat': return self.acrescentar_ao_historico(contexto, pergunta, texto_resposta)
+        return list(contexto or [])
+
 class InterfaceChroma:
     def __init__(self,
                  url_banco_vetores=environment.URL_BANCO_VETORES,
@@ -105,11 +283,32 @@ class InterfaceChroma:
             print(f'--- criando a função de embeddings do ChromaDB com {environment.MODELO_DE_EMBEDDINGS} (device={environment.DEVICE})...')
             funcao_de_embeddings = FuncaoEmbeddings(model_name=environment.MODELO_DE_EMBEDDINGS, biblioteca=SentenceTransformer, device=environment.DEVICE)
         
+        self.funcao_de_embeddings = funcao_de_embeddings
+        self.url_banco_vetores = url_banco_vetores
+
         if fazer_log: print(f'--- inicializando banco de vetores (usando "{url_banco_vetores}")...')
         self.banco_de_vetores = chromadb.PersistentClient(path=url_banco_vetores)
 
         if fazer_log: print(f'--- definindo a coleção a ser usada ({colecao_de_documentos})...')
         self.colecao_documentos = self.banco_de_vetores.get_collection(name=colecao_de_documentos, embedding_function=funcao_de_embeddings)
     
-    def consultar_documentos(self, termos_de_consulta: str, num_resultados=environment.NUM_DOCUMENTOS_RETORNADOS):
-        return self.colecao_documentos.query(query_texts=[termos_de_consulta], n_results=num_resultados)
\ No newline at end of file
+    def consultar_documentos(self, termos_de_consulta: str, num_resultados=environment.NUM_DOCUMENTOS_RETORNADOS, embedding_consulta: List[float]=None):
+        if embedding_consulta is not None:
+            return self.colecao_documentos.query(query_embeddings=[embedding_consulta], n_results=num_resultados)
+        return self.colecao_documentos.query(query_texts=[termos_de_consulta], n_results=num_resultados)
+
+    def gerar_embedding_consulta(self, termos_de_consulta: str):
+        return self.funcao_de_embeddings([termos_de_consulta])[0]
+
+    def calcular_distancias(self, ids: List[str], embedding_consulta: List[float]):
+        # Distância do cosseno entre a consulta e documentos específicos (fora do resultado da busca densa)
+        registros = self.colecao_documentos.get(ids=ids, include=['embeddings'])
+        vetor = np.asarray(embedding_consulta, dtype=np.float32)
+        matriz = np.asarray(registros['embeddings'], dtype=np.float32)
+        similaridades = (matriz @ vetor) / (np.linalg.norm(matriz, axis=1) * np.linalg.norm(vetor) + 1e-12)
+        return dict(zip(registros['ids'], (1 - similaridades).tolist()))
+
+    def versao_colecao(self):
+        # Qualquer escrita na coleção (inclusive sua recriação) altera o arquivo SQLite do ChromaDB
+        url_sqlite = os.path.join(self.url_banco_vetores, 'chroma.sqlite3')
+        return os.path.getmtime(url_sqlite) if os.path.exists(url_sqlite) else None
\ No newline at end of file